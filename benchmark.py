@@ -0,0 +1,278 @@
+"""
+Benchmark of the profile pipeline on synthetic NHANES-shaped data.
+
+Generates synthetic XPT files for every mapped file, serves them from a local
+StubCDCServer and times each stage (download, filter, build, clean,
+visualization) with its peak traced memory.  Results can be saved as a
+baseline and later runs compared against it:
+
+    python benchmark.py --rows 20000 --save-baseline
+    python benchmark.py --rows 20000 --compare
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import mapping
+from cdc_stub import StubCDCServer, stub_file_index
+from nhanes_cleaner import NHANESDataCleaner
+from patient_profile_builder import PatientProfileBuilder, apply_filters, download_nhanes_file
+from synthetic_nhanes import CYCLES, generate_files, serve_files
+from xpt_cache import XPTCache
+
+DEFAULT_BASELINE_PATH = "benchmark_baselines.json"
+DEFAULT_TOLERANCE = 0.25
+# Growth below these is noise, whatever the ratio (millisecond stages jitter by more than 25%).
+MIN_DELTA = {"min_s": 0.01, "peak_mb": 1.0}
+BENCHMARK_FILTERS = {"age": "20-59", "gender": "Female"}
+
+
+def measure(fn, repeat=3):
+    """
+    Runs fn repeat times for timing, then once more under tracemalloc for its
+    peak memory.
+
+    Returns:
+    - (dict, object): {"min_s", "median_s", "peak_mb"} and the last result of fn.
+    """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    tracemalloc.start()
+    try:
+        result = fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"min_s": min(timings), "median_s": statistics.median(timings), "peak_mb": peak / 1024 ** 2}, result
+
+
+def _rows(result):
+    if isinstance(result, pd.DataFrame):
+        return len(result)
+    if isinstance(result, (list, tuple)):
+        return sum(_rows(item) for item in result)
+    return None
+
+
+def _import_api(scratch):
+    """
+    Imports the Flask app, keeping its artifacts in scratch and its cohort cube
+    off when it has not been imported yet.
+    """
+    overrides = {"NHANES_ARTIFACT_DIR": os.path.join(scratch, "artifacts"), "NHANES_COHORT_CUBE": "off"}
+    saved = {name: os.environ.get(name) for name in overrides}
+    os.environ.update({name: value for name, value in overrides.items() if saved[name] is None})
+    try:
+        import nhanes_api
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+    return nhanes_api
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(rows=10000, cycles=None, repeat=3, seed=0, workdir=None, verbose=False):
+    """
+    Runs every stage of the pipeline on synthetic data.
+
+    Parameters:
+    - rows (int): Participants per cycle.
+    - cycles (list): Cycles to include (default: all ten mapped cycles).
+    - repeat (int): Timed runs per stage.
+    - seed (int): Seed of the synthetic data.
+    - workdir (str): Scratch directory (default: a temporary directory, removed afterwards).
+    - verbose (bool): Keep the pipeline's DEBUG output.
+
+    Returns:
+    - dict: {"config", "environment", "stages": {stage: {"min_s", "median_s", "peak_mb", "rows"}}}.
+    """
+    cycles = list(cycles or CYCLES)
+    scratch = workdir or tempfile.mkdtemp(prefix="nhanes_bench_")
+    server = StubCDCServer().start()
+    original_index = mapping.FILE_INDEX
+    stages = {}
+    output = sys.stdout if verbose else open(os.devnull, "w")
+    try:
+        started = time.perf_counter()
+        written = generate_files(os.path.join(scratch, "xpt"), cycles, rows, seed)
+        generated = time.perf_counter() - started
+        serve_files(server, written)
+        mapping.FILE_INDEX = stub_file_index(original_index, server.base_url)
+        jobs = sorted(written)
+
+        def record(name, fn):
+            with contextlib.redirect_stdout(output):
+                stats, result = measure(fn, repeat)
+            stats["rows"] = _rows(result)
+            stages[name] = stats
+            print(f"{name:<22} {stats['min_s'] * 1000:>10.1f} ms {stats['peak_mb']:>10.1f} MB "
+                  f"{stats['rows'] if stats['rows'] is not None else '':>10}")
+            return result
+
+        def cold_download():
+            cache = XPTCache(tempfile.mkdtemp(dir=scratch))
+            try:
+                return [download_nhanes_file(cycle, file_desc, category, cache=cache)
+                        for cycle, category, file_desc in jobs]
+            finally:
+                shutil.rmtree(cache.cache_dir, ignore_errors=True)
+
+        warm_cache = XPTCache(os.path.join(scratch, "warm_cache"))
+
+        def download(cycle, file_desc, category, **options):
+            return download_nhanes_file(cycle, file_desc, category, cache=warm_cache, **options)
+
+        with contextlib.redirect_stdout(output):
+            demographics = pd.concat([download(cycle, file_desc, category) for cycle, category, file_desc in jobs
+                                      if category == "demographics"], ignore_index=True)
+
+        selections = {}
+        for (category, file_desc) in mapping.FILE_COLUMNS:
+            selections.setdefault(category, []).append(file_desc)
+
+        print(f"{'stage':<22} {'time':>13} {'peak':>13} {'rows':>10}")
+        record("download", cold_download)
+        record("apply_filters", lambda: apply_filters(demographics, BENCHMARK_FILTERS))
+        profile = record("build_profile", lambda: PatientProfileBuilder(download).build_profile(
+            selections, cycles, join="left"))
+        record("clean_data", lambda: NHANESDataCleaner().clean_data(profile))
+
+        with contextlib.redirect_stdout(output):
+            nhanes_api = _import_api(scratch)
+            profile_id = nhanes_api.artifact_store.put(profile)
+        client = nhanes_api.app.test_client()
+        for mode in ("points", "stats"):
+            def visualize():
+                response = client.get(f"/visualization?profile_id={profile_id}&mode={mode}")
+                assert response.status_code == 200, response.get_data(as_text=True)
+                return response.get_data()
+            record(f"visualization_{mode}", visualize)
+    finally:
+        mapping.FILE_INDEX = original_index
+        server.stop()
+        if output is not sys.stdout:
+            output.close()
+        if workdir is None:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    return {
+        "config": {"rows": rows, "cycles": cycles, "repeat": repeat, "seed": seed},
+        "environment": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "generate_s": generated,
+            # ru_maxrss is in kilobytes on Linux.
+            "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        },
+        "stages": stages,
+    }
+
+
+def baseline_key(result):
+    config = result["config"]
+    return f"rows={config['rows']},cycles={len(config['cycles'])}"
+
+
+def load_baselines(path=DEFAULT_BASELINE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_baseline(result, path=DEFAULT_BASELINE_PATH):
+    """
+    Stores result as the baseline for its configuration (rows and cycles) in path.
+    """
+    baselines = load_baselines(path)
+    baselines[baseline_key(result)] = result
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def compare(result, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares the stages of result with a baseline of the same configuration.
+
+    Returns:
+    - list: (stage, metric, baseline value, current value, ratio) for every
+      stage whose fastest time or peak memory grew by more than tolerance
+      (and by more than MIN_DELTA).
+    """
+    regressions = []
+    for stage, current in result["stages"].items():
+        previous = baseline["stages"].get(stage)
+        if previous is None:
+            continue
+        for metric in ("min_s", "peak_mb"):
+            grown = current[metric] - previous[metric]
+            if previous[metric] > 0 and current[metric] > previous[metric] * (1 + tolerance) and grown > MIN_DELTA[metric]:
+                regressions.append((stage, metric, previous[metric], current[metric], current[metric] / previous[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the NHANES profile pipeline on synthetic data.")
+    parser.add_argument("--rows", type=int, default=10000, help="participants per cycle")
+    parser.add_argument("--cycles", type=int, default=len(CYCLES), help="number of cycles, from 1999-2000 on")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH, help="baseline file")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--compare", action="store_true", help="fail when a stage regressed against the baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="allowed relative growth")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="keep the pipeline's DEBUG output")
+    args = parser.parse_args(argv)
+
+    result = run_benchmark(args.rows, CYCLES[:args.cycles], args.repeat, args.seed, verbose=args.verbose)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+    status = 0
+    if args.compare:
+        baseline = load_baselines(args.baseline).get(baseline_key(result))
+        if baseline is None:
+            print(f"WARNING: No baseline for {baseline_key(result)} in {args.baseline}")
+        else:
+            regressions = compare(result, baseline, args.tolerance)
+            for stage, metric, before, after, ratio in regressions:
+                print(f"REGRESSION: {stage} {metric} {before:.4g} -> {after:.4g} ({ratio:.2f}x, "
+                      f"baseline {baseline['environment']['revision']})")
+            status = 1 if regressions else 0
+    if args.save_baseline:
+        save_baseline(result, args.baseline)
+        print(f"DEBUG: Baseline for {baseline_key(result)} saved to {args.baseline}")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+import hashlib
+import os
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CDC_BASE_URL = "https://wwwn.cdc.gov"
+FILE_PATH = "/Nchs/Data/Nhanes/Public/{year}/DataFiles/{code}.XPT"
+
+
+class StubCDCServer:
+    """
+    Local stand-in for the CDC file server.
+
+    Serves registered files at /Nchs/Data/Nhanes/Public/<year>/DataFiles/<code>.XPT
+    with ETag and Last-Modified headers, answers conditional requests with 304,
+    and can be told to fail the next N requests with 503 to exercise retries.
+    Files are registered either as bytes (add_file) or as paths on disk
+    (add_path), which are streamed so multi-gigabyte synthetic files never
+    have to be held in memory.
+    """
+
+    LAST_MODIFIED = "Tue, 01 Oct 2024 00:00:00 GMT"
+
+    def __init__(self):
+        self.files = {}
+        self.requests = []
+        self.fail_next = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with stub._lock:
+                    stub.requests.append((self.path, dict(self.headers)))
+                    if stub.fail_next:
+                        stub.fail_next -= 1
+                        self.send_response(503)
+                        self.end_headers()
+                        return
+                    entry = stub.files.get(self.path)
+                if entry is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body, etag, size = entry
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(size))
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", stub.LAST_MODIFIED)
+                self.end_headers()
+                if isinstance(body, bytes):
+                    self.wfile.write(body)
+                else:
+                    with open(body, "rb") as f:
+                        shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def _register(self, year, code, entry):
+        path = FILE_PATH.format(year=year, code=code)
+        with self._lock:
+            self.files[path] = entry
+        return self.base_url + path
+
+    def add_file(self, year, code, body):
+        etag = '"%s"' % hashlib.sha256(body).hexdigest()[:16]
+        return self._register(year, code, (body, etag, len(body)))
+
+    def add_path(self, year, code, file_path):
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        etag = '"%s"' % digest.hexdigest()[:16]
+        return self._register(year, code, (file_path, etag, os.path.getsize(file_path)))
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def stub_file_index(file_index, base_url):
+    """
+    Returns a copy of mapping.FILE_INDEX whose download URLs point at base_url
+    (a StubCDCServer) instead of the CDC.
+    """
+    return {key: spec._replace(url=spec.url.replace(CDC_BASE_URL, base_url)) for key, spec in file_index.items()}
@@ -0,0 +1,295 @@
+import json
+import os
+import threading
+import numpy as np
+from instrumentation import debug, warning
+from mapping import FILE_COLUMNS, resolve_file
+from patient_profile_builder import GENDER_CODES, RACE_CODES, compile_filters
+from visualization import numeric_values
+
+DEFAULT_CUBE_PATH = os.path.join("nhanes_data", "cohort_cube.npz")
+DEFAULT_CUBE_METRICS = ("BMXBMI", "BPXSY1", "BPXDI1")
+DEMOGRAPHICS_FILE = "Demographic Variables & Sample Weights"
+
+GENDER_AXIS = np.array(sorted(GENDER_CODES.values()), dtype=np.float64)
+RACE_AXIS = np.array(sorted(RACE_CODES.values()), dtype=np.float64)
+# NHANES top-codes age in years at 85 (80 in later cycles).
+AGE_AXIS = np.arange(0, 86, dtype=np.float64)
+AXES = {"RIAGENDR": GENDER_AXIS, "RIDRETH1": RACE_AXIS, "RIDAGEYR": AGE_AXIS}
+CELL_SHAPE = (len(GENDER_AXIS), len(RACE_AXIS), len(AGE_AXIS))
+
+
+def metric_selections(metrics):
+    """
+    Returns the build_profile selections holding the given metric variables,
+    always including the demographics file.
+    """
+    selections = {"demographics": DEMOGRAPHICS_FILE}
+    for metric in metrics:
+        for (category, file_desc), columns in FILE_COLUMNS.items():
+            if category != "demographics" and metric in columns:
+                files = selections.setdefault(category, [])
+                if file_desc not in files:
+                    files.append(file_desc)
+                break
+        else:
+            raise ValueError(f"Metric {metric} is not read from any mapped file.")
+    return selections
+
+
+def _axis_positions(values, axis):
+    positions = np.searchsorted(axis, values)
+    positions = np.minimum(positions, len(axis) - 1)
+    return positions, axis[positions] == values
+
+
+class CohortCube:
+    """
+    Materialized aggregate of merged profiles: participant counts and metric
+    sums (with non-missing counts) per (cycle, gender, race, age-year) cell.
+
+    Filtered count / mean queries are answered by summing the selected cells,
+    without touching participant rows.  Cycles are added or replaced one at a
+    time, each tagged with the source version it was built from, so a new or
+    changed cycle refreshes only its own slab.
+    """
+
+    def __init__(self, metrics=DEFAULT_CUBE_METRICS, path=DEFAULT_CUBE_PATH):
+        self.metrics = list(metrics)
+        self.path = path
+        self.cycles = []
+        self.versions = {}
+        self.counts = np.zeros((0,) + CELL_SHAPE, dtype=np.int64)
+        self.sums = np.zeros((len(self.metrics), 0) + CELL_SHAPE)
+        self.observed = np.zeros((len(self.metrics), 0) + CELL_SHAPE, dtype=np.int64)
+        self._lock = threading.Lock()
+
+    def _cells(self, df):
+        """
+        Returns the flat (gender, race, age) cell of every row and a mask of
+        rows with a known gender, race and age.
+        """
+        ages = np.clip(np.floor(numeric_values(df["RIDAGEYR"])), AGE_AXIS[0], AGE_AXIS[-1])
+        gender, gender_ok = _axis_positions(numeric_values(df["RIAGENDR"]), GENDER_AXIS)
+        race, race_ok = _axis_positions(numeric_values(df["RIDRETH1"]), RACE_AXIS)
+        valid = gender_ok & race_ok & ~np.isnan(ages)
+        age = np.nan_to_num(ages).astype(np.int64)
+        return np.ravel_multi_index((gender[valid], race[valid], age[valid]), CELL_SHAPE), valid
+
+    def add_cycle(self, cycle, df, version=None):
+        """
+        Adds (or replaces) the slab of one cycle from its profile rows.
+        """
+        size = int(np.prod(CELL_SHAPE))
+        cells, valid = self._cells(df)
+        counts = np.bincount(cells, minlength=size).reshape(CELL_SHAPE)
+        sums = np.zeros((len(self.metrics),) + CELL_SHAPE)
+        observed = np.zeros((len(self.metrics),) + CELL_SHAPE, dtype=np.int64)
+        for i, metric in enumerate(self.metrics):
+            if metric not in df.columns:
+                continue
+            values = numeric_values(df[metric])[valid]
+            present = ~np.isnan(values)
+            sums[i] = np.bincount(cells[present], weights=values[present], minlength=size).reshape(CELL_SHAPE)
+            observed[i] = np.bincount(cells[present], minlength=size).reshape(CELL_SHAPE)
+
+        with self._lock:
+            if cycle in self.cycles:
+                position = self.cycles.index(cycle)
+                self.counts[position] = counts
+                self.sums[:, position] = sums
+                self.observed[:, position] = observed
+            else:
+                self.cycles.append(cycle)
+                self.counts = np.concatenate([self.counts, counts[None]])
+                self.sums = np.concatenate([self.sums, sums[:, None]], axis=1)
+                self.observed = np.concatenate([self.observed, observed[:, None]], axis=1)
+            self.versions[cycle] = version
+        debug(f"Cohort cube updated for {cycle} ({int(counts.sum())} participants)")
+
+    def add_profile(self, df, version_function=None):
+        """
+        Adds every cycle of a long-layout profile, splitting it on its cycle column.
+        """
+        for cycle, rows in df.groupby(df["cycle"].astype(str), sort=False):
+            self.add_cycle(cycle, rows, version_function(cycle) if version_function else None)
+
+    def stale_cycles(self, cycles, version_function=None):
+        """
+        Returns the cycles that are missing from the cube or were built from an
+        older source version.
+        """
+        return [
+            cycle for cycle in cycles
+            if cycle not in self.versions
+            or (version_function is not None and self.versions[cycle] != version_function(cycle))
+        ]
+
+    def _axis_masks(self, filters):
+        masks = {column: np.ones(len(axis), dtype=bool) for column, axis in AXES.items()}
+        for column, kind, payload in compile_filters(filters).clauses:
+            if column not in AXES:
+                raise ValueError(f"Filter on {column} cannot be answered from the cohort cube.")
+            axis = AXES[column]
+            if kind == "isin":
+                masks[column] &= np.isin(axis, payload)
+            else:
+                in_any = np.zeros(len(axis), dtype=bool)
+                for lower, upper in payload:
+                    in_range = np.ones(len(axis), dtype=bool) if lower is None else axis >= lower
+                    if upper is not None:
+                        in_range &= axis <= upper
+                    in_any |= in_range
+                masks[column] &= in_any
+        return masks
+
+    def query(self, filters=None, cycles=None, metrics=None):
+        """
+        Answers a filtered count / mean query from the cube.
+
+        Parameters:
+        - filters (dict): Demographic filters as accepted by compile_filters
+          (gender, race, age / age_range).
+        - cycles (list): Cycles to include (default: every cycle in the cube).
+        - metrics (list): Metrics to average (default: every metric in the cube).
+
+        Returns:
+        - dict: {"count": participants, "metrics": {metric: {"n", "sum", "mean"}}}.
+        """
+        with self._lock:
+            cycles = list(self.cycles) if cycles is None else cycles
+            missing = [cycle for cycle in cycles if cycle not in self.cycles]
+            if missing:
+                raise ValueError(f"Cycles not in the cohort cube: {', '.join(missing)}.")
+            metrics = self.metrics if metrics is None else metrics
+            unknown = [metric for metric in metrics if metric not in self.metrics]
+            if unknown:
+                raise ValueError(f"Metrics not in the cohort cube: {', '.join(unknown)}.")
+
+            masks = self._axis_masks(filters)
+            cycle_mask = np.isin(self.cycles, cycles) if self.cycles else np.zeros(0, dtype=bool)
+            index = np.ix_(cycle_mask, masks["RIAGENDR"], masks["RIDRETH1"], masks["RIDAGEYR"])
+            result = {"count": int(self.counts[index].sum()), "metrics": {}}
+            for metric in metrics:
+                i = self.metrics.index(metric)
+                n = int(self.observed[i][index].sum())
+                total = float(self.sums[i][index].sum())
+                result["metrics"][metric] = {"n": n, "sum": total, "mean": total / n if n else None}
+        return result
+
+    def save(self, path=None):
+        """
+        Writes the cube to path (default: its own path, an .npz archive) atomically.
+        """
+        path = path or self.path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        with self._lock:
+            meta = json.dumps({"metrics": self.metrics, "cycles": self.cycles, "versions": self.versions})
+            np.savez_compressed(tmp_path, counts=self.counts, sums=self.sums, observed=self.observed,
+                                meta=np.array(meta))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=DEFAULT_CUBE_PATH, metrics=DEFAULT_CUBE_METRICS):
+        """
+        Returns the cube saved at path, or an empty cube when there is none or it
+        was built for different metrics.
+        """
+        cube = cls(metrics, path)
+        if not os.path.exists(path):
+            return cube
+        try:
+            with np.load(path) as data:
+                meta = json.loads(str(data["meta"]))
+                if meta["metrics"] != list(metrics) or data["counts"].shape[1:] != CELL_SHAPE:
+                    debug("Saved cohort cube was built for other metrics, starting afresh")
+                    return cube
+                cube.cycles = meta["cycles"]
+                cube.versions = meta["versions"]
+                cube.counts = data["counts"]
+                cube.sums = data["sums"]
+                cube.observed = data["observed"]
+        except Exception as e:
+            warning(f"Ignoring unreadable cohort cube {path}: {str(e)}")
+            return cls(metrics, path)
+        return cube
+
+
+def cycle_version(cube, version_function):
+    """
+    Returns a version_function for refresh_cube that covers only the files the
+    cube reads for a cycle, from a version_function(selections, cycles) such
+    as profile_fragments.plan_version.  Downloads of other files of the same
+    cycle then leave its slab valid.
+    """
+    selections = metric_selections(cube.metrics)
+    return lambda cycle: version_function(selections, [cycle])
+
+
+def refresh_cube(cube, builder, cycles, version_function=None):
+    """
+    Brings the cube up to date for cycles, building only the cycles that are
+    missing or stale with a single build_profile call.
+
+    A cycle is only added when every mapped file of it was loaded and it has
+    participants.  A failed download leaves the source version unchanged, so
+    recording the cycle would keep its incomplete slab until the files change;
+    left out, it is built again on the next refresh.
+
+    Returns:
+    - list: The cycles that were (re)built.
+    """
+    stale = cube.stale_cycles(cycles, version_function)
+    if not stale:
+        return []
+    debug(f"Refreshing cohort cube for {stale}")
+    incomplete = set()
+
+    def progress(job, status):
+        # Files not mapped for a cycle (a metric it never measured) are absent, not failed.
+        if status == "failed" and resolve_file(*job) is not None:
+            incomplete.add(job[0])
+
+    df = builder.build_profile(metric_selections(cube.metrics), stale, join="left", progress=progress)
+    built = []
+    if df is not None and not df.empty:
+        for cycle, rows in df.groupby(df["cycle"].astype(str), sort=False):
+            if cycle in stale and cycle not in incomplete:
+                cube.add_cycle(cycle, rows, version_function(cycle) if version_function else None)
+                built.append(cycle)
+    skipped = [cycle for cycle in stale if cycle not in built]
+    if skipped:
+        warning(f"Cohort cube not updated for {skipped}: their files could not all be loaded")
+    return [cycle for cycle in stale if cycle in built]
+
+
+def cube_from_env():
+    """
+    Returns the cohort cube configured by the environment, loaded from its saved
+    copy when there is one, or None when NHANES_COHORT_CUBE=off.
+
+    - NHANES_COHORT_CUBE_PATH: where the cube is saved (default nhanes_data/cohort_cube.npz)
+    - NHANES_COHORT_CUBE_METRICS: comma-separated metrics to aggregate
+    """
+    if os.environ.get("NHANES_COHORT_CUBE", "on").lower() in ("off", "0", "false"):
+        return None
+    metrics = os.environ.get("NHANES_COHORT_CUBE_METRICS")
+    metrics = [m.strip() for m in metrics.split(",") if m.strip()] if metrics else DEFAULT_CUBE_METRICS
+    return CohortCube.load(os.environ.get("NHANES_COHORT_CUBE_PATH", DEFAULT_CUBE_PATH), metrics)
+
+
+def parse_cohort_query(params):
+    """
+    Returns (filters, cycles, metrics) from /cohort query parameters: cycles and
+    metrics as comma-separated lists, and gender, race and age_range filters
+    (comma-separated for several values).
+    """
+    def split(name):
+        return [item.strip() for item in (params.get(name) or "").split(",") if item.strip()]
+
+    cycles = split("cycles")
+    if not cycles:
+        raise ValueError('Please provide "cycles".')
+    filters = {name: split(name) for name in ("gender", "race", "age_range") if split(name)}
+    return filters, cycles, split("metrics") or None
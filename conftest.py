@@ -0,0 +1,14 @@
+import pytest
+from cdc_stub import StubCDCServer, stub_file_index
+
+
+@pytest.fixture
+def cdc_server(monkeypatch):
+    """
+    Starts a StubCDCServer and points mapping.NHANES_URL-based downloads at it.
+    """
+    import mapping
+    server = StubCDCServer().start()
+    monkeypatch.setattr(mapping, "FILE_INDEX", stub_file_index(mapping.FILE_INDEX, server.base_url))
+    yield server
+    server.stop()
@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+from instrumentation import debug
+
+# Variables holding small integer codes rather than measurements.
+CODED_VARIABLES = {
+    "RIAGENDR", "RIDRETH1", "RIDRETH3", "RIDSTATR", "RIDEXMON", "SDMVPSU", "SDMVSTRA",
+    "DMDEDUC2", "DMDEDUC3", "DMDMARTL", "DMDCITZN", "DMDBORN", "INDHHINC", "INDFMINC",
+    "DIQ010", "DIQ050", "DIQ070", "DIQ160", "ALQ101", "ALQ110",
+}
+
+# Column prefixes that always keep float64 (survey weights are summed over large cohorts).
+FLOAT64_PREFIXES = ("WT",)
+
+ID_COLUMNS = ("SEQN",)
+
+
+def frame_memory(df):
+    """
+    Returns the deep memory usage of a DataFrame in bytes.
+    """
+    return int(df.memory_usage(deep=True).sum())
+
+
+def base_variable(col):
+    """
+    Returns the NHANES variable name of a possibly cycle-suffixed column
+    ("DIQ010_1999-2000" -> "DIQ010").
+    """
+    return str(col).split("_", 1)[0]
+
+
+class DtypePolicy:
+    """
+    Downcasts NHANES frames to compact dtypes.
+
+    - identifier columns (SEQN) become int32 (Int32 when they contain gaps)
+    - coded variables become the smallest nullable integer type (Int8 for the
+      usual 1/2/7/9 codes) or, with coded="category", pandas categoricals
+    - other float columns become float32 when every value survives the round
+      trip to within float_tolerance (NHANES measures carry at most three
+      decimals); survey weights stay float64
+    """
+
+    def __init__(self, coded="int8", float_dtype="float32", coded_variables=None,
+                 id_columns=ID_COLUMNS, float64_prefixes=FLOAT64_PREFIXES, float_tolerance=5e-4,
+                 verbose=True):
+        """
+        Parameters:
+        - coded (str): "int8" for nullable integers, "category" for categoricals,
+          or None to leave coded variables alone.
+        - float_dtype (str): Target dtype for continuous measures, or None to keep float64.
+        - coded_variables (set): Variable names treated as coded (default: CODED_VARIABLES).
+        - id_columns (tuple): Identifier columns downcast to int32.
+        - float64_prefixes (tuple): Column prefixes that keep full precision.
+        - float_tolerance (float): Largest absolute error allowed when narrowing floats.
+        - verbose (bool): Print memory usage before and after each conversion.
+        """
+        if coded not in ("int8", "category", None):
+            raise ValueError("Invalid coded dtype. Choose from 'int8', 'category', or None.")
+        self.coded = coded
+        self.float_dtype = float_dtype
+        self.coded_variables = CODED_VARIABLES if coded_variables is None else set(coded_variables)
+        self.id_columns = tuple(id_columns)
+        self.float64_prefixes = tuple(float64_prefixes)
+        self.float_tolerance = float_tolerance
+        self.verbose = verbose
+        self.last_report = None
+
+    @staticmethod
+    def _smallest_int(values):
+        finite = values[~np.isnan(values)]
+        if len(finite) and not np.array_equal(finite, np.round(finite)):
+            return None
+        low, high = (finite.min(), finite.max()) if len(finite) else (0, 0)
+        for dtype in ("Int8", "Int16", "Int32"):
+            info = np.iinfo(dtype.lower())
+            if info.min <= low and high <= info.max:
+                return dtype
+        return "Int64"
+
+    def _convert(self, col, series):
+        if not pd.api.types.is_numeric_dtype(series) or isinstance(series.dtype, pd.CategoricalDtype):
+            return series
+        values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+
+        if col in self.id_columns:
+            if np.isnan(values).any():
+                return series.astype("Int32")
+            return series.astype(np.int32)
+
+        if self.coded and base_variable(col) in self.coded_variables:
+            target = self._smallest_int(values)
+            if target is None:
+                return series
+            converted = series.astype(target)
+            return converted.astype("category") if self.coded == "category" else converted
+
+        if (self.float_dtype and pd.api.types.is_float_dtype(series)
+                and not str(col).startswith(self.float64_prefixes)):
+            narrowed = values.astype(self.float_dtype)
+            if np.allclose(narrowed, values, rtol=0, atol=self.float_tolerance, equal_nan=True):
+                return pd.Series(narrowed, index=series.index, name=series.name)
+
+        return series
+
+    def apply(self, df, inplace=False):
+        """
+        Returns df with every column converted according to the policy and
+        records the before/after memory usage in last_report.  With inplace the
+        converted columns replace those of the caller's frame.
+        """
+        before = frame_memory(df)
+        converted = {col: self._convert(col, df[col]) for col in df.columns}
+        if inplace:
+            for col, series in converted.items():
+                if series.dtype != df[col].dtype:
+                    df[col] = series
+        else:
+            df = pd.DataFrame(converted, index=df.index)
+        after = frame_memory(df)
+        self.last_report = {"before_bytes": before, "after_bytes": after}
+        if self.verbose:
+            debug(f"Downcast dtypes {before / 1024 ** 2:.2f} MB -> {after / 1024 ** 2:.2f} MB")
+        return df
@@ -0,0 +1,308 @@
+import bisect
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - not available on Windows
+    resource = None
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "OFF": 100}
+DEFAULT_LEVEL = "INFO"
+
+# Upper bounds (seconds) of the latency histogram buckets; the last bucket is unbounded.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_level = LEVELS.get(os.environ.get("NHANES_LOG_LEVEL", DEFAULT_LEVEL).upper(), LEVELS[DEFAULT_LEVEL])
+
+
+def set_level(name):
+    """
+    Sets the log level: "DEBUG", "INFO" (default, or NHANES_LOG_LEVEL),
+    "WARNING", "ERROR" or "OFF".
+    """
+    global _level
+    if name.upper() not in LEVELS:
+        raise ValueError(f"Invalid log level. Choose from {', '.join(LEVELS)}.")
+    _level = LEVELS[name.upper()]
+
+
+def enabled(level):
+    """
+    True when messages of level are printed; guard expensive debug-only work with it.
+    """
+    return LEVELS[level] >= _level
+
+
+def log(level, message):
+    if LEVELS[level] >= _level:
+        print(f"{level}: {message}")
+
+
+def debug(message):
+    log("DEBUG", message)
+
+
+def info(message):
+    log("INFO", message)
+
+
+def warning(message):
+    log("WARNING", message)
+
+
+def error(message):
+    log("ERROR", message)
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of the process so far in MB (None
+    where the resource module is unavailable).
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def frame_bytes(df):
+    """
+    Returns the shallow memory usage of a DataFrame in bytes: exact for
+    numeric columns and cheap enough to record on every span.
+    """
+    return int(df.memory_usage(index=False, deep=False).sum())
+
+
+class Histogram:
+    """
+    Fixed-bucket latency histogram with count, sum and max.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Returns the upper bound of the bucket holding the q-quantile (the
+        observed maximum for the unbounded bucket), or None when empty.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        cumulative, seen = {}, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            cumulative[f"{bound:g}"] = seen
+        cumulative["+Inf"] = self.count
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": cumulative,
+        }
+
+
+class Metrics:
+    """
+    Process-wide registry of latency histograms (per span and per endpoint),
+    cache hit / miss counters and per-span row and byte totals.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.latency = {}
+            self.caches = {}
+            self.totals = {}
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self.latency.get(name)
+            if histogram is None:
+                histogram = self.latency[name] = Histogram()
+            histogram.observe(seconds)
+
+    def cache(self, name, hit):
+        """
+        Counts a lookup in the named cache as a hit or a miss.
+        """
+        with self._lock:
+            counts = self.caches.setdefault(name, [0, 0])
+            counts[0 if hit else 1] += 1
+
+    def record_span(self, span):
+        self.observe(f"span.{span.name}", span.duration)
+        with self._lock:
+            totals = self.totals.setdefault(span.name, {"rows_in": 0, "rows_out": 0, "bytes": 0})
+            for field in totals:
+                value = getattr(span, field)
+                if value is not None:
+                    totals[field] += value
+
+    def snapshot(self):
+        """
+        Returns the metrics as a JSON-serializable dict: {"latency": {name:
+        histogram}, "caches": {name: {"hits", "misses", "hit_rate"}}, "spans":
+        {name: {"rows_in", "rows_out", "bytes"}}, "peak_rss_mb"}.
+        """
+        with self._lock:
+            latency = {name: histogram.snapshot() for name, histogram in sorted(self.latency.items())}
+            caches = {
+                name: {"hits": hits, "misses": misses,
+                       "hit_rate": hits / (hits + misses) if hits + misses else None}
+                for name, (hits, misses) in sorted(self.caches.items())
+            }
+            totals = {name: dict(values) for name, values in sorted(self.totals.items())}
+        return {"latency": latency, "caches": caches, "spans": totals, "peak_rss_mb": peak_rss_mb()}
+
+    def prometheus(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = ["# TYPE nhanes_latency_seconds histogram"]
+        for name, histogram in snapshot["latency"].items():
+            for bound, count in histogram["buckets"].items():
+                lines.append(f'nhanes_latency_seconds_bucket{{name="{name}",le="{bound}"}} {count}')
+            lines.append(f'nhanes_latency_seconds_sum{{name="{name}"}} {histogram["sum"]}')
+            lines.append(f'nhanes_latency_seconds_count{{name="{name}"}} {histogram["count"]}')
+        lines.append("# TYPE nhanes_cache_lookups_total counter")
+        for name, cache in snapshot["caches"].items():
+            lines.append(f'nhanes_cache_lookups_total{{cache="{name}",result="hit"}} {cache["hits"]}')
+            lines.append(f'nhanes_cache_lookups_total{{cache="{name}",result="miss"}} {cache["misses"]}')
+        lines.append("# TYPE nhanes_span_rows_total counter")
+        for name, totals in snapshot["spans"].items():
+            lines.append(f'nhanes_span_rows_total{{span="{name}",direction="in"}} {totals["rows_in"]}')
+            lines.append(f'nhanes_span_rows_total{{span="{name}",direction="out"}} {totals["rows_out"]}')
+        if snapshot["peak_rss_mb"] is not None:
+            lines.append("# TYPE nhanes_peak_rss_bytes gauge")
+            lines.append(f"nhanes_peak_rss_bytes {int(snapshot['peak_rss_mb'] * 1024 ** 2)}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class Span:
+    """
+    One timed pipeline stage.  Set rows_out and bytes (and rows_in when it
+    is only known inside the block) on the span before it ends.
+    """
+
+    __slots__ = ("name", "attrs", "rows_in", "rows_out", "bytes", "started", "duration", "peak_rss_mb")
+
+    def __init__(self, name, rows_in=None, attrs=None):
+        self.name = name
+        self.attrs = attrs or {}
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.bytes = None
+        self.started = time.perf_counter()
+        self.duration = None
+        self.peak_rss_mb = None
+
+    def as_dict(self):
+        return {"name": self.name, "duration_ms": self.duration * 1000, "rows_in": self.rows_in,
+                "rows_out": self.rows_out, "bytes": self.bytes, "peak_rss_mb": self.peak_rss_mb, **self.attrs}
+
+
+class Trace:
+    """
+    The spans recorded while handling one request.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def server_timing(self):
+        """
+        Returns a Server-Timing header value with the total duration of every
+        span name (e.g. 'download;dur=812.4;desc="8 spans", merge;dur=3.1').
+        """
+        with self._lock:
+            totals = {}
+            for span in self.spans:
+                duration, count = totals.get(span.name, (0.0, 0))
+                totals[span.name] = (duration + span.duration, count + 1)
+        entries = [f'{name};dur={duration * 1000:.1f}' + (f';desc="{count} spans"' if count > 1 else "")
+                   for name, (duration, count) in totals.items()]
+        entries.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(entries)
+
+
+_current_trace = contextvars.ContextVar("nhanes_trace", default=None)
+
+
+def start_trace():
+    """
+    Starts collecting spans into a new Trace for the current context and
+    returns (trace, token); pass token to end_trace.
+    """
+    trace = Trace()
+    return trace, _current_trace.set(trace)
+
+
+def end_trace(token):
+    _current_trace.reset(token)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name, rows_in=None, **attrs):
+    """
+    Times the enclosed block as a span: its duration feeds the span.<name>
+    latency histogram, its rows and bytes the per-span totals, and it is
+    added to the current request's trace.  Each span also records the peak
+    RSS of the process when it ends.
+    """
+    current = Span(name, rows_in, attrs)
+    try:
+        yield current
+    finally:
+        current.duration = time.perf_counter() - current.started
+        current.peak_rss_mb = peak_rss_mb()
+        metrics.record_span(current)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(current)
+        if _level <= LEVELS["DEBUG"]:
+            print(f"DEBUG: span {name} {current.duration * 1000:.1f} ms, rows {current.rows_in} -> "
+                  f"{current.rows_out}, bytes {current.bytes}, peak RSS {current.peak_rss_mb} MB {attrs or ''}")
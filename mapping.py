@@ -1,3 +1,6 @@
+from collections import namedtuple
+from instrumentation import warning
+
 # A dictionary mapping cycle years to file mappings for each category.
 
 FILE_MAPPING = {
@@ -184,6 +187,61 @@ FILE_MAPPING = {
 }
 
 
+NHANES_URL = "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/{year}/DataFiles/{code}.XPT"
+
+# Columns kept from each file, by category and file description (SEQN is always kept).
+# Files not listed here keep every column.
+FILE_COLUMNS = {
+    # Interview / MEC exam weights and the masked design variables (strata, PSU) for
+    # survey-weighted estimates; 1999-2000 and 2001-2002 also carry 4-year weights.
+    ("demographics", "Demographic Variables & Sample Weights"): [
+        "SEQN", "RIDAGEYR", "RIAGENDR", "RIDRETH1",
+        "WTINT2YR", "WTMEC2YR", "WTINT4YR", "WTMEC4YR", "SDMVPSU", "SDMVSTRA",
+    ],
+    ("examination", "Blood Pressure"): ["SEQN", "BPXSY1", "BPXDI1"],
+    ("examination", "Body Measures"): ["SEQN", "BMXWT", "BMXHT", "BMXBMI"],
+    ("examination", "Cardiovascular Fitness"): ["SEQN", "CVDESVO2", "CVDFITLV"],
+    ("laboratory", "Cholesterol - LDL & Triglycerides"): ["SEQN", "LBXTR", "LBDLDL"],
+    ("laboratory", "Plasma Fasting Glucose & Insulin"): ["SEQN", "LBXGLU", "LBXIN"],
+    ("questionnaire", "Alcohol Use"): ["SEQN", "ALQ100", "ALQ101", "ALQ130"],
+    ("questionnaire", "Diabetes"): ["SEQN", "DIQ010"],
+}
+
+FileSpec = namedtuple("FileSpec", ["cycle", "category", "file_desc", "code", "url", "columns"])
+
+
+def build_file_index(file_mapping=FILE_MAPPING, file_columns=FILE_COLUMNS):
+    """
+    Flattens FILE_MAPPING into a dict keyed by (cycle, category, file_desc) so
+    every lookup is a single O(1) access.
+    """
+    index = {}
+    for cycle, categories in file_mapping.items():
+        year = cycle.split("-")[0]
+        for category, files in categories.items():
+            for file_desc, code in files.items():
+                index[(cycle, category, file_desc)] = FileSpec(
+                    cycle=cycle,
+                    category=category,
+                    file_desc=file_desc,
+                    code=code,
+                    url=NHANES_URL.format(year=year, code=code),
+                    columns=file_columns.get((category, file_desc)),
+                )
+    return index
+
+
+FILE_INDEX = build_file_index()
+
+
+def resolve_file(cycle, category, file_desc):
+    """
+    Returns the FileSpec (file code, download URL and columns to keep) for a
+    cycle, category and file description, or None if the file is not mapped.
+    """
+    return FILE_INDEX.get((cycle, category.lower(), file_desc))
+
+
 def get_file_identifier(cycle, category, file_desc):
     """
     Returns the NHANES file identifier (e.g. 'DIQ_B') for a given cycle, category, and file description.
@@ -196,19 +254,9 @@ def get_file_identifier(cycle, category, file_desc):
     Returns:
         str or None: The short code for that file (like "DIQ_B") or None if not found.
     """
-    cycle_map = FILE_MAPPING.get(cycle)
-    if not cycle_map:
-        print(f"No file mapping for cycle '{cycle}'")
-        return None
-    
-    category_map = cycle_map.get(category)
-    if not category_map:
-        print(f"No file mapping for category '{category}' in cycle '{cycle}'")
+    spec = resolve_file(cycle, category, file_desc)
+    if not spec:
+        warning(f"No file mapping for file_desc '{file_desc}' in category '{category}', cycle '{cycle}'")
         return None
-    
-    short_code = category_map.get(file_desc)
-    if not short_code:
-        print(f"No file mapping for file_desc '{file_desc}' in category '{category}', cycle '{cycle}'")
-        return None
-    
-    return short_code
+
+    return spec.code
@@ -0,0 +1,69 @@
+import os
+import time
+from flask import Blueprint, Response, g, jsonify, request
+from instrumentation import end_trace, metrics, start_trace
+
+PROMETHEUS_MIME = "text/plain; version=0.0.4"
+
+
+def wants_timing(req):
+    """
+    True when the response should carry a Server-Timing header: requested
+    with ?timing=1 or an X-Timing: 1 header, or always with NHANES_TIMING_HEADER=1.
+    """
+    flag = req.args.get("timing") or req.headers.get("X-Timing") or os.environ.get("NHANES_TIMING_HEADER")
+    return flag is not None and flag.lower() in ("1", "true", "yes")
+
+
+def instrument_app(app):
+    """
+    Records the latency of every request under request.<route> and collects
+    the spans of its pipeline stages; when wants_timing, their totals are
+    returned in a Server-Timing header.  Also registers GET /metrics.
+
+    Streamed CSV bodies are encoded after the headers are sent, so their
+    serialize span appears in /metrics but not in the header.
+    """
+    @app.before_request
+    def begin_trace():
+        g.nhanes_trace, g.nhanes_trace_token = start_trace()
+
+    @app.after_request
+    def finish_trace(response):
+        trace = g.get("nhanes_trace")
+        if trace is None:
+            return response
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        if route != "/metrics":
+            metrics.observe(f"request.{route}", time.perf_counter() - trace.started)
+        if wants_timing(request):
+            response.headers["Server-Timing"] = trace.server_timing()
+        return response
+
+    @app.teardown_request
+    def drop_trace(exc):
+        token = g.pop("nhanes_trace_token", None)
+        if token is not None:
+            end_trace(token)
+
+    app.register_blueprint(metrics_blueprint())
+
+
+def metrics_blueprint():
+    """
+    Returns a Flask blueprint exposing GET /metrics: latency histograms of
+    requests and pipeline spans, cache hit rates, per-span row and byte
+    totals and the process peak RSS, as JSON (default) or in the Prometheus
+    text format (?format=prometheus or Accept: text/plain).
+    """
+    bp = Blueprint("metrics", __name__)
+
+    @bp.route('/metrics', methods=['GET'])
+    def get_metrics():
+        prometheus = request.args.get("format") == "prometheus" or \
+            request.accept_mimetypes.best_match(["application/json", "text/plain"]) == "text/plain"
+        if prometheus:
+            return Response(metrics.prometheus(), mimetype=PROMETHEUS_MIME)
+        return jsonify(metrics.snapshot())
+
+    return bp
@@ -1,47 +1,155 @@
 import pandas as pd
 import numpy as np
-from sklearn.impute import KNNImputer
-from sklearn.experimental import enable_iterative_imputer
-from sklearn.impute import IterativeImputer
+from dtype_policy import DtypePolicy
+from instrumentation import frame_bytes, span
+
+try:
+    from sklearn.impute import KNNImputer, SimpleImputer
+    from sklearn.experimental import enable_iterative_imputer
+    from sklearn.impute import IterativeImputer
+except ImportError:  # pragma: no cover - scikit-learn is only needed for impute_method
+    KNNImputer = SimpleImputer = IterativeImputer = None
+
+# Refused / don't know codes per NHANES variable.  Continuous measures such as
+# ages and lab values have no codes: a 7 or 99 there is a real value.
+DEFAULT_MISSING_CODES = {
+    "DIQ010": [7, 9],
+    "DIQ050": [7, 9],
+    "DIQ070": [7, 9],
+    "DIQ160": [7, 9],
+    "ALQ101": [7, 9],
+    "ALQ110": [7, 9],
+    "ALQ120Q": [777, 999],
+    "ALQ130": [777, 999],
+    "DMDEDUC2": [7, 9],
+    "DMDEDUC3": [77, 99],
+    "DMDMARTL": [77, 99],
+    "DMDCITZN": [7, 9],
+    "DMDBORN": [7, 9],
+    "INDHHINC": [77, 99],
+    "INDFMINC": [77, 99],
+    "INDHHIN2": [77, 99],
+    "INDFMIN2": [77, 99],
+}
 
 class NHANESDataCleaner:
-    def __init__(self, impute=False, impute_method="mean"):
+    def __init__(self, impute=False, impute_method="mean", missing_codes=None, default_codes=None, inplace=False,
+                 impute_scope=None, impute_features=None, batch_rows=5000, imputer=None, reuse_imputer=False,
+                 downcast=True, dtype_policy=None):
         """
         Initialize the NHANES data cleaner.
 
         Parameters:
         - impute (bool): Whether to perform imputation (True) or leave missing values as is (False).
         - impute_method (str): The method for imputation ("mean", "median", "mode", "knn", "mice").
+        - missing_codes (dict): Per-variable missing codes, e.g. {"DIQ010": [7, 9]}. Columns
+          suffixed with a cycle ("DIQ010_1999-2000") use the codes of their base variable.
+          Defaults to DEFAULT_MISSING_CODES.
+        - default_codes (list): Codes applied to numeric columns missing from the table
+          (None leaves them untouched).
+        - inplace (bool): Clean the caller's DataFrame directly instead of a copy.
+        - impute_scope (str): "column" imputes each column on its own; "frame" fits one
+          multivariate imputer over impute_features on each call.
+          Defaults to "frame" for "knn" and "mice" and "column" otherwise.
+        - impute_features (list): Numeric columns used by frame-level imputation
+          (default: every numeric column except SEQN).
+        - batch_rows (int): Rows transformed per block by frame-level imputation.
+        - imputer: An already fitted imputer to reuse for frame-level imputation.
+        - reuse_imputer (bool): Keep the imputer fitted on the first frame-level call
+          and reuse it on later calls instead of fitting each frame (implied by imputer).
+        - downcast (bool): Convert the cleaned frame to compact dtypes.
+        - dtype_policy (DtypePolicy): The conversion applied when downcasting
+          (default: DtypePolicy()).
         """
         self.impute = impute
         self.impute_method = impute_method
-        self.nhanes_missing_codes = {
-            "numeric": [".", 7, 77, 777, 9, 99, 999],  # NHANES missing codes for numbers
-            "categorical": ["", 7, 77, 777, 9, 99, 999]  # NHANES missing codes for text
-        }
+        self.missing_codes = DEFAULT_MISSING_CODES if missing_codes is None else missing_codes
+        self.default_codes = default_codes
+        self.inplace = inplace
+        if impute_scope is None:
+            impute_scope = "frame" if impute_method in ("knn", "mice") else "column"
+        self.impute_scope = impute_scope
+        self.impute_features = impute_features
+        self.batch_rows = batch_rows
+        if imputer is not None and impute_features is None:
+            raise ValueError("impute_features must be given together with a fitted imputer.")
+        self.imputer = imputer
+        self.reuse_imputer = reuse_imputer or imputer is not None
+        self.imputer_features = list(impute_features) if imputer is not None else None
+        self.dtype_policy = (dtype_policy or DtypePolicy()) if downcast else None
+
+    def codes_for(self, col):
+        """
+        Returns the missing codes for a column, looking up the base variable name
+        for cycle-suffixed columns.
+        """
+        if col in self.missing_codes:
+            return self.missing_codes[col]
+        base = str(col).split("_", 1)[0]
+        return self.missing_codes.get(base, self.default_codes)
 
-    def clean_data(self, df):
+    def clean_data(self, df, inplace=None):
         """
         Cleans the dataset based on the chosen option (leave as is or impute).
 
         Parameters:
         - df (DataFrame): The NHANES dataset
-        
+        - inplace (bool): Overrides the cleaner's inplace setting for this call.
+
         Returns:
         - DataFrame: Processed dataset
         """
-        df = df.copy()
+        inplace = self.inplace if inplace is None else inplace
+        with span("clean", rows_in=len(df), impute=self.impute) as stage:
+            if not inplace:
+                df = df.copy()
 
-        # Step 1: Convert NHANES missing codes to NaN
-        for col in df.columns:
-            if df[col].dtype in [np.float64, np.int64]:
-                df[col] = df[col].replace(self.nhanes_missing_codes["numeric"], np.nan)
-            else:
-                df[col] = df[col].replace(self.nhanes_missing_codes["categorical"], np.nan)
+            # Step 1: Convert NHANES missing codes to NaN
+            self.replace_missing_codes(df)
+
+            # Step 2: Apply imputation if selected
+            if self.impute:
+                df = self.impute_missing_values(df)
+
+            # Step 3: Downcast to compact dtypes now that missing codes are NaN
+            if self.dtype_policy is not None:
+                df = self.dtype_policy.apply(df, inplace=inplace)
+            stage.rows_out = len(df)
+            stage.bytes = frame_bytes(df)
+
+        return df
 
-        # Step 2: Apply imputation if selected
-        if self.impute:
-            df = self.impute_missing_values(df)
+    def replace_missing_codes(self, df):
+        """
+        Replaces missing codes with NaN across all numeric columns at once.
+
+        The numeric columns that have codes are viewed as one 2-D float array and
+        compared against a (columns x codes) table padded with NaN, so the work
+        is one vectorized comparison per code slot rather than per column.
+        Blank strings in text columns become NaN as well.
+        """
+        numeric_cols = df.select_dtypes(include="number").columns
+        coded = [(col, self.codes_for(col)) for col in numeric_cols]
+        coded = [(col, codes) for col, codes in coded if codes]
+
+        if coded:
+            cols = [col for col, _ in coded]
+            width = max(len(codes) for _, codes in coded)
+            code_table = np.full((len(cols), width), np.nan)
+            for i, (_, codes) in enumerate(coded):
+                code_table[i, :len(codes)] = codes
+
+            values = df[cols].to_numpy(dtype=np.float64, na_value=np.nan, copy=True)
+            mask = np.zeros(values.shape, dtype=bool)
+            for j in range(width):
+                mask |= values == code_table[:, j]
+            if mask.any():
+                values[mask] = np.nan
+                df[cols] = values
+
+        text_cols = df.columns.difference(numeric_cols)
+        if len(text_cols):
+            df[text_cols] = df[text_cols].replace({"": np.nan, b"": np.nan})
 
         return df
 
@@ -49,9 +157,12 @@ class NHANESDataCleaner:
         """
         Imputes missing values in the dataset.
         """
+        if self.impute_scope == "frame":
+            return self.impute_frame(df)
+
         for col in df.columns:
             if df[col].isnull().sum() > 0:  # Only process columns with missing values
-                if df[col].dtype in [np.float64, np.int64]:  # Numeric columns
+                if pd.api.types.is_numeric_dtype(df[col]):  # Numeric columns
                     df[col] = self.impute_numeric(df[col])
                 else:  # Categorical columns
                     df[col] = df[col].fillna(df[col].mode()[0])  # Mode imputation for categorical
@@ -68,6 +179,8 @@ class NHANESDataCleaner:
             return series.fillna(series.median())
         elif self.impute_method == "mode":
             return series.fillna(series.mode()[0])
+        elif self.impute_method in ("knn", "mice") and KNNImputer is None:
+            raise RuntimeError(f"{self.impute_method} imputation requires scikit-learn.")
         elif self.impute_method == "knn":
             imputer = KNNImputer(n_neighbors=5)
             return imputer.fit_transform(series.values.reshape(-1, 1)).flatten()
@@ -75,4 +188,77 @@ class NHANESDataCleaner:
             imputer = IterativeImputer(max_iter=10, random_state=0)
             return imputer.fit_transform(series.values.reshape(-1, 1)).flatten()
         else:
-            raise ValueError("Invalid imputation method. Choose from 'mean', 'median', 'mode', 'knn', or 'mice'.")
\ No newline at end of file
+            raise ValueError("Invalid imputation method. Choose from 'mean', 'median', 'mode', 'knn', or 'mice'.")
+
+    def make_imputer(self):
+        """
+        Creates an unfitted multivariate imputer for the selected method.
+        """
+        if SimpleImputer is None:
+            raise RuntimeError("Frame-level imputation requires scikit-learn.")
+        if self.impute_method == "mean":
+            return SimpleImputer(strategy="mean", keep_empty_features=True)
+        elif self.impute_method == "median":
+            return SimpleImputer(strategy="median", keep_empty_features=True)
+        elif self.impute_method == "mode":
+            return SimpleImputer(strategy="most_frequent", keep_empty_features=True)
+        elif self.impute_method == "knn":
+            return KNNImputer(n_neighbors=5, keep_empty_features=True)
+        elif self.impute_method == "mice":
+            return IterativeImputer(max_iter=10, random_state=0, keep_empty_features=True)
+        else:
+            raise ValueError("Invalid imputation method. Choose from 'mean', 'median', 'mode', 'knn', or 'mice'.")
+
+    def fit_imputer(self, df):
+        """
+        Fits one imputer over the feature columns of df and keeps it on the
+        cleaner, so later calls with reuse_imputer (e.g. later API requests)
+        reuse it without refitting.
+        """
+        self.imputer, self.imputer_features = self._fit(df)
+        return self.imputer
+
+    def _fit(self, df):
+        if self.impute_features is not None:
+            features = list(self.impute_features)
+        else:
+            features = [col for col in df.select_dtypes(include="number").columns if col != "SEQN"]
+
+        imputer = self.make_imputer()
+        imputer.fit(df[features].to_numpy(dtype=np.float64, na_value=np.nan, copy=True))
+        return imputer, features
+
+    def impute_frame(self, df, refit=False):
+        """
+        Imputes numeric features with a single multivariate fit, so each value
+        is filled using the other columns of the same participant.
+
+        Only rows with missing features are transformed, in blocks of
+        batch_rows rows to bound memory on large cohorts.  Non-numeric columns
+        are filled with their mode.  The imputer is fitted on df unless the
+        cleaner reuses one (reuse_imputer or imputer=); refit replaces it.
+        """
+        if not self.reuse_imputer:
+            imputer, features = self._fit(df)
+        else:
+            if self.imputer is None or refit:
+                self.fit_imputer(df)
+            imputer, features = self.imputer, self.imputer_features
+
+        missing = [col for col in features if col not in df.columns]
+        if missing:
+            raise ValueError(f"Columns required by the fitted imputer are missing: {missing}")
+
+        values = df[features].to_numpy(dtype=np.float64, na_value=np.nan, copy=True)
+        rows = np.flatnonzero(np.isnan(values).any(axis=1))
+        for start in range(0, len(rows), self.batch_rows):
+            block = rows[start:start + self.batch_rows]
+            values[block] = imputer.transform(values[block])
+        if len(rows):
+            df[features] = values
+
+        for col in df.columns.difference(features):
+            if df[col].isnull().any() and not pd.api.types.is_numeric_dtype(df[col]):
+                df[col] = df[col].fillna(df[col].mode()[0])
+
+        return df
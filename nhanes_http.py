@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+from collections import namedtuple
+import requests
+from requests.adapters import HTTPAdapter
+from instrumentation import error, warning
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+DownloadResult = namedtuple("DownloadResult", ["status", "etag", "last_modified", "status_code"])
+DownloadResult.__doc__ = """
+Outcome of a download: status is "downloaded", "not_modified" or "failed";
+etag and last_modified are the validators sent by the server.
+"""
+
+
+class DownloadClient:
+    """
+    Pooled HTTP client for CDC file downloads.
+
+    A single requests.Session keeps connections alive across downloads.  Each
+    download is streamed to a temporary file in chunks and atomically renamed
+    into place, retried with exponential backoff on connection errors and
+    transient status codes, and can be made conditional on the validators
+    (ETag / Last-Modified) of a previously downloaded copy.
+    """
+
+    def __init__(self, pool_size=16, retries=3, backoff=0.5, timeout=(10, 120), chunk_size=1024 * 1024):
+        """
+        Parameters:
+        - pool_size (int): Maximum number of kept-alive connections per host.
+        - retries (int): Retries after the first attempt.
+        - backoff (float): Base delay in seconds, doubled after every failed attempt.
+        - timeout (tuple): (connect, read) timeouts in seconds.
+        - chunk_size (int): Bytes written per chunk while streaming to disk.
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def download(self, url, dest_path, validators=None):
+        """
+        Downloads url to dest_path.
+
+        Parameters:
+        - url (str): The file URL.
+        - dest_path (str): Where the file is written (atomically, on success only).
+        - validators (dict): Optional {"etag": ..., "last_modified": ...} of a cached
+          copy; the request is then conditional and may return "not_modified".
+
+        Returns:
+        - DownloadResult
+        """
+        headers = {}
+        if validators:
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+
+        tmp_path = f"{dest_path}.{os.getpid()}.{threading.get_ident()}.part"
+        status_code = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                    status_code = response.status_code
+                    if status_code == 304:
+                        validators = validators or {}
+                        return DownloadResult("not_modified", validators.get("etag"), validators.get("last_modified"), 304)
+                    if status_code in RETRY_STATUSES:
+                        warning(f"{url} returned {status_code}, attempt {attempt + 1} of {self.retries + 1}")
+                        continue
+                    if status_code != 200:
+                        error(f"Failed to download {url}, Status Code: {status_code}")
+                        return DownloadResult("failed", None, None, status_code)
+
+                    with open(tmp_path, "wb") as f:
+                        for chunk in response.iter_content(chunk_size=self.chunk_size):
+                            f.write(chunk)
+                    os.replace(tmp_path, dest_path)
+                    return DownloadResult(
+                        "downloaded",
+                        response.headers.get("ETag"),
+                        response.headers.get("Last-Modified"),
+                        status_code,
+                    )
+            except requests.RequestException as e:
+                warning(f"Downloading {url} failed ({str(e)}), attempt {attempt + 1} of {self.retries + 1}")
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        error(f"Giving up on {url} after {self.retries + 1} attempts")
+        return DownloadResult("failed", None, None, status_code)
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Returns the shared DownloadClient, creating it on first use.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = DownloadClient()
+        return _client
@@ -1,84 +1,221 @@
+import contextvars
 import os
-import requests
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import numpy as np
 import pandas as pd
+from dtype_policy import DtypePolicy, frame_memory
+from instrumentation import debug, enabled, error, frame_bytes, span, warning
+from mapping import resolve_file
+from nhanes_http import get_client
+from xpt_cache import CacheMissError, get_cache, read_xpt
+
+def download_nhanes_file(cycle, file_desc, category, download_dir="nhanes_data", cache=None, client=None,
+                         chunksize=None, transform=None):
+    """
+    Retrieves one NHANES XPT file and returns the columns used by the profile builder.
 
-def download_nhanes_file(cycle, file_desc, category, download_dir="nhanes_data"):
-    print(f"DEBUG: Requested -> Cycle: {cycle}, Description: {file_desc}, Category: {category}")
+    The file code, URL and columns to keep are resolved from mapping.FILE_INDEX,
+    so any file listed in mapping.FILE_MAPPING can be fetched.
 
-    category = category.lower()
+    Downloaded files are kept in a persistent XPTCache (by default under
+    <download_dir>/xpt_cache), so repeated requests for the same cycle and file
+    are served from disk.  In offline mode only cached files are returned.
+    Downloads go through a pooled, retrying DownloadClient (the shared one from
+    nhanes_http.get_client() by default).
 
-    cycle_mapping = {
-        "1999-2000": "1999", "2001-2002": "2001", "2003-2004": "2003",
-        "2005-2006": "2005", "2007-2008": "2007", "2009-2010": "2009",
-        "2011-2012": "2011", "2013-2014": "2013", "2015-2016": "2015", "2017-2018": "2017"
-    }
-    cycle_single_year = cycle_mapping.get(cycle, None)
-    if not cycle_single_year:
-        print(f"ERROR: Cycle '{cycle}' not recognized in cycle_mapping!")
-        return None
+    With chunksize the file is streamed in chunks of that many rows and
+    transform(chunk) (cleaning, filters) is applied to each, so only the
+    surviving rows are ever assembled.
+    """
+    debug(f"Requested -> Cycle: {cycle}, Description: {file_desc}, Category: {category}")
 
-    nhanes_file_mapping = {
-        "demographics": {
-            "Demographic Variables & Sample Weights": {
-                "1999": "DEMO", "2001": "DEMO_B", "2003": "DEMO_C", "2005": "DEMO_D",
-                "2007": "DEMO_E", "2009": "DEMO_F", "2011": "DEMO_G", "2013": "DEMO_H",
-                "2015": "DEMO_I", "2017": "DEMO_J"
-            }
-        },
-        "questionnaire": {
-            "Diabetes": {
-                "1999": "DIQ", "2001": "DIQ_B", "2003": "DIQ_C", "2005": "DIQ_D",
-                "2007": "DIQ_E", "2009": "DIQ_F", "2011": "DIQ_G", "2013": "DIQ_H",
-                "2015": "DIQ_I", "2017": "DIQ_J"
-            }
-        }
-    }
-
-    file_name = nhanes_file_mapping.get(category, {}).get(file_desc, {}).get(cycle_single_year, None)
-    if not file_name:
-        print(f"ERROR: No file mapping found for category '{category}', description '{file_desc}', cycle '{cycle_single_year}'")
+    spec = resolve_file(cycle, category, file_desc)
+    if not spec:
+        error(f"No file mapping found for category '{category}', description '{file_desc}', cycle '{cycle}'")
         return None
 
-    url = f"https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/{cycle_single_year}/DataFiles/{file_name}.XPT"
-    print(f"DEBUG: Constructed URL -> {url}")
-
-    os.makedirs(download_dir, exist_ok=True)
-    xpt_path = os.path.join(download_dir, f"{file_name}.XPT")
+    file_name = spec.code
+    url = spec.url
+    debug(f"Constructed URL -> {url}")
 
-    if not os.path.exists(xpt_path):
-        print(f"DEBUG: Downloading file from {url}...")
-        response = requests.get(url)
-        if response.status_code != 200:
-            print(f"ERROR: Failed to download {file_name}.XPT, Status Code: {response.status_code}")
-            return None
-        with open(xpt_path, "wb") as f:
-            f.write(response.content)
+    if cache is None:
+        cache = get_cache(os.path.join(download_dir, "xpt_cache"))
 
-    try:
-        df = pd.read_sas(xpt_path, format='xport')
-        print(f"DEBUG: Successfully loaded {file_name}, Shape: {df.shape}")
+    if client is None:
+        client = get_client()
 
-        if category == "demographics" and file_desc == "Demographic Variables & Sample Weights":
-            required_columns = ["SEQN", "RIDAGEYR", "RIAGENDR", "RIDRETH1"]
-            df = df[required_columns]
+    def download(tmp_path, validators):
+        debug(f"Downloading file from {url}...")
+        return client.download(url, tmp_path, validators)
 
-        if category == "questionnaire" and file_desc == "Diabetes":
-            if "DIQ010" in df.columns:
-                df = df[["SEQN", "DIQ010"]]
-                df.rename(columns={"DIQ010": f"DIQ010_{cycle}"}, inplace=True)
-            else:
-                print(f"WARNING: 'DIQ010' not found in {file_name}, skipping.")
-                return None
+    try:
+        with span("download", cycle=cycle, file=file_name) as stage:
+            xpt_path = cache.fetch(cycle, file_name, download)
+            if xpt_path is not None:
+                stage.bytes = os.path.getsize(xpt_path)
+    except CacheMissError as e:
+        error(f"{e}")
+        return None
+    if xpt_path is None:
+        return None
 
-        os.remove(xpt_path)
-        print(f"DEBUG: Deleted {file_name}.XPT after processing")
+    try:
+        with span("parse", cycle=cycle, file=file_name) as stage:
+            df = read_xpt(xpt_path, columns=spec.columns, chunksize=chunksize, transform=transform)
+            stage.rows_out = len(df)
+            stage.bytes = frame_bytes(df)
+        # The first read writes a Parquet copy next to the cached file; count it towards the cache size.
+        cache.record_columnar(cycle, file_name)
+        if "SEQN" not in df.columns or len(df.columns) < 2:
+            warning(f"None of the columns {spec.columns} found in {file_name}, skipping.")
+            return None
+        debug(f"Successfully loaded {file_name}, Shape: {df.shape}")
 
         return df
     except Exception as e:
-        print(f"ERROR: Failed to read {file_name}: {str(e)}")
+        error(f"Failed to read {file_name}: {str(e)}")
         return None
 
 
+GENDER_CODES = {"Male": 1, "Female": 2}
+
+RACE_CODES = {
+    "Mexican American": 1,
+    "Other Hispanic": 2,
+    "Non-Hispanic White": 3,
+    "Non-Hispanic Black": 4,
+    "Other": 5
+}
+
+# Request filter names mapped to (column, label -> code table).
+FILTER_COLUMNS = {
+    "gender": ("RIAGENDR", GENDER_CODES),
+    "race": ("RIDRETH1", RACE_CODES),
+    "age": ("RIDAGEYR", None),
+    "age_range": ("RIDAGEYR", None),
+}
+
+
+def parse_range(spec):
+    """
+    Parses a range spec into inclusive (lower, upper) bounds, where None means
+    unbounded.  Accepts "20-29", "60+", "<20", "20" and {"min": 20, "max": 29}.
+    """
+    if isinstance(spec, dict):
+        return spec.get("min"), spec.get("max")
+    if isinstance(spec, (int, float)):
+        return spec, spec
+
+    text = str(spec).strip()
+    try:
+        if text.endswith("+"):
+            return float(text[:-1]), None
+        if text.startswith("<"):
+            return None, float(text[1:]) - 1
+        if "-" in text:
+            lower, upper = text.split("-", 1)
+            return float(lower), float(upper)
+        return float(text), float(text)
+    except ValueError:
+        raise ValueError(f"Unrecognized range '{spec}'")
+
+
+class CompiledFilter:
+    """
+    A request's filters compiled into per-column set and range clauses that are
+    evaluated together into one boolean mask, so filtering is a single pass
+    over the data and a single row selection.
+    """
+
+    def __init__(self, clauses):
+        """
+        Parameters:
+        - clauses (list): (column, kind, payload) tuples, where kind is "isin"
+          with a list of codes or "ranges" with a list of (lower, upper) bounds.
+        """
+        self.clauses = clauses
+
+    def __bool__(self):
+        return bool(self.clauses)
+
+    @property
+    def columns(self):
+        return [column for column, _, _ in self.clauses]
+
+    @staticmethod
+    def _numeric_values(series):
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            series = series.astype(series.cat.categories.dtype)
+        if pd.api.types.is_numeric_dtype(series):
+            return series.to_numpy(dtype="float64", na_value=float("nan"))
+        return pd.to_numeric(series, errors="coerce").to_numpy(dtype="float64", na_value=float("nan"))
+
+    def mask(self, df):
+        """
+        Returns a boolean NumPy mask of the rows that satisfy every clause.
+        Clauses on columns the frame does not have are skipped.
+        """
+        mask = np.ones(len(df), dtype=bool)
+        for column, kind, payload in self.clauses:
+            if column not in df.columns:
+                continue
+            values = self._numeric_values(df[column])
+            if kind == "isin":
+                mask &= np.isin(values, payload)
+            else:
+                in_any = np.zeros(len(df), dtype=bool)
+                for lower, upper in payload:
+                    in_range = np.ones(len(df), dtype=bool) if lower is None else values >= lower
+                    if upper is not None:
+                        in_range &= values <= upper
+                    in_any |= in_range
+                mask &= in_any
+        return mask
+
+    def apply(self, df):
+        if not self.clauses or df.empty:
+            return df
+        return df[self.mask(df)]
+
+
+def compile_filters(filters):
+    """
+    Compiles request filters into a CompiledFilter.
+
+    Filters:
+    - gender: "Male"/"Female" (or a list of them, or RIAGENDR codes)
+    - race: race/ethnicity label (or a list of them, or RIDRETH1 codes)
+    - age / age_range: a range such as "20-29", "60+" or {"min": 20, "max": 29},
+      or a list of ranges to select several age bins
+    - any other column name: a list of codes (set membership) or a range
+    """
+    clauses = []
+    for name, value in (filters or {}).items():
+        if value is None or value == "" or value == []:
+            continue
+
+        column, labels = FILTER_COLUMNS.get(name, (name, None))
+        values = value if isinstance(value, list) else [value]
+
+        if column == "RIDAGEYR" or isinstance(value, dict) or (
+                isinstance(value, str) and labels is None):
+            clauses.append((column, "ranges", [parse_range(v) for v in values]))
+            continue
+
+        codes = []
+        for v in values:
+            if labels is not None and v in labels:
+                codes.append(labels[v])
+            elif isinstance(v, (int, float)):
+                codes.append(v)
+            else:
+                raise ValueError(f"Unrecognized value '{v}' for filter '{name}'")
+        clauses.append((column, "isin", codes))
+
+    return CompiledFilter(clauses)
+
+
 def apply_filters(df, filters):
     """
     Apply filters to the demographic DataFrame.
@@ -86,118 +223,390 @@ def apply_filters(df, filters):
     Filters:
     - RIAGENDR: Gender (1 = Male, 2 = Female)
     - RIDRETH1: Race/Ethnicity (1 = Mexican American, etc.)
-    - RIDAGEYR: Age range (e.g., 20-29)
+    - RIDAGEYR: Age range (e.g., 20-29, 60+, or a list of ranges)
+
+    filters may be a dict as sent by the client or an already CompiledFilter.
+    The input frame is not modified.
     """
-    print(f"DEBUG: Applying filters -> {filters}")
+    debug(f"Applying filters -> {filters}")
 
     if isinstance(df, str):
-        print("ERROR: Received a string instead of a DataFrame!")
+        error("Received a string instead of a DataFrame!")
         return None
 
     if df.empty:
-        print("DEBUG: DataFrame is empty before applying filters.")
+        debug("DataFrame is empty before applying filters.")
         return df
 
-    if "gender" in filters and "RIAGENDR" in df.columns and filters["gender"]:
-        print("DEBUG: Applying gender filter")
-        df["RIAGENDR"] = pd.to_numeric(df["RIAGENDR"], errors="coerce")
-        gender_map = {"Male": 1, "Female": 2}
-        gender_codes = [gender_map[g] for g in filters["gender"]] if isinstance(filters["gender"], list) else [gender_map[filters["gender"]]]
-        df = df[df["RIAGENDR"].isin(gender_codes)]
-
-    if "race" in filters and "RIDRETH1" in df.columns and filters["race"]:
-        print("DEBUG: Applying race filter")
-        race_map = {
-            "Mexican American": 1,
-            "Other Hispanic": 2,
-            "Non-Hispanic White": 3,
-            "Non-Hispanic Black": 4,
-            "Other": 5
-        }
-        race_codes = [race_map[r] for r in filters["race"]] if isinstance(filters["race"], list) else [race_map[filters["race"]]]
-        df = df[df["RIDRETH1"].isin(race_codes)]
-
-    if "age" in filters and "RIDAGEYR" in df.columns and filters["age"]:
-        print("DEBUG: Applying age filter")
-        age_range = filters["age"]
-        df["RIDAGEYR"] = pd.to_numeric(df["RIDAGEYR"], errors="coerce")
-
-        if age_range == "10-15":
-            df = df[(df["RIDAGEYR"] >= 10) & (df["RIDAGEYR"] <= 15)]
-        elif age_range == "15-19":
-            df = df[(df["RIDAGEYR"] >= 15) & (df["RIDAGEYR"] <= 19)]
-        elif "-" in age_range:
-            bounds = age_range.split("-")
-            if len(bounds) == 2:
-                lower, upper = int(bounds[0]), int(bounds[1])
-                df = df[(df["RIDAGEYR"] >= lower) & (df["RIDAGEYR"] <= upper)]
-        elif age_range == "60+":
-            df = df[df["RIDAGEYR"] >= 60]
-        else:
-            print(f"WARNING: Unrecognized age range '{age_range}'")
-
-    print(f"DEBUG: DataFrame shape after filtering: {df.shape}")
+    compiled = filters if isinstance(filters, CompiledFilter) else compile_filters(filters)
+    with span("filter", rows_in=len(df)) as stage:
+        df = compiled.apply(df)
+        stage.rows_out = len(df)
+
+    debug(f"DataFrame shape after filtering: {df.shape}")
     return df
 
 
-class PatientProfileBuilder:
-    def __init__(self, download_function):
-        self.download_function = download_function
+def pivot_wide(df, id_column="SEQN", cycle_column="cycle"):
+    """
+    Pivots a long profile (one row per participant and cycle) into the wide
+    layout with one "<variable>_<cycle>" column per variable and cycle.
+
+    Parameters:
+    - df (DataFrame): Long frame with id_column, cycle_column and value columns.
 
-    def build_profile(self, selections, cycles):
-        print(f"DEBUG: build_profile called with selections={selections}, cycles={cycles}")
+    Returns:
+    - DataFrame: One row per id_column value.
+    """
+    values = df.set_index([id_column, df[cycle_column].astype(str)]).drop(columns=cycle_column)
+    wide = values.unstack(cycle_column)
+    wide.columns = [f"{variable}_{cycle}" for variable, cycle in wide.columns]
+    return wide.reset_index()
 
-        demo_dfs = []
-        questionnaire_dfs = []
 
-        for cycle in cycles:
-            if "demographics" in selections:
-                file_desc = selections["demographics"]["file"]
-                print(f"  Retrieving demographics '{file_desc}' for cycle {cycle}...")
-                df = self.download_function(cycle, file_desc, "demographics")
+def join_tables(tables, keys="SEQN", how="inner"):
+    """
+    Joins any number of per-category tables on their key columns in one pass.
+
+    Each table is indexed and sorted by the keys, the target key set is
+    computed once (the intersection of all tables for "inner", the first
+    table's keys for "left"), and every table is aligned to it and placed side
+    by side with a single column-wise concat, without intermediate merges.
+    Tables with duplicate keys cannot be index-aligned and fall back to
+    sequential merges.
+
+    Parameters:
+    - tables (list): DataFrames that all contain the key columns.
+    - keys (str or list): Join key column(s), e.g. "SEQN" or ["SEQN", "cycle"].
+    - how (str): "inner" or "left" (left keeps every row of the first table).
+
+    Returns:
+    - DataFrame: The key columns followed by every table's columns, in order.
+    """
+    if how not in ("inner", "left"):
+        raise ValueError("Invalid join. Choose from 'inner' or 'left'.")
+    if len(tables) == 1:
+        return tables[0]
+
+    indexed = [table.set_index(keys).sort_index() for table in tables]
+    if not all(table.index.is_unique for table in indexed):
+        warning("Duplicate join keys found, falling back to sequential merges.")
+        joined = tables[0]
+        for table in tables[1:]:
+            joined = pd.merge(joined, table, on=keys, how=how)
+        return joined
+
+    target = indexed[0].index
+    if how == "inner":
+        for table in indexed[1:]:
+            target = target.intersection(table.index, sort=False)
+        target = target.sort_values()
+
+    aligned = [table if table.index.equals(target) else table.reindex(target) for table in indexed]
+    return pd.concat(aligned, axis=1).reset_index()
+
+
+def selection_files(selection):
+    """
+    Returns the file descriptions of one category's selection, which may be a
+    single description, a list of them, or a dict with "file" or "files".
+    """
+    if isinstance(selection, dict):
+        selection = selection.get("files", selection.get("file"))
+    if selection is None:
+        return []
+    if isinstance(selection, str):
+        return [selection]
+    return list(selection)
 
+
+def check_build_request(selections, layout="long", join="inner"):
+    """
+    Raises ValueError when a build request names an unknown layout or join,
+    or carries demographic filters compile_filters rejects, so callers can
+    refuse it before anything is fetched.
+
+    Returns:
+    - CompiledFilter: The compiled demographic filters.
+    """
+    if not isinstance(selections, dict):
+        raise ValueError("selections must map categories to file descriptions.")
+    if layout not in ("long", "wide"):
+        raise ValueError("Invalid layout. Choose from 'long' or 'wide'.")
+    if join not in ("inner", "left"):
+        raise ValueError("Invalid join. Choose from 'inner' or 'left'.")
+    demographics = selections.get("demographics")
+    if isinstance(demographics, dict):
+        return compile_filters(demographics.get("filters") or {})
+    return CompiledFilter([])
+
+
+def plan_jobs(selections, cycles):
+    """
+    Expands the selections into one (cycle, category, file_desc) job per file
+    and cycle.  Demographics come first so later stages can rely on them.
+    """
+    categories = sorted(selections, key=lambda category: category != "demographics")
+    return [
+        (cycle, category, file_desc)
+        for category in categories
+        for file_desc in selection_files(selections[category])
+        for cycle in cycles
+    ]
+
+
+class PatientProfileBuilder:
+    def __init__(self, download_function, max_workers=8, timeout=None, downcast=True, dtype_policy=None,
+                 chunk_rows=None, cleaner=None, fragments=None):
+        """
+        Parameters:
+        - download_function (callable): Called as download_function(cycle, file_desc, category)
+          and expected to return a DataFrame or None.
+        - max_workers (int): Maximum number of files fetched and parsed concurrently.
+        - timeout (float): Seconds a single file may take once started before it is
+          abandoned and treated as missing (None waits indefinitely).
+        - downcast (bool): Convert every loaded file to compact dtypes.
+        - dtype_policy (DtypePolicy): The conversion applied when downcasting
+          (default: DtypePolicy()).
+        - chunk_rows (int): Stream every file in chunks of this many rows, cleaning
+          and filtering each chunk as it is read (default: NHANES_XPT_CHUNK_ROWS,
+          unset reads whole files).  download_function must then accept the
+          chunksize and transform keyword arguments, as download_nhanes_file does.
+        - cleaner (NHANESDataCleaner): Optional cleaner whose replace_missing_codes
+          runs on every file (per chunk when streaming) before filters apply.
+        - fragments (FragmentStore): Optional store of loaded per-file tables;
+          builds reuse the fragments it holds and only fetch the missing ones.
+        """
+        self.download_function = download_function
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.dtype_policy = (dtype_policy or DtypePolicy(verbose=False)) if downcast else None
+        if chunk_rows is None and os.environ.get("NHANES_XPT_CHUNK_ROWS"):
+            chunk_rows = int(os.environ["NHANES_XPT_CHUNK_ROWS"])
+        self.chunk_rows = chunk_rows
+        self.cleaner = cleaner
+        self.fragments = fragments
+
+    def _fetch_all(self, jobs, max_workers, timeout, prepare=None, progress=None, transform=None):
+        """
+        Runs every (cycle, category, file_desc) job on a bounded thread pool so that
+        network I/O of one file overlaps with XPT parsing of another.
+
+        prepare(job, df), if given, runs in the worker right after each file is
+        loaded, so per-file work such as filtering happens before results pile up.
+        progress(job, status), if given, is called with "done" or "failed" as
+        each job finishes.
+        transform(job), if given, returns the per-chunk transform passed to the
+        download function when the builder streams files (chunk_rows).
+
+        Returns a dict mapping each job to its DataFrame, or None when the job
+        failed or exceeded its timeout.
+        """
+        results = {}
+        started = {}
+
+        def run(job):
+            started[job] = time.monotonic()
+            cycle, category, file_desc = job
+            if self.chunk_rows:
+                df = self.download_function(cycle, file_desc, category, chunksize=self.chunk_rows,
+                                            transform=transform(job) if transform else None)
+            else:
+                df = self.download_function(cycle, file_desc, category)
+            if df is not None and prepare is not None:
+                df = prepare(job, df)
+            return df
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Each job runs in a copy of the caller's context so its spans join the caller's trace.
+        futures = {executor.submit(contextvars.copy_context().run, run, job): job for job in jobs}
+        pending = set(futures)
+        try:
+            while pending:
+                wait_for = None
+                if timeout is not None:
+                    now = time.monotonic()
+                    deadlines = [started[futures[f]] + timeout for f in pending if futures[f] in started]
+                    wait_for = max(0.0, min(deadlines) - now) if deadlines else timeout
+
+                done, pending = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = futures[future]
+                    try:
+                        results[job] = future.result()
+                    except Exception as e:
+                        error(f"Fetching {job} failed: {str(e)}")
+                        results[job] = None
+                    if progress is not None:
+                        progress(job, "failed" if results[job] is None else "done")
+
+                if timeout is not None:
+                    now = time.monotonic()
+                    for future in list(pending):
+                        job = futures[future]
+                        if job in started and now - started[job] >= timeout:
+                            warning(f"Fetching {job} timed out after {timeout}s, skipping.")
+                            future.cancel()
+                            pending.discard(future)
+                            results[job] = None
+                            if progress is not None:
+                                progress(job, "failed")
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        return results
+
+    def build_profile(self, selections, cycles, max_workers=None, timeout=None, layout="long", join="inner",
+                      progress=None, output_path=None):
+        """
+        Builds the merged patient profile for the selected files and cycles.
+
+        Parameters:
+        - selections (dict): Category -> file description, list of descriptions, or
+          {"file": description(s), "filters": {...}} (filters apply to demographics).
+        - cycles (list): Survey cycles such as "1999-2000".
+        - max_workers (int), timeout (float): Override the builder's fetch settings.
+        - layout (str): "long" returns one row per participant with a "cycle"
+          column and a single column per variable; "wide" pivots every
+          non-demographic variable into one "<variable>_<cycle>" column per cycle.
+        - join (str): "inner" keeps participants present in every selected file;
+          "left" keeps every participant of the first table (demographics when selected).
+        - progress (callable): Called as progress(job, status) for every
+          (cycle, category, file_desc) job: "queued" once planned, then "done"
+          or "failed" when its file has been fetched.
+        - output_path (str): Optional CSV path the merged profile is also written to.
+          Nothing is written by default, so concurrent builds never share a file.
+
+        Returns:
+        - DataFrame: The merged profile (empty when no data was retrieved).
+        """
+        debug(f"build_profile called with selections={selections}, cycles={cycles}")
+
+        max_workers = max_workers or self.max_workers
+        timeout = timeout if timeout is not None else self.timeout
+        # A repeated cycle is the same cycle (as in payload_key); it also cannot be a category twice.
+        cycles = list(dict.fromkeys(cycles))
+
+        # Check the options and compile the filters once up front so a bad request fails before any download.
+        filters = check_build_request(selections, layout, join)
+        demographics = selections.get("demographics")
+        filter_spec = (demographics.get("filters") or None) if isinstance(demographics, dict) else None
+
+        jobs = plan_jobs(selections, cycles)
+        if progress is not None:
+            for job in jobs:
+                progress(job, "queued")
+        loaded_bytes = []
+
+        def fragment_filters(job):
+            return filter_spec if job[1] == "demographics" else None
+
+        reused = {}
+        if self.fragments is not None:
+            for job in jobs:
+                df = self.fragments.get(job, fragment_filters(job))
                 if df is not None:
-                    demo_dfs.append(df)
-                else:
-                    print(f"  WARNING: No demographic data for cycle {cycle}.")
-
-        if demo_dfs:
-            print("DEBUG: Merging all demographic datasets before filtering...")
-            merged_demo_df = pd.concat(demo_dfs, ignore_index=True)
-
-            filters = selections["demographics"].get("filters", {})
-            merged_demo_df = apply_filters(merged_demo_df, filters)
-        else:
-            print("ERROR: No demographic data available after merging!")
-            return None
+                    reused[job] = df.assign(cycle=df["cycle"].cat.set_categories(cycles))
+            debug(f"Reusing {len(reused)} of {len(jobs)} files from stored fragments")
 
-        for cycle in cycles:
-            if "questionnaire" in selections:
-                file_desc = selections["questionnaire"]["file"]
-                print(f"  Retrieving questionnaire '{file_desc}' for cycle {cycle}...")
-                df = self.download_function(cycle, file_desc, "questionnaire")
+        def chunk_transform(job):
+            # Streamed files are cleaned and filtered chunk by chunk, so prepare only sees surviving rows.
+            chunk_filter = filters if job[1] == "demographics" and filters else None
+            if self.cleaner is None and chunk_filter is None:
+                return None
 
+            def transform(chunk):
+                if self.cleaner is not None:
+                    chunk = self.cleaner.replace_missing_codes(chunk)
+                return chunk_filter.apply(chunk) if chunk_filter is not None else chunk
+            return transform
+
+        def prepare(job, df):
+            if enabled("DEBUG"):
+                loaded_bytes.append(frame_memory(df))
+            if self.cleaner is not None and not self.chunk_rows:
+                with span("clean", rows_in=len(df)) as stage:
+                    df = self.cleaner.replace_missing_codes(df)
+                    stage.rows_out = len(df)
+            if self.dtype_policy is not None:
+                df = self.dtype_policy.apply(df)
+            # assign rather than insert: the downloaded frame may be shared with the caller's cache.
+            df = df.assign(cycle=pd.Categorical([job[0]] * len(df), categories=cycles))
+            df = df[[*df.columns[:1], "cycle", *df.columns[1:-1]]]
+            # Push the demographic filters down to each cycle as it loads.
+            if job[1] == "demographics" and filters and not self.chunk_rows:
+                return apply_filters(df, filters)
+            return df
+
+        missing = [job for job in jobs if job not in reused]
+        debug(f"Fetching {len(missing)} files with up to {max_workers} workers...")
+        fetched = self._fetch_all(missing, max_workers, timeout, prepare, progress, chunk_transform) if missing else {}
+        if self.fragments is not None:
+            for job, df in fetched.items():
                 if df is not None:
-                    questionnaire_dfs.append(df)
-                else:
-                    print(f"  WARNING: No questionnaire data for cycle {cycle}.")
-
-        if questionnaire_dfs:
-            print("DEBUG: Merging all questionnaire datasets...")
-            merged_questionnaire_df = pd.concat(questionnaire_dfs, ignore_index=True)
-        else:
-            print("WARNING: No questionnaire data found.")
-            merged_questionnaire_df = None
-
-        if merged_questionnaire_df is not None:
-            print("DEBUG: Merging filtered demographics with questionnaire data...")
-            final_profile = pd.merge(merged_demo_df, merged_questionnaire_df, on="SEQN", how="inner")
-        else:
-            print("DEBUG: No questionnaire data found. Using only demographics.")
-            final_profile = merged_demo_df
-
-        merged_csv_path = "nhanes_data/merged_profile.csv"
-        final_profile.to_csv(merged_csv_path, index=False)
-        print(f"DEBUG: Merged CSV saved at {merged_csv_path}")
+                    self.fragments.put(job, df, fragment_filters(job))
+        for job, df in reused.items():
+            fetched[job] = df
+            if progress is not None:
+                progress(job, "done")
+
+        # Group the loaded frames per (category, file), in plan order.
+        groups = {}
+        for cycle, category, file_desc in jobs:
+            df = fetched.pop((cycle, category, file_desc), None)
+            frames = groups.setdefault((category, file_desc), [])
+            if df is None:
+                warning(f"No {category} '{file_desc}' data for cycle {cycle}.")
+            else:
+                frames.append(df)
+
+        demo_frames = [frame for (category, _), frames in groups.items() if category == "demographics" for frame in frames]
+        if demographics is not None and not demo_frames:
+            error("No demographic data available after merging!")
+            return pd.DataFrame()
+
+        surviving_seqns = None
+        if demo_frames:
+            surviving_seqns = pd.unique(np.concatenate([df["SEQN"].to_numpy() for df in demo_frames]))
+
+        tables = []
+        for (category, file_desc), frames in groups.items():
+            if not frames:
+                continue
+            if surviving_seqns is not None and category != "demographics":
+                # Semi-join against the surviving SEQNs before concatenating: rows
+                # without one can never appear in the joined result (inner, or
+                # left on demographics), so they are never copied.
+                frames = [df[df["SEQN"].isin(surviving_seqns)] for df in frames]
+            debug(f"Concatenating {category} '{file_desc}' across {len(frames)} cycles...")
+            with span("concat", rows_in=sum(len(df) for df in frames), file=file_desc) as stage:
+                table = pd.concat(frames, ignore_index=True)
+                stage.rows_out = len(table)
+                stage.bytes = frame_bytes(table)
+            if layout == "wide" and category != "demographics":
+                table = pivot_wide(table)
+            elif layout == "wide":
+                table = table.drop(columns="cycle")
+            tables.append(table)
+
+        if not tables:
+            error("No data retrieved for the given selections and cycles.")
+            return pd.DataFrame()
+
+        keys = "SEQN" if layout == "wide" else ["SEQN", "cycle"]
+        debug(f"Joining {len(tables)} profile tables on SEQN ({join} join)...")
+        with span("merge", rows_in=sum(len(table) for table in tables), join=join) as stage:
+            final_profile = join_tables(tables, keys=keys, how=join)
+            stage.rows_out = len(final_profile)
+            stage.bytes = frame_bytes(final_profile)
+
+        if enabled("DEBUG"):
+            debug(f"Loaded files used {sum(loaded_bytes) / 1024 ** 2:.2f} MB as read; "
+                  f"final profile uses {frame_memory(final_profile) / 1024 ** 2:.2f} MB")
+
+        if output_path:
+            os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+            final_profile.to_csv(output_path, index=False)
+            debug(f"Merged CSV saved at {output_path}")
 
         return final_profile
@@ -0,0 +1,231 @@
+from flask import Flask, request, jsonify
+from cohort_cube import cube_from_env, cycle_version, parse_cohort_query, refresh_cube
+from instrumentation import error
+from metrics_api import instrument_app
+from nhanes_cleaner import NHANESDataCleaner
+from patient_profile_builder import PatientProfileBuilder, check_build_request, download_nhanes_file
+from profile_artifacts import artifact_id_for, create_artifact_store
+from profile_cache import cached_build, create_result_cache, payload_key
+from profile_fragments import create_fragment_store, plan_version, source_version
+from profile_jobs import JobManager, jobs_blueprint
+from profile_response import profile_response
+from response_encoding import payload_response
+from survey_stats import statistics_columns, statistics_payload
+from visualization import visualization_columns, visualization_payload
+from xpt_cache import get_cache
+from flask_cors import CORS
+
+
+class APIServices:
+    """
+    The caches, stores and builders behind the API, configured from the
+    environment.  Endpoints look them up on every request, so tests can
+    replace any of them on a running app.
+    """
+
+    def __init__(self):
+        # Cache of built profiles keyed by the normalized request payload (NHANES_RESULT_CACHE=memory|file|off).
+        # Entries are invalidated whenever one of the cached XPT files they were built from changes.
+        self.result_cache = create_result_cache()
+        self.source_cache = get_cache()
+        self.result_version = plan_version(self.source_cache)
+
+        # Loaded files are kept as fragments (NHANES_FRAGMENT_CACHE=memory|off), so adding a cycle or a
+        # category to an earlier request only fetches the new files, and a subset is assembled without fetching.
+        # Missing codes are cleaned as files load (chunk by chunk with NHANES_XPT_CHUNK_ROWS).
+        self.profile_builder = PatientProfileBuilder(
+            download_nhanes_file, cleaner=NHANESDataCleaner(),
+            fragments=create_fragment_store(source_version(self.source_cache)))
+
+        # Every built profile is kept under its own id (NHANES_ARTIFACT_STORE=arrow|file|memory) so concurrent
+        # requests never overwrite each other's output; /visualization reads it back by id.
+        self.artifact_store = create_artifact_store()
+
+        # Background builds for large selections: POST /jobs, then poll /jobs/<id> and fetch /jobs/<id>/result.
+        self.job_manager = JobManager(self.profile_builder, result_cache=self.result_cache,
+                                      version_function=self.result_version, artifact_store=self.artifact_store)
+
+        # Aggregate cube answering filtered cohort counts and means without scanning rows
+        # (NHANES_COHORT_CUBE=off disables it).  Cycles are added to it as they are first queried.
+        self.cohort_cube = cube_from_env()
+
+
+def create_app(services=None):
+    """
+    Creates the NHANES Profile API: /profile, /visualization, /statistics,
+    /cohort, the /jobs endpoints and /metrics.
+
+    Parameters:
+    - services (APIServices): The caches and builders to serve from (default:
+      a new APIServices() configured from the environment).
+
+    Returns:
+    - Flask: The app, with its services at app.extensions["nhanes"].
+    """
+    services = services if services is not None else APIServices()
+    app = Flask(__name__)
+    CORS(app, expose_headers=["X-Profile-Id", "Server-Timing"])
+    app.extensions["nhanes"] = services
+    app.register_blueprint(jobs_blueprint(services.job_manager))
+
+    # Per-stage spans and request latencies: GET /metrics, and a Server-Timing header with ?timing=1
+    # (or X-Timing: 1; NHANES_TIMING_HEADER=1 for every request).  NHANES_LOG_LEVEL sets the log level.
+    instrument_app(app)
+
+    @app.route('/', methods=['GET'])
+    def index():
+        return "NHANES Profile API is running!"
+
+    @app.route('/profile', methods=['POST'])
+    def profile():
+        """
+        Expects a JSON payload with:
+          - selections: a dictionary mapping categories to lists of file descriptions.
+          - cycles: a list of cycle years.
+          - layout (optional): "long" (default) for one row per participant with a
+            cycle column, or "wide" for one "<variable>_<cycle>" column per cycle.
+          - join (optional): "inner" (default) or "left" to keep every demographic row.
+
+        Returns:
+          The merged patient profile as a streamed CSV file (gzip-compressed when
+          requested with ?gzip=1 or Accept-Encoding: gzip); Accept: application/json
+          or application/vnd.apache.arrow.stream selects columnar JSON or Arrow IPC
+          instead.  The X-Profile-Id header
+          (also set as the profile_id cookie) names the stored profile for /visualization.
+        """
+        data = request.get_json()
+        selections = data.get("selections")
+        cycles = data.get("cycles")
+        layout = data.get("layout", "long")
+        join = data.get("join", "inner")
+
+        if not selections or not cycles:
+            return jsonify({'error': 'Please provide both "selections" and "cycles".'}), 400
+
+        try:
+            check_build_request(selections, layout, join)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        try:
+            hits = []
+            profile_df = cached_build(services.result_cache, services.profile_builder, selections, cycles,
+                                      services.result_version, on_hit=lambda key, version: hits.append((key, version)),
+                                      layout=layout, join=join)
+            if profile_df is None or profile_df.empty:
+                return jsonify({'error': 'No data found for the given selections and cycles.'}), 404
+
+            # Keep the profile for later visualization access.  Cached profiles are stored under an id derived
+            # from their cache key and source version, so a cache hit reuses the stored copy without writing it.
+            if hits:
+                profile_id = artifact_id_for(*hits[0])
+                if services.artifact_store.peek(profile_id) is None:
+                    profile_id = services.artifact_store.put(profile_df, profile_id)
+            elif services.result_cache is not None:
+                key = payload_key(selections, cycles, {"layout": layout, "join": join})
+                profile_id = services.artifact_store.put(
+                    profile_df, artifact_id_for(key, services.result_version(selections, cycles)))
+            else:
+                profile_id = services.artifact_store.put(profile_df)
+            response = profile_response(profile_df, request, download_name="patient_profile.csv")
+            if profile_id is not None:
+                response.headers["X-Profile-Id"] = profile_id
+                response.set_cookie("profile_id", profile_id, httponly=True, samesite="Lax")
+            return response
+        except Exception as e:
+            error(f"/profile failed: {str(e)}")
+            return jsonify({'error': str(e)}), 500
+
+    @app.route('/visualization', methods=['GET'])
+    def visualization():
+        """
+        Returns processed data for visualization as JSON.
+        It reads the profile named by ?profile_id= (the X-Profile-Id header of a
+        /profile response), falling back to the caller's profile_id cookie.
+
+        The payload is bounded regardless of cohort size: by default a capped
+        random sample of points; ?mode=histogram|grid|hex|stats returns binned
+        counts or per age band / cycle aggregates instead (see visualization_payload).
+        The Accept header selects strict JSON (default), Arrow IPC or typed arrays.
+        """
+        try:
+            profile_id = request.args.get("profile_id") or request.cookies.get("profile_id")
+            if not profile_id:
+                return jsonify({'error': 'No merged profile found. Please run analysis first.'}), 404
+
+            schema = services.artifact_store.peek(profile_id)
+            if schema is None:
+                return jsonify({'error': f'Profile {profile_id} not found or expired. Please run analysis again.'}), 404
+
+            try:
+                df = services.artifact_store.get(profile_id, columns=visualization_columns(schema, request.args))
+                if df is None:
+                    return jsonify({'error': f'Profile {profile_id} not found or expired. Please run analysis again.'}), 404
+                payload = visualization_payload(df, request.args)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            return payload_response(payload, request)
+
+        except Exception as e:
+            error(f"/visualization failed: {str(e)}")
+            return jsonify({'error': str(e)}), 500
+
+    @app.route('/statistics', methods=['GET'])
+    def statistics():
+        """
+        Returns survey-weighted means (?variables=) and proportions (?proportions=)
+        of a stored profile with Taylor-linearized standard errors, grouped by
+        ?by= (e.g. gender,age_band,cycle).  ?weight= selects the 2-year weight
+        (default WTMEC2YR), combined across the profile's cycles.
+        """
+        try:
+            profile_id = request.args.get("profile_id") or request.cookies.get("profile_id")
+            schema = services.artifact_store.peek(profile_id)
+            df = services.artifact_store.get(profile_id, columns=statistics_columns(schema, request.args)) \
+                if schema is not None else None
+            if df is None:
+                return jsonify({'error': 'No merged profile found. Please run analysis first.'}), 404
+
+            try:
+                payload = statistics_payload(df, request.args)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            return payload_response(payload, request)
+
+        except Exception as e:
+            error(f"/statistics failed: {str(e)}")
+            return jsonify({'error': str(e)}), 500
+
+    @app.route('/cohort', methods=['GET'])
+    def cohort():
+        """
+        Returns the number of participants and the mean of each cube metric for a
+        demographic filter, answered from the cohort cube.
+
+        Query parameters: cycles (required), gender, race, age_range (comma-separated
+        for several values) and metrics.  Cycles missing from the cube, or whose
+        source files changed, are built and added first.
+        """
+        cube = services.cohort_cube
+        if cube is None:
+            return jsonify({'error': 'The cohort cube is disabled.'}), 404
+        try:
+            try:
+                filters, cycles, metrics = parse_cohort_query(request.args)
+                # Built without holding the cube: it only locks while a cycle is added or saved.
+                version = cycle_version(cube, services.result_version)
+                if refresh_cube(cube, services.profile_builder, cycles, version):
+                    cube.save()
+                missing = cube.stale_cycles(cycles)
+                if missing:
+                    return jsonify({'error': f'No data found for cycles: {", ".join(missing)}.'}), 404
+                result = cube.query(filters, cycles, metrics)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            return payload_response(result, request)
+
+        except Exception as e:
+            error(f"/cohort failed: {str(e)}")
+            return jsonify({'error': str(e)}), 500
+
+    return app
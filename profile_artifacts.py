@@ -0,0 +1,130 @@
+import getpass
+import hashlib
+import os
+import re
+import tempfile
+import uuid
+from instrumentation import metrics, warning
+from profile_cache import ArrowResultCache, FileResultCache, MemoryResultCache
+
+try:
+    import pyarrow as pa
+except ImportError:  # pragma: no cover - pyarrow is optional
+    pa = None
+
+DEFAULT_TTL = 60 * 60  # seconds
+DEFAULT_MAX_BYTES = 1024 ** 3
+
+_ARTIFACT_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+def default_artifact_dir():
+    """
+    Returns the directory used for file-backed artifacts: a per-user tmpfs
+    directory under /dev/shm when available, otherwise under the system temp
+    directory.
+    """
+    base = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+    owner = os.getuid() if hasattr(os, "getuid") else getpass.getuser()
+    return os.path.join(base, f"nhanes_artifacts-{owner}")
+
+
+class ArtifactStore:
+    """
+    Per-request store of built profiles.
+
+    Every stored profile gets its own artifact id, so concurrent /profile calls
+    never share an output file and later requests (/visualization, job
+    results) read exactly the profile they refer to.  Storage, expiry and
+    size-based eviction are delegated to a result cache backend: a
+    MemoryResultCache for a single process, or an ArrowResultCache /
+    FileResultCache (by default on tmpfs) shared between threads and worker
+    processes.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def put(self, df, artifact_id=None):
+        """
+        Stores df and returns its artifact id, or None when the profile is too
+        large to keep.
+
+        Parameters:
+        - df (DataFrame): The profile to store.
+        - artifact_id (str): Store under this id (see artifact_id_for) instead of
+          a new random one.
+        """
+        if artifact_id is None:
+            artifact_id = uuid.uuid4().hex
+        if not self.backend.put(artifact_id, df):
+            warning(f"Profile of {len(df)} rows exceeds the artifact store limit and was not kept")
+            return None
+        return artifact_id
+
+    def get(self, artifact_id, columns=None):
+        """
+        Returns the profile stored under artifact_id (only the given columns,
+        when set), or None when the id is malformed, unknown or expired.
+        """
+        if not artifact_id or not _ARTIFACT_ID.match(artifact_id):
+            return None
+        df = self.backend.get(artifact_id, columns=columns)
+        metrics.cache("artifacts", df is not None)
+        return df
+
+    def peek(self, artifact_id):
+        """
+        Returns a zero-row frame with the columns and dtypes of the profile
+        stored under artifact_id, without loading its rows, or None.
+        """
+        if not artifact_id or not _ARTIFACT_ID.match(artifact_id):
+            return None
+        return self.backend.peek(artifact_id)
+
+    def clear(self):
+        self.backend.clear()
+
+
+def artifact_id_for(key, version=None):
+    """
+    Returns the artifact id of the profile built for a result cache key
+    (profile_cache.payload_key) from sources at version, so repeated requests
+    for an unchanged profile share one stored copy.
+    """
+    return hashlib.sha256(f"{key}:{version}".encode("utf-8")).hexdigest()[:32]
+
+
+def _artifact_dir():
+    return os.environ.get("NHANES_ARTIFACT_DIR") or default_artifact_dir()
+
+
+def create_artifact_store(backend=None):
+    """
+    Creates the artifact store selected by backend or the NHANES_ARTIFACT_STORE
+    environment variable, all but "memory" safe across gunicorn workers:
+
+    - "arrow" (default when pyarrow is installed): memory-mapped Arrow IPC files
+    - "file": pickled DataFrames, only when asked for explicitly
+    - "memory" (default without pyarrow): a single-process store
+
+    NHANES_ARTIFACT_TTL, NHANES_ARTIFACT_MAX_BYTES and NHANES_ARTIFACT_DIR
+    control expiry, total size and location; the directory must be private
+    to this user (see profile_cache.private_dir).
+    """
+    backend = (backend or os.environ.get("NHANES_ARTIFACT_STORE") or "").lower()
+    if not backend:
+        backend = "arrow" if pa is not None else "memory"
+        if pa is None:
+            warning("pyarrow is not installed, artifacts are kept in memory and not shared between workers")
+    ttl = float(os.environ.get("NHANES_ARTIFACT_TTL", DEFAULT_TTL))
+    max_bytes = int(os.environ.get("NHANES_ARTIFACT_MAX_BYTES", DEFAULT_MAX_BYTES))
+    if backend == "arrow":
+        if pa is None:
+            raise ValueError("The arrow artifact store requires pyarrow.")
+        return ArtifactStore(ArrowResultCache(_artifact_dir(), max_bytes=max_bytes, ttl=ttl))
+    if backend == "file":
+        return ArtifactStore(FileResultCache(_artifact_dir(), max_bytes=max_bytes, ttl=ttl))
+    if backend == "memory":
+        return ArtifactStore(MemoryResultCache(max_bytes=max_bytes, ttl=ttl))
+    raise ValueError("Invalid artifact store backend. Choose from 'arrow', 'file' or 'memory'.")
@@ -0,0 +1,391 @@
+import hashlib
+import json
+import os
+import stat
+import threading
+import time
+from collections import OrderedDict
+import pandas as pd
+from instrumentation import debug, metrics, warning
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:  # pragma: no cover - pyarrow is optional
+    pa = None
+    feather = None
+
+DEFAULT_TTL = 6 * 60 * 60  # seconds
+DEFAULT_MAX_BYTES = 512 * 1024 ** 2
+
+
+def _normalize(value):
+    """
+    Recursively normalizes a request payload so that equivalent payloads
+    serialize identically: dict keys are sorted by json.dumps, list order and
+    duplicates are ignored, and surrounding whitespace is stripped from strings.
+    """
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        items = {json.dumps(_normalize(v), sort_keys=True) for v in value}
+        return [json.loads(item) for item in sorted(items)]
+    if isinstance(value, str):
+        return value.strip()
+    return value
+
+
+def payload_key(selections, cycles, options=None):
+    """
+    Returns a canonical hash of a /profile payload, filters and build options
+    (such as the output layout) included.
+    """
+    canonical = json.dumps(
+        {"selections": _normalize(selections), "cycles": _normalize(cycles), "options": _normalize(options or {})},
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def private_dir(path):
+    """
+    Creates path with mode 0700 when missing and returns it.
+
+    The file backends load whatever is stored in their directory (pickles are
+    executed on load), so a directory that is a symlink, owned by another user
+    or writable by group or others is refused with a PermissionError.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    foreign = hasattr(os, "getuid") and info.st_uid != os.getuid()
+    if not stat.S_ISDIR(info.st_mode) or foreign or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(f"Refusing cache directory {path}: it must be a directory owned by this "
+                              "user and not writable by others.")
+    return path
+
+
+def _frame_bytes(df):
+    return int(df.memory_usage(deep=True).sum())
+
+
+def _project(df, columns):
+    return df if columns is None else df[list(columns)]
+
+
+class MemoryResultCache:
+    """
+    In-process LRU cache of built profiles with TTL and size-based eviction.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _entry(self, key, version):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry["created"] > self.ttl or entry["version"] != version:
+            self._remove(key)
+            return None
+        return entry
+
+    def get(self, key, version=None, columns=None):
+        with self._lock:
+            entry = self._entry(key, version)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return _project(entry["df"], columns)
+
+    def peek(self, key, version=None):
+        """
+        Returns a zero-row frame with the columns and dtypes of the entry, or None.
+        """
+        with self._lock:
+            entry = self._entry(key, version)
+            return None if entry is None else entry["df"].iloc[0:0]
+
+    def put(self, key, df, version=None):
+        """
+        Stores df under key and returns whether it was kept (frames larger than
+        max_bytes are not).
+        """
+        size = _frame_bytes(df)
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            now = time.time()
+            expired = [k for k, entry in self._entries.items() if now - entry["created"] > self.ttl]
+            for k in expired:
+                self._remove(k)
+            self._entries[key] = {"df": df, "version": version, "created": now, "size": size}
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+        return True
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry["size"]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+class FileResultCache:
+    """
+    Filesystem cache of built profiles, shared between worker processes.
+
+    Each entry is a pickled DataFrame (<key>.pkl) with a JSON sidecar
+    (<key>.json) recording its source version, creation and last access time.
+    Subclasses change the data format through suffix, _write_frame,
+    _read_frame and _read_schema.  The directory must be private to this
+    user (see private_dir).
+    """
+
+    suffix = ".pkl"
+
+    def __init__(self, cache_dir=os.path.join("nhanes_data", "result_cache"), max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        private_dir(cache_dir)
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return f"{base}{self.suffix}", f"{base}.json"
+
+    def _write_frame(self, df, path):
+        df.to_pickle(path)
+
+    def _read_frame(self, path, columns=None):
+        return _project(pd.read_pickle(path), columns)
+
+    def _read_schema(self, path):
+        return self._read_frame(path).iloc[0:0]
+
+    def _read_meta(self, meta_path):
+        try:
+            with open(meta_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, meta_path, meta):
+        tmp_path = f"{meta_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+    def _remove(self, key):
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _current_meta(self, key, version):
+        """
+        Returns the sidecar of a valid entry, removing it when it is expired or stale.
+        """
+        data_path, meta_path = self._paths(key)
+        meta = self._read_meta(meta_path)
+        if meta is None or not os.path.exists(data_path):
+            return None
+        if time.time() - meta["created"] > self.ttl or meta["version"] != version:
+            self._remove(key)
+            return None
+        return meta
+
+    def get(self, key, version=None, columns=None):
+        """
+        Returns the entry stored under key (only the given columns, when set),
+        or None when it is missing, expired or built from another version.
+        """
+        data_path, meta_path = self._paths(key)
+        with self._lock:
+            meta = self._current_meta(key, version)
+            if meta is None:
+                return None
+            try:
+                df = self._read_frame(data_path, columns)
+            except KeyError:
+                # An unknown column is the caller's error, not a damaged entry.
+                raise
+            except Exception as e:
+                warning(f"Dropping unreadable cached result {key}: {str(e)}")
+                self._remove(key)
+                return None
+            meta["last_access"] = time.time()
+            self._write_meta(meta_path, meta)
+            return df
+
+    def peek(self, key, version=None):
+        """
+        Returns a zero-row frame with the columns and dtypes of the entry, or None.
+        """
+        data_path, _ = self._paths(key)
+        with self._lock:
+            if self._current_meta(key, version) is None:
+                return None
+            try:
+                return self._read_schema(data_path)
+            except Exception as e:
+                warning(f"Dropping unreadable cached result {key}: {str(e)}")
+                self._remove(key)
+                return None
+
+    def put(self, key, df, version=None):
+        """
+        Stores df under key and returns whether it was kept (frames larger than
+        max_bytes are not).
+        """
+        data_path, meta_path = self._paths(key)
+        tmp_path = f"{data_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self._write_frame(df, tmp_path)
+        size = os.path.getsize(tmp_path)
+        if size > self.max_bytes:
+            os.remove(tmp_path)
+            return False
+        with self._lock:
+            os.replace(tmp_path, data_path)
+            now = time.time()
+            self._write_meta(meta_path, {"version": version, "created": now, "last_access": now, "size": size})
+            self._evict()
+        return True
+
+    def _evict(self):
+        """
+        Removes expired entries, then the least recently used ones until the
+        cache fits in max_bytes.
+        """
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".json"):
+                key = name[:-len(".json")]
+                meta = self._read_meta(os.path.join(self.cache_dir, name))
+                if meta is None:
+                    continue
+                if now - meta["created"] > self.ttl:
+                    self._remove(key)
+                else:
+                    entries.append((meta["last_access"], key, meta["size"]))
+        total = sum(size for _, _, size in entries)
+        for _, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(key)
+            total -= size
+
+    def clear(self):
+        with self._lock:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith((self.suffix, ".json")):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+
+class ArrowResultCache(FileResultCache):
+    """
+    FileResultCache storing every entry as an uncompressed Arrow IPC (Feather
+    v2) file that is read through a memory map.
+
+    Opening an entry only reads its schema and footer, whatever the number of
+    rows, and the requested columns are converted without parsing: numeric
+    columns without nulls become views of the mapped pages.  On tmpfs or the
+    page cache those pages are shared by every worker process reading the
+    same entry.
+    """
+
+    suffix = ".arrow"
+
+    def __init__(self, *args, **kwargs):
+        if pa is None:
+            raise RuntimeError("ArrowResultCache requires pyarrow.")
+        super().__init__(*args, **kwargs)
+
+    def _write_frame(self, df, path):
+        feather.write_feather(pa.Table.from_pandas(df, preserve_index=False), path, compression="uncompressed")
+
+    def _open(self, path):
+        return pa.ipc.open_file(pa.memory_map(path, "r"))
+
+    def _read_frame(self, path, columns=None):
+        reader = self._open(path)
+        table = reader.read_all()
+        if columns is not None:
+            table = table.select(list(columns))
+        return table.to_pandas(split_blocks=True)
+
+    def _read_schema(self, path):
+        return self._open(path).schema.empty_table().to_pandas()
+
+
+def create_result_cache(backend=None):
+    """
+    Creates the result cache selected by backend or the NHANES_RESULT_CACHE
+    environment variable: "memory" (default), "file", or "off" (returns None).
+    """
+    backend = (backend or os.environ.get("NHANES_RESULT_CACHE", "memory")).lower()
+    if backend == "off":
+        return None
+    ttl = float(os.environ.get("NHANES_RESULT_CACHE_TTL", DEFAULT_TTL))
+    max_bytes = int(os.environ.get("NHANES_RESULT_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+    if backend == "file":
+        cache_dir = os.environ.get("NHANES_RESULT_CACHE_DIR", os.path.join("nhanes_data", "result_cache"))
+        return FileResultCache(cache_dir, max_bytes=max_bytes, ttl=ttl)
+    if backend == "memory":
+        return MemoryResultCache(max_bytes=max_bytes, ttl=ttl)
+    raise ValueError("Invalid result cache backend. Choose from 'memory', 'file', or 'off'.")
+
+
+def cached_build(cache, builder, selections, cycles, version_function=None, progress=None, on_hit=None,
+                 **build_options):
+    """
+    Returns the profile for (selections, cycles), building it with
+    builder.build_profile only when no valid cached result exists.
+    build_options are passed on to build_profile and are part of the cache key;
+    progress is passed on as well but does not affect the key.
+
+    version_function(selections, cycles) returns a token describing the
+    source files the request reads (e.g. profile_fragments.plan_version); a
+    cached result is reused only while the token it was stored with is still
+    current.  on_hit(key, version) is called when the profile is served from
+    the cache.
+    """
+    if progress is not None:
+        build_options = dict(build_options)
+        key_options = dict(build_options)
+        build_options["progress"] = progress
+    else:
+        key_options = build_options
+
+    if cache is None:
+        return builder.build_profile(selections, cycles, **build_options)
+
+    key = payload_key(selections, cycles, key_options)
+    version = version_function(selections, cycles) if version_function else None
+    df = cache.get(key, version)
+    metrics.cache("results", df is not None)
+    if df is not None:
+        debug(f"Serving cached profile {key[:12]}")
+        if on_hit is not None:
+            on_hit(key, version)
+        return df
+
+    df = builder.build_profile(selections, cycles, **build_options)
+    if df is not None and not df.empty:
+        # Downloads made by this build change the source version, so store the result under the post-build version.
+        cache.put(key, df, version_function(selections, cycles) if version_function else None)
+    return df
@@ -0,0 +1,131 @@
+import hashlib
+import os
+import threading
+from instrumentation import metrics
+from mapping import resolve_file
+from patient_profile_builder import plan_jobs
+from profile_cache import DEFAULT_MAX_BYTES, DEFAULT_TTL, MemoryResultCache, payload_key
+
+
+def source_version(xpt_cache):
+    """
+    Returns a version_function for FragmentStore that tags every fragment with
+    the fingerprint of the one cached XPT file it was read from.
+    """
+    def version(cycle, category, file_desc):
+        spec = resolve_file(cycle, category, file_desc)
+        return xpt_cache.fingerprint(cycle, spec.code) if spec else None
+    return version
+
+
+def plan_version(xpt_cache):
+    """
+    Returns a version_function for cached_build: a digest of the fingerprints
+    of exactly the files a (selections, cycles) request reads, so downloads
+    made for other requests leave its cached profile valid.
+    """
+    file_version = source_version(xpt_cache)
+
+    def version(selections, cycles):
+        digest = hashlib.sha256()
+        for job in plan_jobs(selections, list(dict.fromkeys(cycles))):
+            digest.update(f"{job}={file_version(*job)}\n".encode("utf-8"))
+        return digest.hexdigest()
+    return version
+
+
+class FragmentStore:
+    """
+    Store of the per-file fragments profiles are assembled from.
+
+    A fragment is one (cycle, category, file_desc) table as the builder loads
+    it: cleaned, downcast, tagged with its cycle and, for demographics,
+    filtered.  Demographic fragments are keyed by their filters as well;
+    other fragments do not depend on them.  A build whose files and cycles
+    overlap an earlier one (one more cycle or category, or a subset of them)
+    takes the overlapping fragments from here and fetches only the rest;
+    joining is redone on every build, so the result is the same as a build
+    from scratch.
+
+    Fragments are kept in a result cache backend (a MemoryResultCache by
+    default) under the version of their source file, so a replaced download
+    is fetched again.
+    """
+
+    def __init__(self, backend=None, version_function=None):
+        """
+        Parameters:
+        - backend: Result cache holding the fragments (default: MemoryResultCache()).
+        - version_function (callable): Called as version_function(cycle, category,
+          file_desc); a fragment is reused only while it returns the value the
+          fragment was stored with.
+        """
+        self.backend = backend if backend is not None else MemoryResultCache()
+        self.version_function = version_function
+        self._manifest = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(job, filters=None):
+        cycle, category, file_desc = job
+        return payload_key({category: file_desc}, [cycle], {"filters": filters or {}})
+
+    def _version(self, job):
+        return self.version_function(*job) if self.version_function else None
+
+    def get(self, job, filters=None):
+        """
+        Returns the stored fragment of a (cycle, category, file_desc) job, or None.
+        """
+        df = self.backend.get(self.key(job, filters), self._version(job))
+        metrics.cache("fragments", df is not None)
+        return df
+
+    def put(self, job, df, filters=None):
+        """
+        Stores the fragment of a job and records it in the manifest.
+        """
+        key = self.key(job, filters)
+        if self.backend.put(key, df, self._version(job)):
+            cycle, category, file_desc = job
+            with self._lock:
+                self._manifest[key] = {"cycle": cycle, "category": category, "file": file_desc,
+                                       "filters": filters or {}, "rows": int(len(df))}
+
+    def manifest(self):
+        """
+        Returns the fragments currently stored, as a list of {"cycle",
+        "category", "file", "filters", "rows"} dicts.
+        """
+        with self._lock:
+            entries = list(self._manifest.items())
+        live = []
+        for key, entry in entries:
+            job = (entry["cycle"], entry["category"], entry["file"])
+            if self.backend.peek(key, self._version(job)) is None:
+                with self._lock:
+                    self._manifest.pop(key, None)
+            else:
+                live.append(dict(entry))
+        return live
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            self._manifest.clear()
+
+
+def create_fragment_store(version_function=None, backend=None):
+    """
+    Creates the fragment store selected by backend or the NHANES_FRAGMENT_CACHE
+    environment variable: "memory" (default) or "off" (returns None).
+    NHANES_FRAGMENT_CACHE_MAX_BYTES and NHANES_FRAGMENT_CACHE_TTL bound it.
+    """
+    backend = (backend or os.environ.get("NHANES_FRAGMENT_CACHE", "memory")).lower()
+    if backend == "off":
+        return None
+    if backend != "memory":
+        raise ValueError("Invalid fragment cache backend. Choose from 'memory' or 'off'.")
+    max_bytes = int(os.environ.get("NHANES_FRAGMENT_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+    ttl = float(os.environ.get("NHANES_FRAGMENT_CACHE_TTL", DEFAULT_TTL))
+    return FragmentStore(MemoryResultCache(max_bytes=max_bytes, ttl=ttl), version_function)
@@ -0,0 +1,253 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from flask import Blueprint, request, jsonify
+from instrumentation import debug, error
+from patient_profile_builder import check_build_request
+from profile_cache import cached_build, payload_key
+from profile_response import profile_response
+
+DEFAULT_JOB_WORKERS = 2
+DEFAULT_JOB_RETENTION = 60 * 60  # seconds a finished job stays available
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class ProfileJob:
+    """
+    A profile build submitted for background execution.
+
+    files maps every planned (cycle, category, file_desc) job of the build to
+    its status ("queued", "done" or "failed") and is filled in as the builder
+    reports progress.
+    """
+
+    def __init__(self, key, selections, cycles, options):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.selections = selections
+        self.cycles = cycles
+        self.options = options
+        self.status = QUEUED
+        self.files = {}
+        self.result = None
+        self.profile_id = None
+        self.version = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def update_file(self, job, status):
+        with self._lock:
+            self.files[job] = status
+
+    def progress(self):
+        """
+        Returns the per-file progress of the build as a JSON-serializable dict.
+        """
+        with self._lock:
+            files = [
+                {"cycle": cycle, "category": category, "file": file_desc, "status": status}
+                for (cycle, category, file_desc), status in self.files.items()
+            ]
+        completed = sum(1 for f in files if f["status"] != QUEUED)
+        return {"total": len(files), "completed": completed, "files": files}
+
+    def summary(self):
+        progress = self.progress()
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "profile_id": self.profile_id,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "files_total": progress["total"],
+            "files_completed": progress["completed"],
+        }
+
+
+class JobManager:
+    """
+    Runs profile builds on a background worker pool.
+
+    Submissions are keyed like the result cache (normalized payload plus build
+    options), so a request identical to one that is queued, running or still
+    retained after finishing successfully is attached to that job instead of
+    starting a second build.  A finished job whose stored profile has expired
+    or whose source files changed since it ran is replaced by a new build.
+
+    Jobs are kept in the memory of the process that accepted them, so the
+    /jobs endpoints must be served by a single worker process.
+    """
+
+    def __init__(self, builder, max_workers=None, result_cache=None, version_function=None, retention=None,
+                 artifact_store=None):
+        """
+        Parameters:
+        - builder (PatientProfileBuilder): Builder whose build_profile runs the jobs.
+        - max_workers (int): Concurrent builds (default: NHANES_JOB_WORKERS or 2).
+        - result_cache: Optional result cache shared with /profile.
+        - version_function (callable): Source version token for the result cache,
+          called as version_function(selections, cycles).
+        - retention (float): Seconds finished jobs are kept (default: NHANES_JOB_RETENTION or 3600).
+        - artifact_store (ArtifactStore): Where finished profiles are kept; without
+          one they stay in memory on the job.
+        """
+        if max_workers is None:
+            max_workers = int(os.environ.get("NHANES_JOB_WORKERS", DEFAULT_JOB_WORKERS))
+        if retention is None:
+            retention = float(os.environ.get("NHANES_JOB_RETENTION", DEFAULT_JOB_RETENTION))
+        self.builder = builder
+        self.result_cache = result_cache
+        self.version_function = version_function
+        self.retention = retention
+        self.artifact_store = artifact_store
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="profile-job")
+        self._jobs = {}
+        self._by_key = {}
+        self._lock = threading.Lock()
+
+    def submit(self, selections, cycles, **options):
+        """
+        Queues a build of (selections, cycles) and returns its ProfileJob, or
+        the existing job for an identical submission.
+        """
+        key = payload_key(selections, cycles, options)
+        with self._lock:
+            self._prune()
+            existing = self._jobs.get(self._by_key.get(key))
+            if existing is not None and existing.status == DONE and self._is_stale(existing):
+                debug(f"Job {existing.id} is out of date, building again")
+                existing = None
+            if existing is not None and existing.status != FAILED:
+                debug(f"Attaching submission to existing job {existing.id}")
+                return existing
+            job = ProfileJob(key, selections, cycles, options)
+            self._jobs[job.id] = job
+            self._by_key[key] = job.id
+        self._executor.submit(self._run, job)
+        debug(f"Queued profile job {job.id}")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _is_stale(self, job):
+        """
+        Returns True when a finished job can no longer be served as is: its
+        stored profile expired, or the source version changed since it ran.
+        """
+        if job.profile_id is not None and self.artifact_store.peek(job.profile_id) is None:
+            return True
+        if self.version_function is not None:
+            return self.version_function(job.selections, job.cycles) != job.version
+        return False
+
+    def _run(self, job):
+        job.status = RUNNING
+        job.started = time.time()
+        try:
+            result = cached_build(self.result_cache, self.builder, job.selections, job.cycles,
+                                  self.version_function, progress=job.update_file, **job.options)
+            if self.artifact_store is not None and result is not None and not result.empty:
+                job.profile_id = self.artifact_store.put(result)
+            if job.profile_id is None:
+                job.result = result
+            if self.version_function is not None:
+                job.version = self.version_function(job.selections, job.cycles)
+            job.status = DONE
+        except Exception as e:
+            error(f"Profile job {job.id} failed: {str(e)}")
+            job.error = str(e)
+            job.status = FAILED
+        finally:
+            job.finished = time.time()
+
+    def _prune(self):
+        cutoff = time.time() - self.retention
+        expired = [job_id for job_id, job in self._jobs.items() if job.finished is not None and job.finished < cutoff]
+        for job_id in expired:
+            job = self._jobs.pop(job_id)
+            if self._by_key.get(job.key) == job_id:
+                del self._by_key[job.key]
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+def jobs_blueprint(manager):
+    """
+    Returns a Flask blueprint exposing manager under /jobs:
+
+      POST /jobs                 submit a /profile payload, returns 202 with the job id
+      GET  /jobs/<id>            job status
+      GET  /jobs/<id>/progress   per-file completion
+      GET  /jobs/<id>/result     the finished profile (streamed CSV, or as negotiated by Accept)
+    """
+    bp = Blueprint("jobs", __name__)
+
+    def _lookup(job_id):
+        job = manager.get(job_id)
+        if job is None:
+            return None, (jsonify({'error': f'Unknown job {job_id}.'}), 404)
+        return job, None
+
+    @bp.route('/jobs', methods=['POST'])
+    def submit_job():
+        data = request.get_json(silent=True) or {}
+        selections = data.get("selections")
+        cycles = data.get("cycles")
+        if not selections or not cycles:
+            return jsonify({'error': 'Please provide both "selections" and "cycles".'}), 400
+        layout, join = data.get("layout", "long"), data.get("join", "inner")
+        try:
+            check_build_request(selections, layout, join)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        job = manager.submit(selections, cycles, layout=layout, join=join)
+        return jsonify({'job_id': job.id, 'status': job.status}), 202
+
+    @bp.route('/jobs/<job_id>', methods=['GET'])
+    def job_status(job_id):
+        job, error = _lookup(job_id)
+        if error:
+            return error
+        return jsonify(job.summary())
+
+    @bp.route('/jobs/<job_id>/progress', methods=['GET'])
+    def job_progress(job_id):
+        job, error = _lookup(job_id)
+        if error:
+            return error
+        return jsonify(dict(job.progress(), job_id=job.id, status=job.status))
+
+    @bp.route('/jobs/<job_id>/result', methods=['GET'])
+    def job_result(job_id):
+        job, error = _lookup(job_id)
+        if error:
+            return error
+        if job.status == FAILED:
+            return jsonify({'error': job.error, 'status': job.status}), 500
+        if job.status != DONE:
+            return jsonify({'error': 'Job has not finished yet.', 'status': job.status}), 409
+        result = job.result
+        if job.profile_id is not None:
+            result = manager.artifact_store.get(job.profile_id)
+            if result is None:
+                return jsonify({'error': 'The job result has expired.'}), 410
+        if result is None or result.empty:
+            return jsonify({'error': 'No data found for the given selections and cycles.'}), 404
+        response = profile_response(result, request, download_name="patient_profile.csv")
+        if job.profile_id is not None:
+            response.headers["X-Profile-Id"] = job.profile_id
+        return response
+
+    return bp
@@ -0,0 +1,86 @@
+import zlib
+from flask import Response
+from instrumentation import span
+from response_encoding import ARROW_MIME, JSON_MIME, frame_to_arrow, frame_to_json, negotiate
+
+DEFAULT_CHUNK_ROWS = 5000
+
+
+def iter_csv_chunks(df, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Yields the DataFrame as CSV text, header first and then one block of
+    chunk_rows rows at a time, so only one block is ever encoded in memory.
+    """
+    yield df.iloc[0:0].to_csv(index=False)
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows].to_csv(index=False, header=False)
+
+
+def stream_csv(df, chunk_rows=DEFAULT_CHUNK_ROWS, compress=False):
+    """
+    Generator of encoded CSV bytes for a streaming response.
+
+    Parameters:
+    - df (DataFrame): The merged patient profile.
+    - chunk_rows (int): Number of rows encoded per chunk.
+    - compress (bool): Gzip the stream.
+    """
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    with span("serialize", len(df), format="csv") as current:
+        current.bytes = 0
+        for text in iter_csv_chunks(df, chunk_rows):
+            data = text.encode("utf-8")
+            if compressor is not None:
+                data = compressor.compress(data)
+            if data:
+                current.bytes += len(data)
+                yield data
+        if compressor is not None:
+            data = compressor.flush()
+            current.bytes += len(data)
+            yield data
+        current.rows_out = len(df)
+
+
+def wants_gzip(req):
+    """
+    True when the client asked for a gzip-compressed body, either with
+    ?gzip=1 or an Accept-Encoding header that lists gzip.
+    """
+    flag = req.args.get("gzip")
+    if flag is not None:
+        return flag.lower() in ("1", "true", "yes")
+    return "gzip" in req.headers.get("Accept-Encoding", "")
+
+
+def csv_response(df, req, download_name="patient_profile.csv"):
+    """
+    Builds a chunked streaming CSV attachment response for the profile DataFrame.
+    """
+    compress = wants_gzip(req)
+    response = Response(
+        stream_csv(df, compress=compress),
+        mimetype="text/csv",
+    )
+    response.headers["Content-Disposition"] = f"attachment; filename={download_name}"
+    if compress:
+        response.headers["Content-Encoding"] = "gzip"
+        response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
+def profile_response(df, req, download_name="patient_profile.csv"):
+    """
+    Builds the response for a profile DataFrame in the encoding negotiated from
+    the Accept header: a streamed CSV attachment (default), an Arrow IPC
+    stream, or columnar JSON with missing values as null.
+    """
+    mimetype = negotiate(req, ["text/csv", ARROW_MIME, JSON_MIME])
+    if mimetype == "text/csv":
+        return csv_response(df, req, download_name=download_name)
+    with span("serialize", len(df), format=mimetype) as current:
+        body = frame_to_arrow(df) if mimetype == ARROW_MIME else frame_to_json(df)
+        current.rows_out, current.bytes = len(df), len(body)
+    response = Response(body, mimetype=mimetype)
+    response.vary.add("Accept")
+    return response
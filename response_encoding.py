@@ -0,0 +1,211 @@
+import json
+import struct
+import numpy as np
+import pandas as pd
+from flask import Response
+from instrumentation import span
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+try:
+    import pyarrow as pa
+except ImportError:  # pragma: no cover - pyarrow is optional
+    pa = None
+
+JSON_MIME = "application/json"
+ARROW_MIME = "application/vnd.apache.arrow.stream"
+TYPED_ARRAYS_MIME = "application/x-nhanes-typed-arrays"
+
+_ALIGNMENT = 8
+
+
+def jsonable(value):
+    """
+    Returns value with NumPy arrays and scalars converted to plain Python and
+    every NaN / infinity replaced by None, so the result is strict JSON.
+    """
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind == "f":
+            converted = value.astype(object)
+            converted[~np.isfinite(value)] = None
+            return converted.tolist()
+        return jsonable(value.tolist()) if value.dtype.kind == "O" else value.tolist()
+    if isinstance(value, dict):
+        return {k: jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [jsonable(v) for v in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    if value is pd.NA or value is pd.NaT:
+        return None
+    return value
+
+
+def encode_json(payload):
+    """
+    Encodes payload as strict JSON bytes (NaN -> null), using orjson's native
+    NumPy support when it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY, default=jsonable)
+    return json.dumps(jsonable(payload), allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def _is_column(value):
+    if isinstance(value, np.ndarray):
+        return value.ndim == 1
+    return (isinstance(value, list) and len(value) > 0
+            and all(v is None or isinstance(v, (int, float, str)) for v in value))
+
+
+def split_columns(payload):
+    """
+    Splits a payload dict into 1-D columns (arrays, flat lists, and lists of
+    records expanded into one column per field) and the remaining metadata.
+
+    Returns:
+    - (dict, dict): name -> ndarray columns, and the JSON-serializable metadata.
+    """
+    columns, meta = {}, {}
+    for name, value in payload.items():
+        if isinstance(value, list) and value and all(isinstance(v, dict) for v in value):
+            for field, series in pd.DataFrame(value).items():
+                columns[f"{name}.{field}"] = series.to_numpy()
+        elif _is_column(value):
+            columns[name] = np.asarray(value)
+        else:
+            meta[name] = value
+    return columns, meta
+
+
+def _column_array(values):
+    """
+    Returns values as a float64 / int64 array (missing values as NaN), or as
+    an object array of strings and None when it is not numeric.
+    """
+    if values.dtype.kind in "iub":
+        return values.astype(np.int64)
+    if values.dtype.kind == "f":
+        return values.astype(np.float64)
+    numeric = pd.to_numeric(pd.Series(values), errors="coerce")
+    present = pd.notna(pd.Series(values))
+    if (numeric.notna() == present).all():
+        return numeric.to_numpy(dtype=np.float64, na_value=np.nan)
+    return np.array([None if v is None or v is pd.NA else str(v) for v in values], dtype=object)
+
+
+def encode_typed_arrays(payload):
+    """
+    Encodes payload in the binary typed-array format:
+
+      uint32 (little endian)  length N of the header
+      N bytes                 UTF-8 JSON header, padded with spaces to a multiple of 8
+      buffers                 one little-endian buffer per numeric column, 8-byte aligned
+
+    The header is {"meta": {...}, "columns": [{"name", "dtype", "offset",
+    "length"} | {"name", "dtype": "string", "values"}]} with offsets relative to
+    the first buffer.  float64 columns carry missing values as NaN and map
+    directly onto a JavaScript Float64Array; int64 columns onto BigInt64Array.
+    """
+    columns, meta = split_columns(payload)
+    descriptors, buffers, offset = [], [], 0
+    for name, values in columns.items():
+        array = _column_array(values)
+        if array.dtype == object:
+            descriptors.append({"name": name, "dtype": "string", "values": array.tolist()})
+            continue
+        data = array.astype(array.dtype.newbyteorder("<"), copy=False).tobytes()
+        descriptors.append({"name": name, "dtype": str(array.dtype), "offset": offset, "length": len(array)})
+        padding = -len(data) % _ALIGNMENT
+        buffers.append(data + b"\0" * padding)
+        offset += len(data) + padding
+
+    header = encode_json({"meta": meta, "columns": descriptors})
+    # 4 length bytes + header must end on an 8-byte boundary so buffers stay aligned.
+    header += b" " * (-(len(header) + 4) % _ALIGNMENT)
+    return struct.pack("<I", len(header)) + header + b"".join(buffers)
+
+
+def _arrow_bytes(table):
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def encode_arrow(payload):
+    """
+    Encodes payload as an Arrow IPC stream.  Columns of equal length form a
+    regular table; otherwise every column becomes a one-row list column.  The
+    remaining metadata is stored as JSON under the "nhanes" schema metadata key.
+    """
+    columns, meta = split_columns(payload)
+    arrays = {}
+    for name, values in columns.items():
+        array = _column_array(values)
+        if array.dtype.kind == "f":
+            arrays[name] = pa.array(array, from_pandas=True)
+        else:
+            arrays[name] = pa.array(array.tolist() if array.dtype == object else array)
+    if len({len(a) for a in arrays.values()}) > 1:
+        arrays = {name: pa.array([a.to_pylist()], type=pa.list_(a.type)) for name, a in arrays.items()}
+    table = pa.table(arrays) if arrays else pa.table({})
+    table = table.replace_schema_metadata({"nhanes": encode_json(meta)})
+    return _arrow_bytes(table)
+
+
+def frame_to_arrow(df):
+    """
+    Encodes a DataFrame as an Arrow IPC stream (missing values as nulls).
+    """
+    return _arrow_bytes(pa.Table.from_pandas(df, preserve_index=False))
+
+
+def frame_to_json(df):
+    """
+    Encodes a DataFrame as columnar strict JSON: {"columns": [...], "data": {column: [values]}}.
+    """
+    data = {}
+    for col, series in df.items():
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            series = series.astype(object)
+        if pd.api.types.is_numeric_dtype(series):
+            data[str(col)] = series.to_numpy(dtype=np.float64, na_value=np.nan) \
+                if series.hasnans or pd.api.types.is_float_dtype(series) else series.to_numpy()
+        else:
+            data[str(col)] = series.astype(object).where(series.notna(), None).to_numpy()
+    return encode_json({"columns": [str(c) for c in df.columns], "data": data})
+
+
+def negotiate(req, offers):
+    """
+    Returns the offered mimetype that best matches the request's Accept
+    header, defaulting to the first offer.  Arrow is only offered when
+    pyarrow is installed.
+    """
+    offers = [mime for mime in offers if mime != ARROW_MIME or pa is not None]
+    return req.accept_mimetypes.best_match(offers, default=offers[0]) or offers[0]
+
+
+def payload_response(payload, req, status=200):
+    """
+    Builds a response for a JSON-style payload in the encoding negotiated from
+    the Accept header: strict JSON (default), Arrow IPC, or typed arrays.
+    """
+    mimetype = negotiate(req, [JSON_MIME, ARROW_MIME, TYPED_ARRAYS_MIME])
+    with span("serialize", format=mimetype) as current:
+        if mimetype == ARROW_MIME:
+            body = encode_arrow(payload)
+        elif mimetype == TYPED_ARRAYS_MIME:
+            body = encode_typed_arrays(payload)
+        else:
+            body = encode_json(payload)
+        current.bytes = len(body)
+    response = Response(body, status=status, mimetype=mimetype)
+    response.vary.add("Accept")
+    return response
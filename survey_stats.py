@@ -0,0 +1,248 @@
+import numpy as np
+import pandas as pd
+from patient_profile_builder import GENDER_CODES, RACE_CODES
+from visualization import age_bands, numeric_values
+
+DEFAULT_WEIGHT = "WTMEC2YR"
+STRATA_COLUMN = "SDMVSTRA"
+PSU_COLUMN = "SDMVPSU"
+
+# 1999-2000 and 2001-2002 share 4-year weights (WTINT4YR / WTMEC4YR) that must be
+# used instead of the 2-year weights whenever both cycles are analysed together.
+FOUR_YEAR_CYCLES = ("1999-2000", "2001-2002")
+
+Z_95 = 1.959963984540054
+
+# Group-by dimensions named like the request filters, mapped to (column, code -> label).
+GROUP_COLUMNS = {
+    "gender": ("RIAGENDR", {code: label for label, code in GENDER_CODES.items()}),
+    "race": ("RIDRETH1", {code: label for label, code in RACE_CODES.items()}),
+}
+AGE_GROUPS = ("age", "age_range", "age_band")
+
+
+def combine_weights(df, weight=DEFAULT_WEIGHT, cycle_column="cycle"):
+    """
+    Returns the sample weights of a (possibly multi-cycle) profile, combined as
+    the NHANES analytic guidelines prescribe for k cycles:
+
+    - every 2-year weight is divided by k;
+    - when both 1999-2000 and 2001-2002 are included, their rows use the
+      4-year weight (e.g. WTMEC4YR) times 2/k instead.
+
+    Parameters:
+    - df (DataFrame): Long-layout profile with a cycle column.
+    - weight (str): The 2-year weight column (WTINT2YR or WTMEC2YR).
+    - cycle_column (str): Column holding the cycle of every row.
+
+    Returns:
+    - ndarray: float64 weights, NaN where the weight is missing.
+    """
+    if weight not in df.columns:
+        raise ValueError(f"Weight column {weight} not found in data.")
+    weights = numeric_values(df[weight])
+    if cycle_column not in df.columns:
+        return weights
+
+    cycles = df[cycle_column].astype(str).to_numpy()
+    present = pd.unique(cycles)
+    k = len(present)
+    if k <= 1:
+        return weights
+
+    four_year = weight.replace("2YR", "4YR")
+    if all(c in present for c in FOUR_YEAR_CYCLES) and four_year in df.columns:
+        early = np.isin(cycles, FOUR_YEAR_CYCLES)
+        return np.where(early, numeric_values(df[four_year]) * 2.0 / k, weights / k)
+    return weights / k
+
+
+def _group_codes(df, by):
+    """
+    Returns (codes, keys): the group number of every row (-1 when a key is
+    missing) and a DataFrame of the group labels in group-number order.
+    """
+    if not by:
+        return np.zeros(len(df), dtype=np.int64), pd.DataFrame(index=[0])
+
+    columns = {}
+    for name in by:
+        if name in AGE_GROUPS:
+            columns[name] = age_bands(numeric_values(df["RIDAGEYR"]))
+        elif name in GROUP_COLUMNS:
+            column, labels = GROUP_COLUMNS[name]
+            columns[name] = pd.Series(numeric_values(df[column])).map(labels).to_numpy()
+        elif name in df.columns:
+            columns[name] = df[name].astype(object).to_numpy()
+        else:
+            raise ValueError(f"Group-by column {name} not found in data.")
+    keys = pd.DataFrame(columns)
+    grouped = keys.groupby(list(columns), observed=True, dropna=True, sort=True)
+    codes = grouped.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    labels = grouped.size().index.to_frame(index=False)
+    for name in labels.columns:
+        labels[name] = labels[name].astype(str)
+    return codes, labels
+
+
+def _outcomes(df, variables, proportions):
+    """
+    Returns (names, Y): one float64 column per mean variable and one 0/1
+    indicator column per level of every proportion variable (NaN when missing).
+    """
+    names, columns = [], []
+    for variable in variables:
+        if variable not in df.columns:
+            raise ValueError(f"Variable {variable} not found in data.")
+        names.append(variable)
+        columns.append(numeric_values(df[variable]))
+    for variable in proportions:
+        if variable not in df.columns:
+            raise ValueError(f"Variable {variable} not found in data.")
+        values = numeric_values(df[variable])
+        missing = np.isnan(values)
+        for level in np.unique(values[~missing]):
+            names.append(f"{variable}={level:g}")
+            columns.append(np.where(missing, np.nan, (values == level).astype(np.float64)))
+    if not columns:
+        raise ValueError("Provide at least one variable or proportion.")
+    return names, np.column_stack(columns)
+
+
+def survey_estimates(df, variables=(), proportions=(), by=(), weight=DEFAULT_WEIGHT,
+                     strata=STRATA_COLUMN, psu=PSU_COLUMN, cycle_column="cycle", z=Z_95):
+    """
+    Design-based weighted means and proportions with Taylor-linearized
+    standard errors, for every group and variable at once.
+
+    Groups are analysed as domains: every row stays in the design and rows
+    outside a group (or with a missing value or weight) contribute zero, so
+    the variance reflects the full stratified, clustered sample.  Profiles
+    built with demographic filters are already subsets, so prefer grouping
+    with by over filtering when standard errors matter.  Strata with a
+    single PSU contribute no variance.
+
+    Parameters:
+    - df (DataFrame): Long-layout merged profile with weight and design columns.
+    - variables (list): Columns whose weighted mean is estimated.
+    - proportions (list): Coded columns whose level proportions are estimated.
+    - by (list): Group-by dimensions: "gender", "race", "age_band" (also
+      "age" / "age_range") or any profile column such as "cycle".
+    - weight (str): 2-year weight column, combined across cycles with combine_weights.
+    - strata, psu (str): Masked variance strata and PSU columns.
+    - cycle_column (str): Cycle column used for weight combination.
+    - z (float): Normal quantile for the confidence interval (default 95%).
+
+    Returns:
+    - DataFrame: One row per group and variable with the group keys, variable,
+      n (unweighted), population (sum of weights), estimate, se, ci_low and ci_high.
+    """
+    for column in (strata, psu):
+        if column not in df.columns:
+            raise ValueError(f"Design column {column} not found in data.")
+
+    weights = combine_weights(df, weight, cycle_column)
+    stratum_values = numeric_values(df[strata])
+    psu_values = numeric_values(df[psu])
+    in_design = ~np.isnan(stratum_values) & ~np.isnan(psu_values)
+
+    codes, labels = _group_codes(df, by)
+    names, Y = _outcomes(df, variables, proportions)
+    weights, codes, Y = weights[in_design], codes[in_design], Y[in_design]
+    stratum_values, psu_values = stratum_values[in_design], psu_values[in_design]
+    n_groups, n_vars = len(labels), Y.shape[1]
+
+    # Rows counted in each (group, variable) domain.
+    usable = ~np.isnan(Y) & (np.nan_to_num(weights) > 0)[:, None] & (codes >= 0)[:, None]
+    wv = np.where(usable, weights[:, None], 0.0)
+    wy = np.where(usable, wv * np.nan_to_num(Y), 0.0)
+    rows = codes >= 0
+    group = codes[rows]
+
+    W = np.zeros((n_groups, n_vars))
+    WY = np.zeros((n_groups, n_vars))
+    N = np.zeros((n_groups, n_vars), dtype=np.int64)
+    np.add.at(W, group, wv[rows])
+    np.add.at(WY, group, wy[rows])
+    np.add.at(N, group, usable[rows].astype(np.int64))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        R = np.where(W > 0, WY / W, np.nan)
+    # Linearized values of the ratio estimator, nonzero only inside the row's own domain.
+    own = np.maximum(codes, 0)
+    row_estimate, row_total = np.nan_to_num(R[own]), W[own]
+    scores = np.where(usable, wv * (np.nan_to_num(Y) - row_estimate) / np.where(row_total > 0, row_total, 1.0), 0.0)
+
+    # PSU totals of the scores per group; every design PSU takes part, empty ones with zero.
+    design = pd.DataFrame({"stratum": stratum_values, "psu": psu_values})
+    psu_ids = design.groupby(["stratum", "psu"], sort=True).ngroup().to_numpy()
+    psu_keys = design.groupby(["stratum", "psu"], sort=True).size().reset_index()
+    psu_stratum = pd.factorize(psu_keys["stratum"])[0]
+    n_psu = len(psu_keys)
+    n_strata = int(psu_stratum.max()) + 1 if n_psu else 0
+
+    Z = np.zeros((n_groups, n_psu, n_vars))
+    np.add.at(Z, (group, psu_ids[rows]), scores[rows])
+    psus_per_stratum = np.bincount(psu_stratum, minlength=n_strata)
+    stratum_totals = np.zeros((n_groups, n_strata, n_vars))
+    np.add.at(stratum_totals, (slice(None), psu_stratum), Z)
+    n_h = psus_per_stratum[psu_stratum]
+    deviations = Z - stratum_totals[:, psu_stratum, :] / n_h[None, :, None]
+    factor = np.where(n_h > 1, n_h / np.maximum(n_h - 1, 1), 0.0)
+    variance = np.einsum("p,gpv->gv", factor, deviations ** 2)
+
+    se = np.where(W > 0, np.sqrt(variance), np.nan)
+    result = labels.loc[labels.index.repeat(n_vars)].reset_index(drop=True)
+    result["variable"] = np.tile(names, n_groups)
+    result["n"] = N.ravel()
+    result["population"] = W.ravel()
+    result["estimate"] = R.ravel()
+    result["se"] = se.ravel()
+    result["ci_low"] = result["estimate"] - z * result["se"]
+    result["ci_high"] = result["estimate"] + z * result["se"]
+    return result
+
+
+def _list_param(params, name):
+    value = params.get(name) or ""
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def statistics_columns(df, params):
+    """
+    Returns the columns of df that statistics_payload reads for params (design,
+    weight, outcome and group-by columns), in df's column order.  df may be a
+    zero-row frame carrying just the profile's schema.
+    """
+    weight = params.get("weight") or DEFAULT_WEIGHT
+    needed = {weight, weight.replace("2YR", "4YR"), STRATA_COLUMN, PSU_COLUMN, "cycle"}
+    needed.update(_list_param(params, "variables"))
+    needed.update(_list_param(params, "proportions"))
+    for name in _list_param(params, "by"):
+        if name in AGE_GROUPS:
+            needed.add("RIDAGEYR")
+        elif name in GROUP_COLUMNS:
+            needed.add(GROUP_COLUMNS[name][0])
+        else:
+            needed.add(name)
+    return [col for col in df.columns if col in needed]
+
+
+def statistics_payload(df, params):
+    """
+    Builds the /statistics response body from query parameters: variables,
+    proportions and by (comma-separated lists) and weight (default WTMEC2YR).
+
+    Raises:
+    - ValueError: For missing columns or an empty request.
+    """
+    weight = params.get("weight") or DEFAULT_WEIGHT
+    if not weight.startswith("WT"):
+        raise ValueError("weight must be an NHANES weight column such as WTMEC2YR or WTINT2YR.")
+    result = survey_estimates(
+        df,
+        variables=_list_param(params, "variables"),
+        proportions=_list_param(params, "proportions"),
+        by=_list_param(params, "by"),
+        weight=weight,
+    )
+    return {"weight": weight, "rows": result.astype(object).where(result.notna(), None).to_dict(orient="records")}
@@ -0,0 +1,207 @@
+import math
+import os
+import numpy as np
+import pandas as pd
+from mapping import FILE_COLUMNS, FILE_INDEX, FILE_MAPPING
+
+try:
+    import pyreadstat
+except ImportError:  # pragma: no cover - pyreadstat is optional
+    pyreadstat = None
+
+CYCLES = list(FILE_MAPPING)
+
+# First SEQN and participant count of every public release.
+CYCLE_SEQNS = {
+    "1999-2000": (1, 9965),
+    "2001-2002": (9966, 11039),
+    "2003-2004": (21005, 10122),
+    "2005-2006": (31127, 10348),
+    "2007-2008": (41475, 10149),
+    "2009-2010": (51624, 10537),
+    "2011-2012": (62161, 9756),
+    "2013-2014": (73557, 10175),
+    "2015-2016": (83732, 9971),
+    "2017-2018": (93703, 9254),
+}
+
+# Share of the participants present in each file (e.g. the fasting lab subsample).
+FILE_COVERAGE = {
+    "Demographic Variables & Sample Weights": 1.0,
+    "Blood Pressure": 0.93,
+    "Body Measures": 0.95,
+    "Cardiovascular Fitness": 0.35,
+    "Cholesterol - LDL & Triglycerides": 0.45,
+    "Plasma Fasting Glucose & Insulin": 0.45,
+    "Alcohol Use": 0.6,
+    "Diabetes": 0.97,
+}
+
+FOUR_YEAR_CYCLES = ("1999-2000", "2001-2002")
+STRATA_PER_CYCLE = 15
+
+
+def seqn_range(cycle, rows):
+    """
+    Returns the SEQNs of rows synthetic participants of cycle.  Up to the
+    smallest real cycle size they are the real SEQN range of the cycle;
+    beyond it every range is stretched by the same factor, so cycles never
+    overlap and keep their order.
+    """
+    start, _ = CYCLE_SEQNS[cycle]
+    scale = max(1, math.ceil(rows / min(size for _, size in CYCLE_SEQNS.values())))
+    return (start - 1) * scale + 1 + np.arange(rows, dtype=np.int64)
+
+
+def _rng(seed, cycle, name=""):
+    return np.random.default_rng([seed, CYCLES.index(cycle), sum(ord(c) for c in name)])
+
+
+def participants(cycle, rows, seed=0):
+    """
+    Returns the participant base of a synthetic cycle: SEQN, age (top-coded
+    at 85 before 2007-2008 and 80 after), gender and race/ethnicity codes.
+    """
+    rng = _rng(seed, cycle)
+    top_code = 85 if CYCLES.index(cycle) < CYCLES.index("2007-2008") else 80
+    return pd.DataFrame({
+        "SEQN": seqn_range(cycle, rows),
+        "RIDAGEYR": np.minimum(rng.integers(0, 91, rows), top_code).astype(np.float64),
+        "RIAGENDR": rng.choice([1.0, 2.0], rows),
+        "RIDRETH1": rng.choice([1.0, 2.0, 3.0, 4.0, 5.0], rows, p=[0.2, 0.07, 0.4, 0.25, 0.08]),
+    })
+
+
+def _with_missing(values, rng, share):
+    values = np.asarray(values, dtype=np.float64)
+    values[rng.random(len(values)) < share] = np.nan
+    return values
+
+
+def _codes(rng, rows, codes, p):
+    return rng.choice(np.asarray(codes, dtype=np.float64), rows, p=p)
+
+
+def _column(name, base, cycle, rng):
+    """
+    Returns realistic values (NHANES units, coded answers including the
+    7 / 9 / 77 / 99 refused and don't-know codes) for one column.
+    """
+    rows = len(base)
+    age = base["RIDAGEYR"].to_numpy()
+    male = base["RIAGENDR"].to_numpy() == 1
+    if name in ("RIDAGEYR", "RIAGENDR", "RIDRETH1"):
+        return base[name].to_numpy()
+    if name in ("WTINT2YR", "WTMEC2YR", "WTINT4YR", "WTMEC4YR"):
+        weights = rng.lognormal(np.log(25000), 0.8, rows)
+        if name.startswith("WTMEC"):
+            weights[rng.random(rows) < 0.05] = 0.0  # interviewed but not examined
+        return weights / (2 if name.endswith("4YR") else 1)
+    if name == "SDMVSTRA":
+        return (CYCLES.index(cycle) * STRATA_PER_CYCLE + rng.integers(1, STRATA_PER_CYCLE + 1, rows)).astype(np.float64)
+    if name == "SDMVPSU":
+        return rng.integers(1, 3, rows).astype(np.float64)
+    if name == "BPXSY1":
+        return _with_missing(np.round(rng.normal(105 + 0.5 * age, 15)), rng, 0.08)
+    if name == "BPXDI1":
+        values = np.round(rng.normal(70, 12, rows))
+        values[rng.random(rows) < 0.01] = 0.0
+        return _with_missing(values, rng, 0.08)
+    if name in ("BMXWT", "BMXHT", "BMXBMI"):
+        grown = np.minimum(age, 18) / 18
+        height = np.where(male, 175, 162) * (0.55 + 0.45 * grown) + rng.normal(0, 7, rows)
+        weight = np.where(male, 85, 75) * (0.2 + 0.8 * grown) * rng.lognormal(0, 0.2, rows)
+        values = {"BMXWT": weight, "BMXHT": height, "BMXBMI": weight / (height / 100) ** 2}[name]
+        return _with_missing(np.round(values, 1), rng, 0.02)
+    if name == "CVDESVO2":
+        return _with_missing(np.round(rng.normal(42, 9, rows), 1), rng, 0.2)
+    if name == "CVDFITLV":
+        return _codes(rng, rows, [1, 2, 3], [0.3, 0.4, 0.3])
+    if name in ("LBXTR", "LBXIN"):
+        scale = 110 if name == "LBXTR" else 11
+        return _with_missing(np.round(rng.lognormal(np.log(scale), 0.5, rows)), rng, 0.05)
+    if name == "LBDLDL":
+        return _with_missing(np.round(rng.normal(115, 35, rows)), rng, 0.1)
+    if name == "LBXGLU":
+        return _with_missing(np.round(rng.lognormal(np.log(100), 0.2, rows)), rng, 0.05)
+    if name in ("ALQ100", "ALQ101"):
+        return _codes(rng, rows, [1, 2, 7, 9, np.nan], [0.7, 0.25, 0.01, 0.01, 0.03])
+    if name == "ALQ130":
+        values = rng.integers(1, 13, rows).astype(np.float64)
+        values[rng.random(rows) < 0.02] = 777
+        values[rng.random(rows) < 0.02] = 999
+        return _with_missing(values, rng, 0.3)
+    if name == "DIQ010":
+        return _codes(rng, rows, [1, 2, 3, 7, 9], [0.1, 0.86, 0.02, 0.01, 0.01])
+    return _with_missing(rng.normal(0, 1, rows), rng, 0.05)
+
+
+def synthetic_file(cycle, category, file_desc, rows, seed=0):
+    """
+    Returns a synthetic NHANES file shaped like the real one: the columns
+    kept by mapping.FILE_COLUMNS (4-year weights only in 1999-2002), SEQNs of
+    the cycle's participant base, and the file's usual share of participants.
+
+    Parameters:
+    - cycle, category, file_desc: A file listed in mapping.FILE_MAPPING.
+    - rows (int): Participants in the cycle (the demographics file size).
+    - seed (int): Seed; the same arguments always give the same frame.
+    """
+    columns = FILE_COLUMNS.get((category, file_desc), ["SEQN"])
+    base = participants(cycle, rows, seed)
+    rng = _rng(seed, cycle, file_desc)
+    coverage = FILE_COVERAGE.get(file_desc, 0.9)
+    if coverage < 1.0:
+        base = base[rng.random(rows) < coverage].reset_index(drop=True)
+    frame = {"SEQN": base["SEQN"].to_numpy(dtype=np.float64)}
+    for name in columns:
+        if name == "SEQN" or (name.endswith("4YR") and cycle not in FOUR_YEAR_CYCLES):
+            continue
+        frame[name] = _column(name, base, cycle, rng)
+    return pd.DataFrame(frame)
+
+
+def write_xpt(df, path):
+    """
+    Writes df as a SAS transport (XPT v5) file, like the CDC releases.
+    """
+    if pyreadstat is None:
+        raise RuntimeError("Writing XPT files requires pyreadstat.")
+    pyreadstat.write_xport(df, path, file_format_version=5)
+    return path
+
+
+def generate_files(directory, cycles=None, rows=1000, seed=0, files=None):
+    """
+    Writes a synthetic XPT file for every mapped (cycle, category, file_desc),
+    one at a time so memory stays bounded by the largest file.
+
+    Parameters:
+    - directory (str): Output directory.
+    - cycles (list): Cycles to generate (default: all ten mapped cycles).
+    - rows (int): Participants per cycle.
+    - seed (int): Random seed.
+    - files (list): Optional (category, file_desc) pairs to restrict to.
+
+    Returns:
+    - dict: (cycle, category, file_desc) -> path of the written file.
+    """
+    os.makedirs(directory, exist_ok=True)
+    written = {}
+    for key, spec in FILE_INDEX.items():
+        cycle, category, file_desc = key
+        if (cycles is not None and cycle not in cycles) or (files is not None and (category, file_desc) not in files):
+            continue
+        path = os.path.join(directory, f"{spec.code}.xpt")
+        write_xpt(synthetic_file(cycle, category, file_desc, rows, seed), path)
+        written[key] = path
+    return written
+
+
+def serve_files(server, written):
+    """
+    Registers generated files with a StubCDCServer under their CDC paths.
+    """
+    for (cycle, category, file_desc), path in written.items():
+        server.add_path(cycle.split("-")[0], FILE_INDEX[(cycle, category, file_desc)].code, path)
+    return server
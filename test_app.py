@@ -128,3 +128,289 @@ def test_profile_endpoint_with_filters(client):
     # You might also want to check that only one row is returned and that its SEQN is 2.
     assert len(df) == 1, "Expected only one row after filtering."
     assert df["SEQN"].iloc[0] == 2, "Expected SEQN 2 after filtering."
+
+@pytest.fixture
+def stub_profile(monkeypatch):
+    """
+    Replaces the profile builder with one returning a fixed multi-chunk profile.
+    """
+    import nhanes_api
+    profile_df = pd.DataFrame({
+        "SEQN": range(1, 12001),
+        "RIDAGEYR": [20 + i % 60 for i in range(12000)],
+        "DIQ010_1999-2000": [1 + i % 2 for i in range(12000)]
+    })
+    monkeypatch.setattr(nhanes_api.profile_builder, "build_profile", lambda selections, cycles, **options: profile_df)
+    if nhanes_api.result_cache is not None:
+        nhanes_api.result_cache.clear()
+    return profile_df
+
+def test_profile_endpoint_streams_csv(client, stub_profile):
+    payload = {"selections": {"demographics": {"file": "Demographic Variables & Sample Weights"}}, "cycles": ["1999-2000"]}
+    response = client.post("/profile", data=json.dumps(payload), content_type="application/json")
+    assert response.status_code == 200
+    assert response.is_streamed, "Profile CSV should be streamed in chunks."
+    assert "attachment" in response.headers.get("Content-Disposition", "")
+    df = pd.read_csv(StringIO(response.data.decode("utf-8")))
+    pd.testing.assert_frame_equal(df, stub_profile)
+
+def test_profile_endpoint_gzip_stream(client, stub_profile):
+    import gzip
+    payload = {"selections": {"demographics": {"file": "Demographic Variables & Sample Weights"}}, "cycles": ["1999-2000"]}
+    response = client.post("/profile?gzip=1", data=json.dumps(payload), content_type="application/json")
+    assert response.status_code == 200
+    assert response.headers.get("Content-Encoding") == "gzip"
+    df = pd.read_csv(StringIO(gzip.decompress(response.data).decode("utf-8")))
+    assert len(df) == len(stub_profile)
+
+def _wait_for_job(client, job_id, timeout=10):
+    import time
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = client.get(f"/jobs/{job_id}").get_json()
+        if status["status"] in ("done", "failed"):
+            return status
+        time.sleep(0.05)
+    raise AssertionError(f"Job {job_id} did not finish")
+
+def test_job_submit_poll_and_result(client, stub_profile):
+    payload = {"selections": {"demographics": {"file": "Demographic Variables & Sample Weights"}}, "cycles": ["1999-2000"]}
+    response = client.post("/jobs", data=json.dumps(payload), content_type="application/json")
+    assert response.status_code == 202
+    job_id = response.get_json()["job_id"]
+
+    assert _wait_for_job(client, job_id)["status"] == "done"
+    progress = client.get(f"/jobs/{job_id}/progress").get_json()
+    assert progress["job_id"] == job_id and progress["status"] == "done"
+
+    result = client.get(f"/jobs/{job_id}/result")
+    assert result.status_code == 200
+    df = pd.read_csv(StringIO(result.data.decode("utf-8")))
+    pd.testing.assert_frame_equal(df, stub_profile)
+
+def test_job_duplicate_submission_shares_job(client, stub_profile):
+    payload = {"selections": {"demographics": {"file": "Demographic Variables & Sample Weights"}}, "cycles": ["2001-2002"]}
+    first = client.post("/jobs", data=json.dumps(payload), content_type="application/json").get_json()
+    second = client.post("/jobs", data=json.dumps(payload), content_type="application/json").get_json()
+    assert first["job_id"] == second["job_id"]
+
+def test_finished_job_is_rebuilt_when_its_profile_or_sources_change(client, stub_profile, monkeypatch):
+    import nhanes_api
+    payload = {"selections": {"demographics": {"file": "Demographic Variables & Sample Weights"}}, "cycles": ["2003-2004"]}
+    version = {"token": "v1"}
+    monkeypatch.setattr(nhanes_api.job_manager, "version_function", lambda selections, cycles: version["token"])
+
+    first = client.post("/jobs", data=json.dumps(payload), content_type="application/json").get_json()["job_id"]
+    assert _wait_for_job(client, first)["status"] == "done"
+    assert client.post("/jobs", data=json.dumps(payload), content_type="application/json").get_json()["job_id"] == first
+
+    version["token"] = "v2"
+    second = client.post("/jobs", data=json.dumps(payload), content_type="application/json").get_json()["job_id"]
+    assert second != first, "A job built from older source files should not be reused."
+    assert _wait_for_job(client, second)["status"] == "done"
+
+    nhanes_api.artifact_store.clear()
+    third = client.post("/jobs", data=json.dumps(payload), content_type="application/json").get_json()["job_id"]
+    assert third != second, "A job whose stored profile expired should be built again."
+    assert _wait_for_job(client, third)["status"] == "done"
+    assert client.get(f"/jobs/{third}/result").status_code == 200
+
+def test_job_unknown_and_missing_payload(client):
+    assert client.get("/jobs/does-not-exist").status_code == 404
+    assert client.get("/jobs/does-not-exist/result").status_code == 404
+    assert client.post("/jobs", data=json.dumps({}), content_type="application/json").status_code == 400
+
+def test_cached_profiles_reuse_their_stored_artifact(client, stub_profile, monkeypatch):
+    import nhanes_api
+    if nhanes_api.result_cache is None:
+        pytest.skip("The result cache is disabled.")
+    writes = []
+    backend = nhanes_api.artifact_store.backend
+    real_put = backend.put
+    monkeypatch.setattr(backend, "put", lambda key, df, version=None: writes.append(key) or real_put(key, df, version))
+    payload = {"selections": {"demographics": {"file": "Demographic Variables & Sample Weights"}}, "cycles": ["2005-2006"]}
+    first = client.post("/profile", data=json.dumps(payload), content_type="application/json")
+    second = client.post("/profile", data=json.dumps(payload), content_type="application/json")
+    assert first.headers["X-Profile-Id"] == second.headers["X-Profile-Id"]
+    assert writes == [first.headers["X-Profile-Id"]], "A cache hit should not store the profile again."
+
+def test_profile_id_scopes_visualization_to_each_request(client, monkeypatch):
+    import nhanes_api
+    profiles = iter([
+        pd.DataFrame({"SEQN": [1, 2], "RIDAGEYR": [30, 40], "DIQ010": [1, 2]}),
+        pd.DataFrame({"SEQN": [7], "RIDAGEYR": [70], "DIQ010": [2]}),
+    ])
+    monkeypatch.setattr(nhanes_api.profile_builder, "build_profile", lambda selections, cycles, **options: next(profiles))
+    monkeypatch.setattr(nhanes_api.services, "result_cache", None)
+    payload = {"selections": {"demographics": {"file": "Demographic Variables & Sample Weights"}}, "cycles": ["1999-2000"]}
+    first = client.post("/profile", data=json.dumps(payload), content_type="application/json")
+    second = client.post("/profile", data=json.dumps(payload), content_type="application/json")
+    first_id, second_id = first.headers["X-Profile-Id"], second.headers["X-Profile-Id"]
+    assert first_id != second_id
+
+    assert client.get(f"/visualization?profile_id={first_id}").get_json()["labels"] == [1, 2]
+    assert client.get(f"/visualization?profile_id={second_id}").get_json()["labels"] == [7]
+    # Without an explicit id the caller's own latest profile (cookie) is used.
+    assert client.get("/visualization").get_json()["labels"] == [7]
+    assert client.get("/visualization?profile_id=" + "0" * 32).status_code == 404
+
+def test_visualization_modes_are_bounded(client, stub_profile):
+    payload = {"selections": {"demographics": {"file": "Demographic Variables & Sample Weights"}}, "cycles": ["1999-2000"]}
+    profile_id = client.post("/profile", data=json.dumps(payload), content_type="application/json").headers["X-Profile-Id"]
+
+    points = client.get(f"/visualization?profile_id={profile_id}&max_points=500").get_json()
+    assert len(points["age"]) == 500 and points["total"] == len(stub_profile)
+    histogram = client.get(f"/visualization?profile_id={profile_id}&mode=histogram&bins=12").get_json()
+    assert len(histogram["counts"]) == 12 and sum(histogram["counts"]) == len(stub_profile)
+    stats = client.get(f"/visualization?profile_id={profile_id}&mode=stats").get_json()
+    assert sum(group["count"] for group in stats["groups"]) == len(stub_profile)
+    assert client.get(f"/visualization?profile_id={profile_id}&mode=bogus").status_code == 400
+
+def test_visualization_and_profile_negotiate_encoding(client, monkeypatch):
+    import nhanes_api
+    import pyarrow as pa
+    profile_df = pd.DataFrame({"SEQN": [1, 2], "RIDAGEYR": [30.0, float("nan")], "DIQ010": [1.0, 2.0]})
+    monkeypatch.setattr(nhanes_api.profile_builder, "build_profile", lambda selections, cycles, **options: profile_df)
+    monkeypatch.setattr(nhanes_api.services, "result_cache", None)
+    payload = {"selections": {"demographics": {"file": "Demographic Variables & Sample Weights"}}, "cycles": ["1999-2000"]}
+
+    response = client.post("/profile", data=json.dumps(payload), content_type="application/json",
+                           headers={"Accept": "application/json"})
+    assert response.mimetype == "application/json"
+    assert response.get_json()["data"]["RIDAGEYR"] == [30.0, None]
+    profile_id = response.headers["X-Profile-Id"]
+
+    default = client.get(f"/visualization?profile_id={profile_id}")
+    assert default.mimetype == "application/json"
+    assert default.get_json()["age"] == [30.0, None], "NaN must be encoded as null."
+    arrow = client.get(f"/visualization?profile_id={profile_id}",
+                       headers={"Accept": "application/vnd.apache.arrow.stream"})
+    assert arrow.mimetype == "application/vnd.apache.arrow.stream"
+    assert pa.ipc.open_stream(arrow.data).read_all().column("labels").to_pylist() == [1, 2]
+
+def test_statistics_endpoint_returns_weighted_estimates(client, monkeypatch):
+    import nhanes_api
+    profile_df = pd.DataFrame({
+        "SEQN": [1, 2, 3, 4], "cycle": ["1999-2000"] * 4, "RIDAGEYR": [25.0, 35.0, 45.0, 55.0],
+        "RIAGENDR": [1.0, 2.0, 1.0, 2.0], "WTMEC2YR": [1.0, 1.0, 3.0, 1.0],
+        "SDMVSTRA": [1.0, 1.0, 2.0, 2.0], "SDMVPSU": [1.0, 2.0, 1.0, 2.0], "BPXSY1": [100.0, 110.0, 120.0, 130.0],
+    })
+    monkeypatch.setattr(nhanes_api.profile_builder, "build_profile", lambda selections, cycles, **options: profile_df)
+    monkeypatch.setattr(nhanes_api.services, "result_cache", None)
+    payload = {"selections": {"demographics": {"file": "Demographic Variables & Sample Weights"}}, "cycles": ["1999-2000"]}
+    profile_id = client.post("/profile", data=json.dumps(payload), content_type="application/json").headers["X-Profile-Id"]
+
+    response = client.get(f"/statistics?profile_id={profile_id}&variables=BPXSY1&by=gender")
+    assert response.status_code == 200
+    rows = {row["gender"]: row for row in response.get_json()["rows"]}
+    assert rows["Male"]["estimate"] == pytest.approx((100.0 + 3 * 120.0) / 4)
+    assert rows["Female"]["estimate"] == pytest.approx(120.0)
+    assert client.get(f"/statistics?profile_id={profile_id}").status_code == 400
+
+def test_cohort_endpoint_answers_from_cube(client, monkeypatch, tmp_path):
+    import nhanes_api
+    from cohort_cube import CohortCube
+    requested = []
+
+    def build_profile(selections, cycles, **options):
+        requested.append(list(cycles))
+        return pd.DataFrame({
+            "SEQN": [1, 2, 3], "cycle": cycles[0], "RIDAGEYR": [25.0, 35.0, 70.0],
+            "RIAGENDR": [2.0, 2.0, 1.0], "RIDRETH1": [3.0, 4.0, 3.0], "BPXSY1": [110.0, 130.0, 150.0],
+        })
+
+    monkeypatch.setattr(nhanes_api.profile_builder, "build_profile", build_profile)
+    monkeypatch.setattr(nhanes_api.services, "cohort_cube", CohortCube(["BPXSY1"], str(tmp_path / "cube.npz")))
+    monkeypatch.setattr(nhanes_api.source_cache, "fingerprint", lambda cycle=None, file_code=None: "v1")
+
+    response = client.get("/cohort?cycles=1999-2000&gender=Female&age_range=20-39")
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["count"] == 2 and body["metrics"]["BPXSY1"]["mean"] == 120.0
+    assert client.get("/cohort?cycles=1999-2000&race=Non-Hispanic White").get_json()["count"] == 2
+    assert requested == [["1999-2000"]], "The cube is built once per cycle and version."
+    assert (tmp_path / "cube.npz").exists()
+    assert client.get("/cohort").status_code == 400
+
+def test_profile_timing_header_and_metrics(client, stub_profile):
+    from instrumentation import metrics
+    metrics.reset()
+    payload = {"selections": {"demographics": {"file": "Demographic Variables & Sample Weights"}}, "cycles": ["1999-2000"]}
+    response = client.post("/profile", data=json.dumps(payload), content_type="application/json")
+    assert "Server-Timing" not in response.headers, "Timing is only returned when asked for."
+
+    response = client.post("/profile?timing=1", data=json.dumps(payload), content_type="application/json",
+                           headers={"Accept": "application/json"})
+    assert response.status_code == 200
+    timing = response.headers["Server-Timing"]
+    assert "serialize;dur=" in timing and "total;dur=" in timing
+
+    snapshot = client.get("/metrics").get_json()
+    assert snapshot["latency"]["request./profile"]["count"] == 2
+    assert snapshot["spans"]["serialize"]["rows_in"] == 2 * len(stub_profile)
+    assert snapshot["caches"]["results"]["hits"] >= 1
+    assert "request./metrics" not in snapshot["latency"]
+
+    text = client.get("/metrics?format=prometheus")
+    assert text.mimetype == "text/plain"
+    assert 'nhanes_latency_seconds_count{name="request./profile"} 2' in text.get_data(as_text=True)
+
+def test_api_builder_cleans_missing_codes_as_files_load(tmp_path, monkeypatch, cdc_server):
+    """
+    Refused / don't know codes served in the CDC files come back from /profile as null.
+    """
+    from profile_api import APIServices, create_app
+    from synthetic_nhanes import write_xpt
+    monkeypatch.chdir(tmp_path)
+    for name, value in {"NHANES_RESULT_CACHE": "off", "NHANES_COHORT_CUBE": "off",
+                        "NHANES_ARTIFACT_STORE": "memory"}.items():
+        monkeypatch.setenv(name, value)
+
+    seqn = [1.0, 2.0, 3.0, 4.0]
+    files = {
+        "DEMO": pd.DataFrame({"SEQN": seqn, "RIDAGEYR": [30.0, 45.0, 60.0, 77.0], "RIAGENDR": [1.0, 2.0, 1.0, 2.0],
+                              "RIDRETH1": [3.0, 3.0, 4.0, 1.0]}),
+        "DIQ": pd.DataFrame({"SEQN": seqn, "DIQ010": [1.0, 2.0, 7.0, 9.0]}),
+        "ALQ": pd.DataFrame({"SEQN": seqn, "ALQ101": [1.0, 7.0, 9.0, 2.0], "ALQ130": [3.0, 777.0, 999.0, 2.0]}),
+    }
+    for code, frame in files.items():
+        path = str(tmp_path / f"{code}.XPT")
+        write_xpt(frame, path)
+        cdc_server.add_path("1999", code, path)
+
+    api = create_app(APIServices())
+    api.config["TESTING"] = True
+    payload = {"selections": {"demographics": ["Demographic Variables & Sample Weights"],
+                              "questionnaire": ["Diabetes", "Alcohol Use"]}, "cycles": ["1999-2000"]}
+    with api.test_client() as api_client:
+        response = api_client.post("/profile", data=json.dumps(payload), content_type="application/json",
+                                   headers={"Accept": "application/json"})
+    assert response.status_code == 200, response.get_data(as_text=True)
+    df = pd.DataFrame(response.get_json()["data"]).set_index("SEQN").sort_index()
+    assert df["DIQ010"].isna().tolist() == [False, False, True, True]
+    assert df["ALQ101"].isna().tolist() == [False, True, True, False]
+    assert df["ALQ130"].isna().tolist() == [False, True, True, False]
+    assert df.loc[4, "RIDAGEYR"] == 77, "Ages have no missing codes and are kept."
+
+def test_profile_rejects_invalid_layout_and_join(client):
+    payload = {"selections": {"demographics": {"file": "Demographic Variables & Sample Weights"}}, "cycles": ["1999-2000"]}
+    for option in ({"layout": "diagonal"}, {"join": "outer"}):
+        response = client.post("/profile", data=json.dumps({**payload, **option}), content_type="application/json")
+        assert response.status_code == 400, f"Expected 400 for {option}, got {response.status_code}"
+        assert "Invalid" in response.get_json()["error"]
+        response = client.post("/jobs", data=json.dumps({**payload, **option}), content_type="application/json")
+        assert response.status_code == 400, f"Jobs should refuse {option} before queueing, got {response.status_code}"
+
+def test_profile_build_errors_are_server_errors(client, monkeypatch):
+    import nhanes_api
+
+    def failing_build(selections, cycles, **options):
+        raise ValueError("cannot reindex on an axis with duplicate labels")
+
+    monkeypatch.setattr(nhanes_api.profile_builder, "build_profile", failing_build)
+    monkeypatch.setattr(nhanes_api.services, "result_cache", None)
+    payload = {"selections": {"demographics": {"file": "Demographic Variables & Sample Weights",
+                                               "filters": {"gender": "Female"}}}, "cycles": ["1999-2000"]}
+    assert client.post("/profile", data=json.dumps(payload), content_type="application/json").status_code == 500
+    payload["selections"]["demographics"]["filters"] = {"gender": "Unknown"}
+    assert client.post("/profile", data=json.dumps(payload), content_type="application/json").status_code == 400
@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+from benchmark import compare, load_baselines, run_benchmark, save_baseline
+from synthetic_nhanes import CYCLES, CYCLE_SEQNS, seqn_range, synthetic_file
+
+
+def test_synthetic_files_use_cycle_seqns_and_coded_values():
+    demo = synthetic_file("2001-2002", "demographics", "Demographic Variables & Sample Weights", 500)
+    start, size = CYCLE_SEQNS["2001-2002"]
+    assert demo["SEQN"].min() == start and demo["SEQN"].max() < start + size
+    assert set(demo["RIAGENDR"]) <= {1, 2} and set(demo["RIDRETH1"]) <= {1, 2, 3, 4, 5}
+    assert {"WTMEC2YR", "WTMEC4YR", "SDMVSTRA", "SDMVPSU"} <= set(demo.columns)
+    assert "WTMEC4YR" not in synthetic_file("2017-2018", "demographics", "Demographic Variables & Sample Weights", 10)
+
+    diabetes = synthetic_file("2001-2002", "questionnaire", "Diabetes", 500)
+    assert set(diabetes["SEQN"]) <= set(demo["SEQN"]) and len(diabetes) < len(demo)
+    assert set(diabetes["DIQ010"].dropna()) <= {1, 2, 3, 7, 9}
+    pd.testing.assert_frame_equal(diabetes, synthetic_file("2001-2002", "questionnaire", "Diabetes", 500))
+
+
+def test_scaled_seqn_ranges_never_overlap():
+    ranges = [seqn_range(cycle, 50000) for cycle in CYCLES]
+    assert all(earlier.max() < later.min() for earlier, later in zip(ranges, ranges[1:]))
+    assert np.array_equal(seqn_range("1999-2000", 3), [1, 2, 3])
+
+
+def test_benchmark_records_every_stage_and_flags_regressions(tmp_path):
+    result = run_benchmark(rows=200, cycles=CYCLES[:2], repeat=1)
+    assert set(result["stages"]) == {"download", "apply_filters", "build_profile", "clean_data",
+                                     "visualization_points", "visualization_stats"}
+    assert result["stages"]["build_profile"]["rows"] == 400
+    assert all(stage["min_s"] > 0 and stage["peak_mb"] >= 0 for stage in result["stages"].values())
+
+    path = str(tmp_path / "baselines.json")
+    save_baseline(result, path)
+    baseline = load_baselines(path)["rows=200,cycles=2"]
+    assert compare(result, baseline) == []
+    slower = dict(result, stages={"clean_data": dict(result["stages"]["clean_data"],
+                                                     min_s=result["stages"]["clean_data"]["min_s"] + 1.0)})
+    assert [(stage, metric) for stage, metric, *_ in compare(slower, baseline)] == [("clean_data", "min_s")]
@@ -0,0 +1,136 @@
+import time
+import numpy as np
+import pandas as pd
+import pytest
+from cohort_cube import CohortCube, cycle_version, metric_selections, refresh_cube
+from patient_profile_builder import apply_filters
+
+
+def cycle_profile(cycle, rows=3000, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "SEQN": np.arange(rows) + seed * rows,
+        "cycle": cycle,
+        "RIDAGEYR": rng.integers(0, 86, rows).astype(float),
+        "RIAGENDR": rng.integers(1, 3, rows).astype(float),
+        "RIDRETH1": rng.integers(1, 6, rows).astype(float),
+        "BPXSY1": rng.normal(120, 15, rows),
+    })
+    df.loc[rng.random(rows) < 0.2, "BPXSY1"] = np.nan
+    return df
+
+
+class CycleBuilder:
+    def __init__(self):
+        self.requested = []
+
+    def build_profile(self, selections, cycles, **options):
+        self.requested.append(list(cycles))
+        return pd.concat([cycle_profile(c, seed=i) for i, c in enumerate(cycles)], ignore_index=True)
+
+
+@pytest.mark.parametrize("filters", [
+    {},
+    {"gender": "Female"},
+    {"gender": "Male", "race": ["Mexican American", "Non-Hispanic Black"], "age_range": ["20-39", "60+"]},
+])
+def test_query_matches_row_level_filtering(filters):
+    df = pd.concat([cycle_profile("1999-2000", seed=1), cycle_profile("2001-2002", seed=2)], ignore_index=True)
+    cube = CohortCube(metrics=["BPXSY1"])
+    cube.add_profile(df)
+
+    expected = apply_filters(df[df["cycle"] == "2001-2002"], filters)
+    result = cube.query(filters, cycles=["2001-2002"])
+    assert result["count"] == len(expected)
+    assert result["metrics"]["BPXSY1"]["mean"] == pytest.approx(expected["BPXSY1"].mean())
+
+
+def test_query_is_answered_without_rows():
+    cube = CohortCube(metrics=["BPXSY1"])
+    cube.add_profile(cycle_profile("1999-2000", rows=50000))
+    filters = {"gender": "Female", "age_range": "20-39"}
+    cube.query(filters)
+    start = time.perf_counter()
+    for _ in range(100):
+        cube.query(filters)
+    assert (time.perf_counter() - start) / 100 < 0.005
+
+
+def test_refresh_builds_only_new_or_changed_cycles(tmp_path):
+    builder = CycleBuilder()
+    versions = {"1999-2000": "a", "2001-2002": "a", "2003-2004": "a"}
+    cube = CohortCube(metrics=["BPXSY1"])
+    assert refresh_cube(cube, builder, ["1999-2000", "2001-2002"], versions.get) == ["1999-2000", "2001-2002"]
+    assert refresh_cube(cube, builder, ["1999-2000", "2001-2002", "2003-2004"], versions.get) == ["2003-2004"]
+    versions["1999-2000"] = "b"
+    assert refresh_cube(cube, builder, ["1999-2000", "2003-2004"], versions.get) == ["1999-2000"]
+    assert builder.requested == [["1999-2000", "2001-2002"], ["2003-2004"], ["1999-2000"]]
+    assert cube.cycles == ["1999-2000", "2001-2002", "2003-2004"]
+
+    path = str(tmp_path / "cube.npz")
+    cube.save(path)
+    loaded = CohortCube.load(path, metrics=["BPXSY1"])
+    assert loaded.query({"gender": "Male"}) == cube.query({"gender": "Male"})
+    assert loaded.stale_cycles(["2003-2004"], versions.get) == []
+    assert CohortCube.load(path, metrics=["BMXBMI"]).cycles == [], "Other metrics need a new cube."
+
+
+def test_refresh_retries_cycles_whose_files_failed(tmp_path):
+    failing = {"1999-2000": "demographics", "2001-2002": "examination"}
+
+    class FailingBuilder(CycleBuilder):
+        def build_profile(self, selections, cycles, progress=None, **options):
+            self.requested.append(list(cycles))
+            frames = []
+            for i, cycle in enumerate(cycles):
+                for category, files in selections.items():
+                    for file_desc in ([files] if isinstance(files, str) else files):
+                        progress((cycle, category, file_desc), "failed" if failing.get(cycle) == category else "done")
+                if failing.get(cycle) != "demographics":
+                    frames.append(cycle_profile(cycle, seed=i))
+            return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    builder = FailingBuilder()
+    cube = CohortCube(metrics=["BPXSY1"], path=str(tmp_path / "cube.npz"))
+    cycles = ["1999-2000", "2001-2002", "2003-2004"]
+    assert refresh_cube(cube, builder, cycles, lambda cycle: "v1") == ["2003-2004"]
+    assert cube.stale_cycles(cycles) == ["1999-2000", "2001-2002"]
+
+    failing.clear()
+    assert refresh_cube(cube, builder, cycles, lambda cycle: "v1") == ["1999-2000", "2001-2002"]
+    assert builder.requested == [cycles, ["1999-2000", "2001-2002"]]
+    assert cube.query(cycles=["1999-2000"])["count"] == 3000
+
+
+def test_cube_slabs_survive_downloads_of_other_files(tmp_path):
+    from mapping import resolve_file
+    from profile_fragments import plan_version
+    from xpt_cache import XPTCache
+
+    def put(file_desc, category, content):
+        path = tmp_path / "blob"
+        path.write_bytes(content)
+        source.put("1999-2000", resolve_file("1999-2000", category, file_desc).code, str(path))
+
+    source = XPTCache(str(tmp_path / "xpt"))
+    cube, builder = CohortCube(metrics=["BPXSY1"]), CycleBuilder()
+    version = cycle_version(cube, plan_version(source))
+    put("Demographic Variables & Sample Weights", "demographics", b"demo")
+    assert refresh_cube(cube, builder, ["1999-2000"], version) == ["1999-2000"]
+    put("Diabetes", "questionnaire", b"diabetes")
+    assert refresh_cube(cube, builder, ["1999-2000"], version) == [], "Diabetes is not read by the cube."
+    put("Blood Pressure", "examination", b"bp")
+    assert refresh_cube(cube, builder, ["1999-2000"], version) == ["1999-2000"]
+
+
+def test_unsupported_queries_raise():
+    cube = CohortCube(metrics=["BPXSY1"])
+    cube.add_profile(cycle_profile("1999-2000", rows=10))
+    with pytest.raises(ValueError):
+        cube.query({"DMDEDUC2": [1]})
+    with pytest.raises(ValueError):
+        cube.query(cycles=["2011-2012"])
+    with pytest.raises(ValueError):
+        metric_selections(["NOT_A_METRIC"])
+    assert metric_selections(["BPXSY1", "BPXDI1"]) == {
+        "demographics": "Demographic Variables & Sample Weights", "examination": ["Blood Pressure"]}
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+from dtype_policy import DtypePolicy
+
+
+def float64_profile():
+    # Everything float64, as read from XPT files and the old merged_profile.csv.
+    return pd.DataFrame({
+        "SEQN": [13.0, 21.0, 27.0, 33.0],
+        "RIDAGEYR": [70.0, 18.0, 18.0, 46.0],
+        "RIAGENDR": [1.0, 1.0, 2.0, 2.0],
+        "RIDRETH1": [1.0, 3.0, 4.0, 5.0],
+        "DIQ010_1999-2000": [1.0, 2.0, np.nan, 9.0],
+        "BMXBMI": [24.31, 31.9, 27.05, 19.5],
+        "WTINT2YR": [12345.678901234, 2345.6, 3456.7, 4567.8],
+    })
+
+
+def test_default_policy_downcasts_and_reports_memory():
+    policy = DtypePolicy()
+    df = policy.apply(float64_profile())
+
+    assert df["SEQN"].dtype == np.int32
+    assert str(df["RIAGENDR"].dtype) == "Int8"
+    assert str(df["DIQ010_1999-2000"].dtype) == "Int8"
+    assert pd.isna(df.loc[2, "DIQ010_1999-2000"])
+    assert df["BMXBMI"].dtype == np.float32
+    assert df["WTINT2YR"].dtype == np.float64, "Survey weights keep full precision."
+    assert policy.last_report["after_bytes"] < policy.last_report["before_bytes"]
+
+
+def test_category_policy_and_precision_guard():
+    source = float64_profile()
+    source["LBXGLU"] = [100.0, 1e-9 + 100.0, 123456789.123, 90.0]
+    df = DtypePolicy(coded="category").apply(source)
+
+    assert isinstance(df["RIDRETH1"].dtype, pd.CategoricalDtype)
+    assert df["LBXGLU"].dtype == np.float64, "Values that do not survive float32 stay float64."
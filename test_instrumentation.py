@@ -0,0 +1,89 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import pytest
+import instrumentation
+from instrumentation import Histogram, Metrics, end_trace, frame_bytes, span, start_trace
+
+
+@pytest.fixture(autouse=True)
+def fresh_metrics(monkeypatch):
+    monkeypatch.setattr(instrumentation, "metrics", Metrics())
+    monkeypatch.setattr(instrumentation, "_level", instrumentation.LEVELS["INFO"])
+    return instrumentation.metrics
+
+
+def test_histogram_quantiles_and_buckets():
+    histogram = Histogram(buckets=(0.01, 0.1, 1.0))
+    for value in (0.005, 0.005, 0.05, 0.5, 3.0):
+        histogram.observe(value)
+    assert histogram.quantile(0.4) == 0.01
+    assert histogram.quantile(0.6) == 0.1
+    assert histogram.quantile(0.99) == 3.0, "The unbounded bucket reports the observed maximum."
+    snapshot = histogram.snapshot()
+    assert snapshot["buckets"] == {"0.01": 2, "0.1": 3, "1": 4, "+Inf": 5}
+    assert snapshot["count"] == 5 and snapshot["max"] == 3.0
+    assert Histogram().quantile(0.5) is None
+
+
+def test_span_records_metrics_and_trace(fresh_metrics):
+    df = pd.DataFrame({"SEQN": [1.0, 2.0, 3.0], "RIDAGEYR": [20.0, 40.0, 60.0]})
+    trace, token = start_trace()
+    try:
+        with span("filter", len(df)) as current:
+            current.rows_out, current.bytes = 2, frame_bytes(df.iloc[:2])
+        with pytest.raises(ValueError):
+            with span("filter", 2):
+                raise ValueError("failed stage")
+    finally:
+        end_trace(token)
+
+    assert [s.name for s in trace.spans] == ["filter", "filter"]
+    assert trace.spans[0].bytes == 32 and trace.spans[0].peak_rss_mb is not None
+    assert trace.server_timing().startswith('filter;dur=') and 'desc="2 spans"' in trace.server_timing()
+    snapshot = fresh_metrics.snapshot()
+    assert snapshot["latency"]["span.filter"]["count"] == 2
+    assert snapshot["spans"]["filter"] == {"rows_in": 5, "rows_out": 2, "bytes": 32}
+    assert instrumentation.current_trace() is None
+
+
+def test_spans_in_worker_threads_join_the_request_trace():
+    trace, token = start_trace()
+    try:
+        def stage():
+            with span("download"):
+                pass
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, stage) for _ in range(3)]
+            for future in futures:
+                future.result()
+    finally:
+        end_trace(token)
+    assert len(trace.spans) == 3
+
+
+def test_cache_hit_rate_and_prometheus(fresh_metrics):
+    fresh_metrics.cache("xpt", True)
+    fresh_metrics.cache("xpt", True)
+    fresh_metrics.cache("xpt", False)
+    fresh_metrics.observe("request./profile", 0.2)
+    assert fresh_metrics.snapshot()["caches"]["xpt"]["hit_rate"] == pytest.approx(2 / 3)
+    text = fresh_metrics.prometheus()
+    assert 'nhanes_cache_lookups_total{cache="xpt",result="miss"} 1' in text
+    assert 'nhanes_latency_seconds_bucket{name="request./profile",le="0.25"} 1' in text
+
+
+def test_log_level_gates_output(capsys):
+    instrumentation.debug("hidden")
+    instrumentation.warning("shown")
+    instrumentation.set_level("DEBUG")
+    assert instrumentation.enabled("DEBUG")
+    with span("merge"):
+        pass
+    instrumentation.set_level("OFF")
+    instrumentation.error("silenced")
+    out = capsys.readouterr().out
+    assert "hidden" not in out and "silenced" not in out
+    assert "WARNING: shown" in out and "DEBUG: span merge" in out
+    with pytest.raises(ValueError):
+        instrumentation.set_level("VERBOSE")
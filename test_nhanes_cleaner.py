@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+from nhanes_cleaner import NHANESDataCleaner
+
+
+def sample_profile():
+    return pd.DataFrame({
+        "SEQN": [1, 2, 3, 4],
+        "RIDAGEYR": [7.0, 9.0, 77.0, 45.0],
+        "DIQ010_1999-2000": [1.0, 7.0, 9.0, 2.0],
+        "DMDMARTL": [1, 77, 99, 5],
+        "NOTES": ["a", "", "b", "c"]
+    })
+
+
+def test_missing_codes_are_per_variable():
+    cleaned = NHANESDataCleaner().clean_data(sample_profile())
+    # Ages are real values, not missing codes.
+    assert cleaned["RIDAGEYR"].tolist() == [7.0, 9.0, 77.0, 45.0]
+    assert cleaned["DIQ010_1999-2000"].isna().tolist() == [False, True, True, False]
+    assert cleaned["DMDMARTL"].isna().tolist() == [False, True, True, False]
+    assert cleaned["NOTES"].isna().tolist() == [False, True, False, False]
+
+
+def test_custom_table_and_default_codes():
+    cleaner = NHANESDataCleaner(missing_codes={"RIDAGEYR": [77]}, default_codes=[9])
+    cleaned = cleaner.clean_data(sample_profile())
+    assert cleaned["RIDAGEYR"].isna().tolist() == [False, False, True, False]
+    assert cleaned["DIQ010_1999-2000"].isna().tolist() == [False, False, True, False]
+
+
+def test_inplace_mode_avoids_copy():
+    df = sample_profile()
+    original = sample_profile()
+
+    NHANESDataCleaner().clean_data(df)
+    pd.testing.assert_frame_equal(df, original)
+
+    result = NHANESDataCleaner(inplace=True).clean_data(df)
+    assert result is df
+    assert pd.isna(df.loc[1, "DIQ010_1999-2000"])
+
+
+def correlated_cohort(rows=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    height = rng.normal(170, 10, rows)
+    df = pd.DataFrame({
+        "SEQN": np.arange(rows),
+        "BMXHT": height,
+        "BMXLEG": height * 0.23 + rng.normal(0, 0.5, rows),
+        "RIDAGEYR": rng.integers(20, 80, rows).astype(float),
+    })
+    truth = df["BMXLEG"].copy()
+    df.loc[df.index % 5 == 0, "BMXLEG"] = np.nan
+    return df, truth
+
+
+def test_frame_imputation_uses_other_columns():
+    df, truth = correlated_cohort()
+    missing = df["BMXLEG"].isna()
+
+    column_mean = NHANESDataCleaner(impute=True, impute_method="mean").clean_data(df)
+    knn = NHANESDataCleaner(impute=True, impute_method="knn", batch_rows=128).clean_data(df)
+
+    assert not knn["BMXLEG"].isna().any()
+    mean_error = (column_mean.loc[missing, "BMXLEG"] - truth[missing]).abs().mean()
+    knn_error = (knn.loc[missing, "BMXLEG"] - truth[missing]).abs().mean()
+    assert knn_error < mean_error / 2, f"KNN ({knn_error:.3f}) should beat mean imputation ({mean_error:.3f})"
+    # SEQN is an identifier, never an imputation feature.
+    assert (knn["SEQN"] == df["SEQN"]).all()
+
+
+def test_frame_imputer_is_fitted_per_call_by_default():
+    df, _ = correlated_cohort()
+    cleaner = NHANESDataCleaner(impute=True, impute_method="knn")
+    cleaner.clean_data(df)
+    assert cleaner.imputer is None, "Without reuse_imputer no imputer is kept between calls."
+    # A later call is imputed from its own rows, not from the first call's cohort.
+    later = cleaner.clean_data(df.tail(50))
+    pd.testing.assert_frame_equal(later, NHANESDataCleaner(impute=True, impute_method="knn").clean_data(df.tail(50)))
+
+
+def test_fitted_imputer_is_reused_across_calls():
+    df, _ = correlated_cohort()
+    cleaner = NHANESDataCleaner(impute=True, impute_method="mice", reuse_imputer=True)
+    cleaner.clean_data(df)
+    fitted = cleaner.imputer
+
+    cleaner.clean_data(df.head(50))
+    assert cleaner.imputer is fitted
+
+    reused = NHANESDataCleaner(impute=True, impute_method="mice", imputer=fitted,
+                               impute_features=cleaner.imputer_features)
+    assert not reused.clean_data(df.tail(50))["BMXLEG"].isna().any()
@@ -0,0 +1,56 @@
+import os
+from nhanes_http import DownloadClient
+from xpt_cache import XPTCache
+
+
+def test_download_streams_to_disk_with_validators(tmp_path, cdc_server):
+    url = cdc_server.add_file("1999", "DEMO", b"x" * 300000)
+    dest = str(tmp_path / "DEMO.XPT")
+
+    result = DownloadClient(chunk_size=4096).download(url, dest)
+
+    assert result.status == "downloaded"
+    assert result.etag and result.last_modified
+    assert os.path.getsize(dest) == 300000
+    assert os.listdir(tmp_path) == ["DEMO.XPT"], "No partial files should be left behind."
+
+
+def test_download_retries_transient_errors(tmp_path, cdc_server):
+    url = cdc_server.add_file("1999", "DEMO", b"demo")
+    cdc_server.fail_next = 2
+
+    result = DownloadClient(retries=3, backoff=0.01).download(url, str(tmp_path / "DEMO.XPT"))
+
+    assert result.status == "downloaded"
+    assert len(cdc_server.requests) == 3
+
+
+def test_download_gives_up_after_bounded_retries(tmp_path, cdc_server):
+    url = cdc_server.add_file("1999", "DEMO", b"demo")
+    cdc_server.fail_next = 10
+    dest = str(tmp_path / "DEMO.XPT")
+
+    result = DownloadClient(retries=2, backoff=0.01).download(url, dest)
+
+    assert result.status == "failed" and result.status_code == 503
+    assert len(cdc_server.requests) == 3
+    assert not os.path.exists(dest)
+
+
+def test_cache_revalidates_with_conditional_get(tmp_path, cdc_server):
+    url = cdc_server.add_file("1999", "DEMO", b"version-1")
+    client = DownloadClient()
+    cache = XPTCache(str(tmp_path / "cache"), revalidate_after=0)
+
+    def download(tmp, validators):
+        return client.download(url, tmp, validators)
+
+    first = cache.fetch("1999-2000", "DEMO", download)
+    second = cache.fetch("1999-2000", "DEMO", download)
+    assert first == second
+    assert cdc_server.requests[1][1].get("If-None-Match"), "Revalidation must be conditional."
+
+    cdc_server.add_file("1999", "DEMO", b"version-2")
+    third = cache.fetch("1999-2000", "DEMO", download)
+    with open(third, "rb") as f:
+        assert f.read() == b"version-2"
@@ -1,6 +1,7 @@
+import time
 import pandas as pd
 import pytest
-from patient_profile_builder import PatientProfileBuilder
+from patient_profile_builder import PatientProfileBuilder, apply_filters, compile_filters, join_tables
 
 class DummyNHANESAPI:
     def list_file_names(self, category, cycle):
@@ -103,3 +104,304 @@ def test_build_profile_multiple_cycles(dummy_api):
     assert expected_bp_2 in cols, f"Expected {expected_bp_2} in columns, got {cols}"
     assert expected_bmx_1 in cols, f"Expected {expected_bmx_1} in columns, got {cols}"
     assert expected_bmx_2 in cols, f"Expected {expected_bmx_2} in columns, got {cols}"
+
+def slow_download(delays):
+    """
+    Returns a download function that sleeps for delays.get(file_desc, 0.2) seconds
+    and returns a small demographics or questionnaire frame.
+    """
+    def download(cycle, file_desc, category):
+        time.sleep(delays.get(file_desc, 0.2))
+        if category == "demographics":
+            return pd.DataFrame({"SEQN": [1, 2], "RIDAGEYR": [30, 40], "RIAGENDR": [1, 2], "RIDRETH1": [3, 4]})
+        return pd.DataFrame({"SEQN": [1, 2], "DIQ010": [1, 2]})
+    return download
+
+def test_build_profile_fetches_cycles_concurrently(tmp_path, monkeypatch):
+    """
+    Twenty 0.2s jobs on a 20-worker pool should finish in roughly one job's time.
+    """
+    monkeypatch.chdir(tmp_path)
+    builder = PatientProfileBuilder(slow_download({}), max_workers=20)
+    selections = {
+        "demographics": {"file": "Demographic Variables & Sample Weights"},
+        "questionnaire": {"file": "Diabetes"}
+    }
+    cycles = [f"{year}-{year + 1}" for year in range(1999, 2019, 2)]
+    start = time.monotonic()
+    df = builder.build_profile(selections, cycles)
+    elapsed = time.monotonic() - start
+    assert elapsed < 1.5, f"Expected concurrent fetches, took {elapsed:.2f}s"
+    assert set(df["cycle"]) == set(cycles)
+
+def test_build_profile_job_timeout_skips_slow_file(tmp_path, monkeypatch):
+    """
+    A questionnaire file that exceeds the per-job timeout is treated as missing.
+    """
+    monkeypatch.chdir(tmp_path)
+    builder = PatientProfileBuilder(slow_download({"Diabetes": 2.0}), timeout=0.5)
+    selections = {
+        "demographics": {"file": "Demographic Variables & Sample Weights"},
+        "questionnaire": {"file": "Diabetes"}
+    }
+    start = time.monotonic()
+    df = builder.build_profile(selections, ["1999-2000"])
+    assert time.monotonic() - start < 1.5
+    assert list(df.columns) == ["SEQN", "cycle", "RIDAGEYR", "RIAGENDR", "RIDRETH1"]
+
+def test_build_profile_reports_per_file_progress(tmp_path, monkeypatch):
+    """
+    Every planned file is reported as queued and then as done or failed.
+    """
+    monkeypatch.chdir(tmp_path)
+    builder = PatientProfileBuilder(slow_download({"Diabetes": 2.0, "Demographic Variables & Sample Weights": 0}), timeout=0.5)
+    selections = {
+        "demographics": {"file": "Demographic Variables & Sample Weights"},
+        "questionnaire": {"file": "Diabetes"}
+    }
+    events = []
+    builder.build_profile(selections, ["1999-2000"], progress=lambda job, status: events.append((job, status)))
+    demographics = ("1999-2000", "demographics", "Demographic Variables & Sample Weights")
+    diabetes = ("1999-2000", "questionnaire", "Diabetes")
+    assert events[:2] == [(demographics, "queued"), (diabetes, "queued")]
+    assert set(events[2:]) == {(demographics, "done"), (diabetes, "failed")}
+
+def demographics_frame():
+    return pd.DataFrame({
+        "SEQN": [1, 2, 3, 4, 5, 6],
+        "RIDAGEYR": [12.0, 25.0, 35.0, 45.0, 65.0, 85.0],
+        "RIAGENDR": [1.0, 2.0, 2.0, 1.0, 2.0, 1.0],
+        "RIDRETH1": [3.0, 3.0, 4.0, 5.0, 3.0, 1.0]
+    })
+
+def test_apply_filters_open_ended_age_range():
+    df = apply_filters(demographics_frame(), {"age": "60+"})
+    assert df["SEQN"].tolist() == [5, 6], "'60+' must select everyone aged 60 and over."
+
+def test_apply_filters_multiple_age_bins_and_sets():
+    filters = {"age": ["10-15", "60+"], "gender": ["Male", "Female"], "race": ["Non-Hispanic White", "Mexican American"]}
+    df = apply_filters(demographics_frame(), filters)
+    assert df["SEQN"].tolist() == [1, 5, 6]
+
+def test_apply_filters_does_not_mutate_input_and_handles_categoricals():
+    source = demographics_frame()
+    source["RIAGENDR"] = source["RIAGENDR"].astype("category")
+    before = source.copy()
+    df = apply_filters(source, {"age_range": {"min": 20, "max": 39}, "gender": "Female"})
+    assert df["SEQN"].tolist() == [2, 3]
+    pd.testing.assert_frame_equal(source, before)
+
+def test_compile_filters_rejects_unknown_labels():
+    with pytest.raises(ValueError):
+        compile_filters({"gender": "Unknown"})
+
+def test_build_profile_pushes_filters_down_before_concat(tmp_path, monkeypatch):
+    """
+    Each cycle is filtered as it loads and questionnaire rows without a surviving
+    SEQN are dropped, so concatenation only ever sees the narrow cohort.
+    """
+    import patient_profile_builder
+    monkeypatch.chdir(tmp_path)
+
+    def download(cycle, file_desc, category):
+        offset = 1000 * int(cycle[:4])
+        if category == "demographics":
+            frame = demographics_frame()
+            frame["SEQN"] += offset
+            return frame
+        return pd.DataFrame({"SEQN": [offset + i for i in range(1, 7)], "DIQ010": [1, 2, 1, 2, 1, 2]})
+
+    concatenated_rows = []
+    real_concat = pd.concat
+
+    def recording_concat(frames, *args, **kwargs):
+        frames = list(frames)
+        concatenated_rows.append(sum(len(f) for f in frames))
+        return real_concat(frames, *args, **kwargs)
+
+    monkeypatch.setattr(patient_profile_builder.pd, "concat", recording_concat)
+    selections = {
+        "demographics": {"file": "Demographic Variables & Sample Weights", "filters": {"age": "60+", "race": "Non-Hispanic White"}},
+        "questionnaire": {"file": "Diabetes"}
+    }
+    df = PatientProfileBuilder(download).build_profile(selections, ["1999-2000", "2001-2002"])
+    assert sorted(df["SEQN"].tolist()) == [1999005, 2001005]
+    assert concatenated_rows[:2] == [2, 2], f"Only surviving rows should be concatenated, got {concatenated_rows}"
+
+def cycle_download(cycle, file_desc, category):
+    """
+    Returns per-cycle frames with cycle-unique SEQNs, like the real NHANES files.
+    """
+    offset = 1000 * int(cycle[:4])
+    if category == "demographics":
+        frame = demographics_frame()
+        frame["SEQN"] += offset
+        return frame
+    return pd.DataFrame({"SEQN": [offset + 1, offset + 2, offset + 3], "DIQ010": [1, 2, 9]})
+
+def test_build_profile_streams_files_with_chunk_transform(tmp_path, monkeypatch):
+    """
+    With chunk_rows the download function receives a per-chunk transform that
+    cleans missing codes and applies the demographic filters.
+    """
+    from nhanes_cleaner import NHANESDataCleaner
+    monkeypatch.chdir(tmp_path)
+    calls = []
+
+    def download(cycle, file_desc, category, chunksize=None, transform=None):
+        calls.append((category, chunksize, transform is not None))
+        frame = cycle_download(cycle, file_desc, category)
+        chunks = [frame.iloc[i:i + chunksize].copy() for i in range(0, len(frame), chunksize)]
+        return pd.concat([transform(chunk) for chunk in chunks], ignore_index=True)
+
+    builder = PatientProfileBuilder(download, chunk_rows=2, cleaner=NHANESDataCleaner())
+    selections = {
+        "demographics": {"file": "Demographic Variables & Sample Weights", "filters": {"age": "20-49"}},
+        "questionnaire": {"file": "Diabetes"}
+    }
+    df = builder.build_profile(selections, ["1999-2000"], join="left")
+    assert sorted(calls) == [("demographics", 2, True), ("questionnaire", 2, True)]
+    assert df["SEQN"].tolist() == [1999002, 1999003, 1999004]
+    assert df["DIQ010"].isna().tolist() == [False, True, True], "Code 9 should be cleaned to missing."
+
+def test_build_profile_long_layout_has_single_variable_column(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    selections = {
+        "demographics": {"file": "Demographic Variables & Sample Weights"},
+        "questionnaire": {"file": "Diabetes"}
+    }
+    df = PatientProfileBuilder(cycle_download).build_profile(selections, ["1999-2000", "2001-2002"])
+    assert list(df.columns) == ["SEQN", "cycle", "RIDAGEYR", "RIAGENDR", "RIDRETH1", "DIQ010"]
+    assert len(df) == 6
+    assert df.groupby("cycle", observed=True).size().tolist() == [3, 3]
+
+def test_build_profile_wide_layout_pivots_on_request(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    selections = {
+        "demographics": {"file": "Demographic Variables & Sample Weights"},
+        "questionnaire": {"file": "Diabetes"}
+    }
+    df = PatientProfileBuilder(cycle_download).build_profile(selections, ["1999-2000", "2001-2002"], layout="wide")
+    assert list(df.columns) == ["SEQN", "RIDAGEYR", "RIAGENDR", "RIDRETH1", "DIQ010_1999-2000", "DIQ010_2001-2002"]
+    row = df[df["SEQN"] == 2001002].iloc[0]
+    assert row["DIQ010_2001-2002"] == 2 and pd.isna(row["DIQ010_1999-2000"])
+
+def test_build_profile_repeated_cycle_is_built_once(tmp_path, monkeypatch):
+    from profile_fragments import FragmentStore
+    monkeypatch.chdir(tmp_path)
+    downloaded = []
+
+    def download(cycle, file_desc, category):
+        downloaded.append(cycle_download(cycle, file_desc, category))
+        return downloaded[-1]
+
+    selections = {
+        "demographics": {"file": "Demographic Variables & Sample Weights"},
+        "questionnaire": {"file": "Diabetes"}
+    }
+    builder = PatientProfileBuilder(download, fragments=FragmentStore())
+    expected = PatientProfileBuilder(cycle_download).build_profile(selections, ["1999-2000"])
+    for _ in range(2):  # fetched, then assembled from fragments
+        df = builder.build_profile(selections, ["1999-2000", "1999-2000"])
+        pd.testing.assert_frame_equal(df, expected)
+    assert len(downloaded) == 2
+    assert all("cycle" not in frame.columns for frame in downloaded), "Downloaded frames must not be mutated."
+
+def test_resolve_file_uses_precompiled_index():
+    from mapping import FILE_INDEX, resolve_file
+    spec = resolve_file("2005-2006", "Laboratory", "Plasma Fasting Glucose & Insulin")
+    assert spec.code == "GLU_D"
+    assert spec.url.endswith("/2005/DataFiles/GLU_D.XPT")
+    assert "LBXGLU" in spec.columns
+    assert resolve_file("9999-9999", "examination", "Blood Pressure") is None
+    assert len(FILE_INDEX) == 10 * 8
+
+def test_plan_jobs_batches_every_category_and_file():
+    from patient_profile_builder import plan_jobs
+    selections = {
+        "examination": ["Blood Pressure", "Body Measures"],
+        "demographics": {"file": "Demographic Variables & Sample Weights", "filters": {"age": "60+"}},
+        "laboratory": "Cholesterol - LDL & Triglycerides"
+    }
+    jobs = plan_jobs(selections, ["1999-2000", "2001-2002"])
+    assert len(jobs) == 8
+    assert [job[1] for job in jobs[:2]] == ["demographics", "demographics"]
+
+def test_build_profile_joins_any_number_of_categories(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    def download(cycle, file_desc, category):
+        if category == "demographics":
+            return cycle_download(cycle, file_desc, category)
+        offset = 1000 * int(cycle[:4])
+        column = file_desc.split()[0].upper()
+        return pd.DataFrame({"SEQN": [offset + 1, offset + 2, offset + 5], column: [1.5, 2.5, 3.5]})
+
+    selections = {
+        "demographics": {"file": "Demographic Variables & Sample Weights", "filters": {"age": "20-99"}},
+        "examination": ["Blood Pressure", "Body Measures"],
+        "laboratory": ["Cholesterol - LDL & Triglycerides"]
+    }
+    df = PatientProfileBuilder(download).build_profile(selections, ["1999-2000", "2001-2002"])
+    assert {"BLOOD", "BODY", "CHOLESTEROL"} <= set(df.columns)
+    assert sorted(df["SEQN"].tolist()) == [1999002, 1999005, 2001002, 2001005]
+
+def test_join_tables_multi_way_inner_and_left():
+    demo = pd.DataFrame({"SEQN": [3, 1, 2], "RIDAGEYR": [30, 10, 20]})
+    exam = pd.DataFrame({"SEQN": [2, 3, 1], "BMXBMI": [22.0, 23.0, 21.0]})
+    lab = pd.DataFrame({"SEQN": [3, 2], "LBXGLU": [93.0, 92.0]})
+
+    inner = join_tables([demo, exam, lab])
+    assert list(inner.columns) == ["SEQN", "RIDAGEYR", "BMXBMI", "LBXGLU"]
+    assert inner["SEQN"].tolist() == [2, 3]
+    assert inner["BMXBMI"].tolist() == [22.0, 23.0]
+
+    left = join_tables([demo, exam, lab], how="left")
+    assert left["SEQN"].tolist() == [1, 2, 3]
+    assert pd.isna(left.loc[0, "LBXGLU"])
+
+def test_join_tables_does_not_chain_merges(monkeypatch):
+    import patient_profile_builder
+    monkeypatch.setattr(patient_profile_builder.pd, "merge", lambda *a, **k: pytest.fail("unexpected merge"))
+    tables = [pd.DataFrame({"SEQN": range(100), f"V{i}": range(100)}) for i in range(5)]
+    assert join_tables(tables).shape == (100, 6)
+
+def test_build_profile_fetches_only_fragments_it_does_not_hold(tmp_path, monkeypatch):
+    """
+    Adding a cycle or a category fetches only the new files, a subset is
+    assembled from stored fragments, and both match a build from scratch.
+    """
+    from profile_fragments import FragmentStore
+    monkeypatch.chdir(tmp_path)
+    fetched = []
+
+    def download(cycle, file_desc, category):
+        fetched.append((cycle, category))
+        if category == "demographics":
+            return cycle_download(cycle, file_desc, category)
+        offset = 1000 * int(cycle[:4])
+        column = file_desc.split()[0].upper()
+        return pd.DataFrame({"SEQN": [offset + 1, offset + 2, offset + 5], column: [1.5, 2.5, 3.5]})
+
+    demographics = {"file": "Demographic Variables & Sample Weights", "filters": {"age": "20-99"}}
+    first = {"demographics": demographics, "examination": ["Blood Pressure"]}
+    wider = {"demographics": demographics, "examination": ["Blood Pressure", "Body Measures"]}
+    builder = PatientProfileBuilder(download, fragments=FragmentStore())
+
+    builder.build_profile(first, ["1999-2000"])
+    fetched.clear()
+    incremental = builder.build_profile(wider, ["1999-2000", "2001-2002"], join="left")
+    assert sorted(fetched) == [("1999-2000", "examination"), ("2001-2002", "demographics"),
+                               ("2001-2002", "examination"), ("2001-2002", "examination")]
+    from_scratch = PatientProfileBuilder(download).build_profile(wider, ["1999-2000", "2001-2002"], join="left")
+    pd.testing.assert_frame_equal(incremental, from_scratch)
+
+    fetched.clear()
+    subset = builder.build_profile(first, ["2001-2002"])
+    assert fetched == [], "A subset of stored fragments needs no fetch."
+    pd.testing.assert_frame_equal(subset, PatientProfileBuilder(download).build_profile(first, ["2001-2002"]))
+
+    builder.build_profile({"demographics": dict(demographics, filters={"age": "60+"})}, ["2001-2002"])
+    assert fetched[-1] == ("2001-2002", "demographics"), "Demographic fragments are keyed by their filters."
+    assert {"cycle": "1999-2000", "category": "examination", "file": "Body Measures", "filters": {},
+            "rows": 3} in builder.fragments.manifest()
@@ -0,0 +1,108 @@
+import os
+import tracemalloc
+import numpy as np
+import pandas as pd
+import pytest
+import profile_artifacts
+from profile_artifacts import create_artifact_store
+
+
+def sample_profile(rows=3):
+    return pd.DataFrame({"SEQN": range(1, rows + 1), "RIDAGEYR": [30.0] * rows})
+
+
+def test_memory_store_assigns_distinct_ids():
+    store = create_artifact_store("memory")
+    first, second = store.put(sample_profile(2)), store.put(sample_profile(3))
+    assert first != second
+    assert len(store.get(first)) == 2 and len(store.get(second)) == 3
+
+
+def test_file_store_is_shared_between_instances(tmp_path, monkeypatch):
+    monkeypatch.setenv("NHANES_ARTIFACT_DIR", str(tmp_path))
+    artifact_id = create_artifact_store("file").put(sample_profile())
+    pd.testing.assert_frame_equal(create_artifact_store("file").get(artifact_id), sample_profile())
+
+
+def test_store_rejects_malformed_ids_and_expires(tmp_path, monkeypatch):
+    monkeypatch.setenv("NHANES_ARTIFACT_DIR", str(tmp_path))
+    monkeypatch.setenv("NHANES_ARTIFACT_TTL", "0")
+    store = create_artifact_store("file")
+    assert store.get("../../etc/passwd") is None
+    artifact_id = store.put(sample_profile())
+    assert store.get(artifact_id) is None
+    store.put(sample_profile())
+    assert not (tmp_path / f"{artifact_id}.pkl").exists(), "Expired artifacts are swept on the next write."
+
+
+def test_store_skips_profiles_over_the_size_limit(monkeypatch):
+    monkeypatch.setenv("NHANES_ARTIFACT_MAX_BYTES", "10")
+    assert create_artifact_store("memory").put(sample_profile()) is None
+
+
+def test_arrow_store_round_trips_dtypes_and_loads_only_requested_columns(tmp_path, monkeypatch):
+    monkeypatch.setenv("NHANES_ARTIFACT_DIR", str(tmp_path))
+    store = create_artifact_store("arrow")
+    df = sample_profile(4)
+    df["RIAGENDR"] = pd.array([1, 2, None, 1], dtype="Int8")
+    df["cycle"] = pd.Categorical(["2015-2016", "2017-2018", "2015-2016", "2017-2018"])
+    artifact_id = store.put(df)
+    assert (tmp_path / f"{artifact_id}.arrow").exists()
+
+    pd.testing.assert_frame_equal(store.get(artifact_id), df)
+    schema = store.peek(artifact_id)
+    assert len(schema) == 0 and list(schema.columns) == list(df.columns)
+    assert schema["RIAGENDR"].dtype == "Int8"
+    assert list(store.get(artifact_id, columns=["SEQN", "cycle"]).columns) == ["SEQN", "cycle"]
+
+
+def test_arrow_store_maps_columns_without_copying(tmp_path, monkeypatch):
+    monkeypatch.setenv("NHANES_ARTIFACT_DIR", str(tmp_path))
+    rows = 500_000
+    df = pd.DataFrame({"SEQN": np.arange(rows), "RIDAGEYR": np.arange(rows) % 85.0, "BPXSY1": np.linspace(90, 180, rows)})
+    arrow_store, pickle_store = create_artifact_store("arrow"), create_artifact_store("file")
+    arrow_id, pickle_id = arrow_store.put(df), pickle_store.put(df)
+
+    def peak_bytes(store, artifact_id):
+        tracemalloc.start()
+        try:
+            loaded = store.get(artifact_id, columns=["RIDAGEYR", "BPXSY1"])
+            return tracemalloc.get_traced_memory()[1], loaded
+        finally:
+            tracemalloc.stop()
+
+    mapped_peak, mapped = peak_bytes(arrow_store, arrow_id)
+    pickled_peak, _ = peak_bytes(pickle_store, pickle_id)
+    np.testing.assert_array_equal(mapped["BPXSY1"].to_numpy(), df["BPXSY1"].to_numpy())
+    assert mapped_peak < 1024 ** 2 < pickled_peak, "Memory-mapped columns must not be copied into the process."
+
+
+def test_file_stores_refuse_directories_others_control(tmp_path, monkeypatch):
+    assert profile_artifacts.default_artifact_dir().endswith(f"nhanes_artifacts-{os.getuid()}")
+    private = tmp_path / "private"
+    monkeypatch.setenv("NHANES_ARTIFACT_DIR", str(private))
+    create_artifact_store("file")
+    assert oct(private.stat().st_mode & 0o777) == oct(0o700)
+
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    shared.chmod(0o777)
+    linked = tmp_path / "linked"
+    linked.symlink_to(private)
+    for path in (shared, linked):
+        monkeypatch.setenv("NHANES_ARTIFACT_DIR", str(path))
+        with pytest.raises(PermissionError):
+            create_artifact_store("arrow")
+    monkeypatch.setenv("NHANES_ARTIFACT_DIR", str(private))
+    monkeypatch.setattr(os, "getuid", lambda: os.stat(private).st_uid + 1)
+    with pytest.raises(PermissionError):
+        create_artifact_store("file")
+
+
+def test_without_pyarrow_artifacts_never_fall_back_to_pickles(monkeypatch):
+    from profile_cache import MemoryResultCache
+    monkeypatch.setattr(profile_artifacts, "pa", None)
+    monkeypatch.delenv("NHANES_ARTIFACT_STORE", raising=False)
+    assert isinstance(create_artifact_store().backend, MemoryResultCache)
+    with pytest.raises(ValueError):
+        create_artifact_store("arrow")
@@ -0,0 +1,111 @@
+import os
+import time
+import pandas as pd
+import pytest
+from profile_cache import FileResultCache, MemoryResultCache, cached_build, create_result_cache, payload_key
+
+
+def sample_profile(rows=3):
+    return pd.DataFrame({"SEQN": range(1, rows + 1), "RIDAGEYR": [30.0] * rows})
+
+
+class CountingBuilder:
+    def __init__(self):
+        self.calls = 0
+
+    def build_profile(self, selections, cycles):
+        self.calls += 1
+        return sample_profile()
+
+
+def test_payload_key_ignores_ordering_and_duplicates():
+    a = payload_key(
+        {"demographics": {"file": "Demographic Variables & Sample Weights", "filters": {"gender": ["Male", "Female"], "age": "20-39"}}},
+        ["2001-2002", "1999-2000"])
+    b = payload_key(
+        {"demographics": {"filters": {"age": "20-39", "gender": ["Female", "Male", "Male"]}, "file": "Demographic Variables & Sample Weights"}},
+        ["1999-2000", "2001-2002"])
+    c = payload_key(
+        {"demographics": {"file": "Demographic Variables & Sample Weights", "filters": {"gender": ["Female"], "age": "20-39"}}},
+        ["1999-2000", "2001-2002"])
+    assert a == b
+    assert a != c, "Different filters must produce different keys."
+
+
+def test_memory_cache_ttl_and_version():
+    cache = MemoryResultCache(ttl=0.05)
+    cache.put("k", sample_profile(), version="v1")
+    assert cache.get("k", version="v1") is not None
+    assert cache.get("k", version="v2") is None, "A changed source version must invalidate the entry."
+
+    cache.put("k", sample_profile(), version="v1")
+    time.sleep(0.1)
+    assert cache.get("k", version="v1") is None
+
+
+def test_memory_cache_size_eviction():
+    df = sample_profile(1000)
+    size = int(df.memory_usage(deep=True).sum())
+    cache = MemoryResultCache(max_bytes=size * 2)
+    for key in ("a", "b", "c"):
+        cache.put(key, df)
+    assert cache.get("a") is None
+    assert cache.get("b") is not None and cache.get("c") is not None
+
+
+def test_file_cache_roundtrip_and_version(tmp_path):
+    cache = FileResultCache(str(tmp_path), ttl=60)
+    cache.put("k", sample_profile(), version="v1")
+    pd.testing.assert_frame_equal(FileResultCache(str(tmp_path)).get("k", version="v1"), sample_profile())
+    assert cache.get("k", version="v2") is None
+    assert cache.get("k", version="v1") is None, "Stale entries are removed from disk."
+
+
+@pytest.mark.parametrize("cache_factory", [lambda tmp: MemoryResultCache(), lambda tmp: FileResultCache(str(tmp))])
+def test_cached_build_builds_once(tmp_path, cache_factory):
+    cache = cache_factory(tmp_path)
+    builder = CountingBuilder()
+    selections = {"demographics": {"file": "Demographic Variables & Sample Weights"}}
+    for _ in range(3):
+        cached_build(cache, builder, selections, ["1999-2000"], lambda selections, cycles: "v1")
+    assert builder.calls == 1
+
+
+def test_cached_build_survives_downloads_of_other_files(tmp_path):
+    from mapping import resolve_file
+    from profile_fragments import plan_version
+    from xpt_cache import XPTCache
+
+    def blob(name, content):
+        path = tmp_path / name
+        path.write_bytes(content)
+        return str(path)
+
+    source = XPTCache(str(tmp_path / "xpt"))
+    demographics = resolve_file("1999-2000", "demographics", "Demographic Variables & Sample Weights").code
+    diabetes = resolve_file("1999-2000", "questionnaire", "Diabetes").code
+    source.put("1999-2000", demographics, blob("a", b"demo"))
+    cache, builder = MemoryResultCache(), CountingBuilder()
+    selections = {"demographics": {"file": "Demographic Variables & Sample Weights"}}
+    for _ in range(2):
+        cached_build(cache, builder, selections, ["1999-2000"], plan_version(source))
+    source.put("1999-2000", diabetes, blob("b", b"diabetes"))
+    cached_build(cache, builder, selections, ["1999-2000"], plan_version(source))
+    assert builder.calls == 1, "A file the profile does not read must not invalidate it."
+    source.put("1999-2000", demographics, blob("c", b"replaced"))
+    cached_build(cache, builder, selections, ["1999-2000"], plan_version(source))
+    assert builder.calls == 2
+
+
+def test_file_result_cache_refuses_shared_directories(tmp_path, monkeypatch):
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    shared.chmod(0o777)
+    monkeypatch.setenv("NHANES_RESULT_CACHE_DIR", str(shared))
+    with pytest.raises(PermissionError):
+        create_result_cache("file")
+
+    private = tmp_path / "private"
+    monkeypatch.setenv("NHANES_RESULT_CACHE_DIR", str(private))
+    create_result_cache("file")
+    assert oct(os.stat(private).st_mode & 0o777) == oct(0o700)
@@ -0,0 +1,66 @@
+import json
+import struct
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import response_encoding
+from response_encoding import encode_arrow, encode_json, encode_typed_arrays, frame_to_arrow, frame_to_json
+
+
+def points_payload():
+    return {
+        "mode": "points",
+        "metricName": "BPXSY1",
+        "age": np.array([25.0, np.nan, 60.0]),
+        "healthMetric": np.array([120.5, 130.0, np.nan]),
+        "labels": np.array([1, 2, 3]),
+        "sampled": False,
+    }
+
+
+def decode_typed_arrays(body):
+    (length,) = struct.unpack("<I", body[:4])
+    header = json.loads(body[4:4 + length])
+    start = 4 + length
+    assert start % 8 == 0, "Buffers must be 8-byte aligned for typed array views."
+    columns = {}
+    for column in header["columns"]:
+        if column["dtype"] == "string":
+            columns[column["name"]] = column["values"]
+        else:
+            offset = start + column["offset"]
+            columns[column["name"]] = np.frombuffer(body, dtype=column["dtype"], count=column["length"], offset=offset)
+    return header["meta"], columns
+
+
+def test_json_maps_nan_to_null_with_and_without_orjson(monkeypatch):
+    expected = {"mode": "points", "metricName": "BPXSY1", "age": [25.0, None, 60.0],
+                "healthMetric": [120.5, 130.0, None], "labels": [1, 2, 3], "sampled": False}
+    assert json.loads(encode_json(points_payload())) == expected
+    monkeypatch.setattr(response_encoding, "orjson", None)
+    assert json.loads(encode_json(points_payload())) == expected
+
+
+def test_typed_arrays_roundtrip():
+    meta, columns = decode_typed_arrays(encode_typed_arrays(points_payload()))
+    assert meta == {"mode": "points", "metricName": "BPXSY1", "sampled": False}
+    np.testing.assert_array_equal(columns["age"], [25.0, np.nan, 60.0])
+    np.testing.assert_array_equal(columns["labels"], [1, 2, 3])
+
+
+def test_typed_arrays_expand_records_and_keep_strings():
+    payload = {"groups": [{"age_band": "20-29", "count": 2, "mean": 110.0},
+                          {"age_band": "80+", "count": 1, "mean": None}]}
+    _, columns = decode_typed_arrays(encode_typed_arrays(payload))
+    assert columns["groups.age_band"] == ["20-29", "80+"]
+    np.testing.assert_array_equal(columns["groups.mean"], [110.0, np.nan])
+
+
+def test_arrow_payload_and_frame():
+    table = pa.ipc.open_stream(encode_arrow(points_payload())).read_all()
+    assert table.column("age").to_pylist() == [25.0, None, 60.0]
+    assert json.loads(table.schema.metadata[b"nhanes"])["metricName"] == "BPXSY1"
+
+    df = pd.DataFrame({"SEQN": [1, 2], "DIQ010": pd.array([1, None], dtype="Int8"), "cycle": ["1999-2000"] * 2})
+    pd.testing.assert_frame_equal(pa.ipc.open_stream(frame_to_arrow(df)).read_pandas(), df, check_dtype=False)
+    assert json.loads(frame_to_json(df))["data"]["DIQ010"] == [1.0, None]
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+from survey_stats import combine_weights, statistics_payload, survey_estimates
+
+
+def design_frame(rows=4000, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "SEQN": np.arange(1, rows + 1),
+        "cycle": np.where(rng.random(rows) < 0.5, "2003-2004", "2005-2006"),
+        "RIDAGEYR": rng.integers(0, 86, rows).astype(float),
+        "RIAGENDR": rng.integers(1, 3, rows).astype(float),
+        "WTMEC2YR": rng.uniform(1000, 50000, rows),
+        "SDMVSTRA": rng.integers(1, 10, rows).astype(float),
+        "SDMVPSU": rng.integers(1, 3, rows).astype(float),
+        "BPXSY1": rng.normal(120, 15, rows),
+        "DIQ010": rng.integers(1, 3, rows).astype(float),
+    })
+    df.loc[rng.random(rows) < 0.1, "BPXSY1"] = np.nan
+    return df
+
+
+def reference_estimate(df, weights, domain, y):
+    """
+    Per-domain, per-stratum loop implementation of the linearized ratio variance.
+    """
+    use = domain & ~np.isnan(y)
+    total = weights[use].sum()
+    estimate = (weights[use] * y[use]).sum() / total
+    scores = np.where(use, weights * (np.nan_to_num(y) - estimate) / total, 0.0)
+    variance = 0.0
+    for _, stratum in df.groupby("SDMVSTRA"):
+        psu_totals = pd.Series(scores[stratum.index]).groupby(stratum["SDMVPSU"].to_numpy()).sum().to_numpy()
+        if len(psu_totals) > 1:
+            variance += len(psu_totals) / (len(psu_totals) - 1) * ((psu_totals - psu_totals.mean()) ** 2).sum()
+    return estimate, np.sqrt(variance)
+
+
+def test_estimates_match_per_group_reference():
+    df = design_frame()
+    result = survey_estimates(df, variables=["BPXSY1"], proportions=["DIQ010"], by=["gender"])
+    weights = df["WTMEC2YR"].to_numpy() / 2
+    for gender, code in (("Female", 2), ("Male", 1)):
+        domain = (df["RIAGENDR"] == code).to_numpy()
+        row = result[(result["gender"] == gender) & (result["variable"] == "BPXSY1")].iloc[0]
+        estimate, se = reference_estimate(df, weights, domain, df["BPXSY1"].to_numpy())
+        assert row["estimate"] == pytest.approx(estimate) and row["se"] == pytest.approx(se)
+
+        row = result[(result["gender"] == gender) & (result["variable"] == "DIQ010=2")].iloc[0]
+        estimate, se = reference_estimate(df, weights, domain, (df["DIQ010"] == 2).astype(float).to_numpy())
+        assert row["estimate"] == pytest.approx(estimate) and row["se"] == pytest.approx(se)
+
+
+def test_proportion_levels_sum_to_one_per_group():
+    result = survey_estimates(design_frame(), proportions=["DIQ010"], by=["gender", "age_band"])
+    totals = result.groupby(["gender", "age_band"])["estimate"].sum()
+    np.testing.assert_allclose(totals, 1.0)
+    assert (result["ci_low"] <= result["estimate"]).all()
+
+
+def test_combine_weights_uses_four_year_weights_for_1999_2002():
+    df = pd.DataFrame({
+        "cycle": ["1999-2000", "2001-2002", "2003-2004"],
+        "WTMEC2YR": [10.0, 20.0, 30.0],
+        "WTMEC4YR": [5.0, 12.0, np.nan],
+    })
+    np.testing.assert_allclose(combine_weights(df), [5.0 * 2 / 3, 12.0 * 2 / 3, 30.0 / 3])
+    np.testing.assert_allclose(combine_weights(df.iloc[1:]), [10.0, 15.0])
+    np.testing.assert_allclose(combine_weights(df.iloc[:1]), [10.0])
+
+
+def test_statistics_payload_validates_request():
+    df = design_frame(200)
+    payload = statistics_payload(df, {"variables": "BPXSY1", "by": "cycle"})
+    assert {row["cycle"] for row in payload["rows"]} == {"2003-2004", "2005-2006"}
+    with pytest.raises(ValueError):
+        statistics_payload(df, {})
+    with pytest.raises(ValueError):
+        statistics_payload(df, {"variables": "BPXSY1", "weight": "SEQN"})
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+from visualization import (age_bands, group_stats, hex_counts, histogram, pick_metric, sample_rows,
+                           visualization_columns, visualization_payload)
+
+
+def cohort(rows=50000):
+    rng = np.random.default_rng(1)
+    return pd.DataFrame({
+        "SEQN": np.arange(1, rows + 1),
+        "cycle": pd.Categorical(np.where(np.arange(rows) % 4 == 0, "1999-2000", "2001-2002")),
+        "RIDAGEYR": rng.integers(0, 86, rows).astype(float),
+        "BPXSY1": rng.normal(120, 15, rows),
+    })
+
+
+def test_points_payload_is_capped_regardless_of_cohort_size():
+    payload = visualization_payload(cohort(), {"max_points": "1000000"})
+    assert payload["total"] == 50000 and payload["sampled"]
+    assert len(payload["age"]) == len(payload["healthMetric"]) == len(payload["labels"]) == 20000
+    assert payload["metricName"] == "BPXSY1"
+
+
+def test_stratified_sample_keeps_group_proportions():
+    df = cohort(10000)
+    sample = sample_rows(df, 1000, stratify="cycle")
+    assert len(sample) <= 1000
+    share = (sample["cycle"] == "1999-2000").mean()
+    assert abs(share - 0.25) < 0.01
+    assert sample.index.is_monotonic_increasing
+
+
+def test_histogram_and_hex_counts_cover_every_finite_point():
+    values = np.array([1.0, 2.0, np.nan, 3.0])
+    assert sum(histogram(values, bins=3)["counts"]) == 3
+    df = cohort(5000)
+    hexes = hex_counts(df["RIDAGEYR"].to_numpy(), df["BPXSY1"].to_numpy(), gridsize=10)
+    assert sum(hexes["counts"]) == 5000
+    assert len(hexes["x"]) <= 2 * 11 * 6 + 2
+
+
+def test_group_stats_per_age_band_and_cycle():
+    df = pd.DataFrame({
+        "RIDAGEYR": [25.0, 27.0, 85.0, 85.0],
+        "cycle": ["1999-2000"] * 4,
+        "BPXSY1": [100.0, 120.0, 140.0, np.nan],
+    })
+    groups = {g["age_band"]: g for g in group_stats(df, "BPXSY1")}
+    assert groups["20-29"]["count"] == 2 and groups["20-29"]["mean"] == 110.0
+    assert groups["20-29"]["q50"] == 110.0
+    assert groups["80+"]["count"] == 1
+    assert list(age_bands(np.array([19.0, 80.0]))) == ["0-19", "80+"]
+
+
+def test_invalid_parameters_raise_value_error():
+    with pytest.raises(ValueError):
+        visualization_payload(cohort(10), {"mode": "pie"})
+    with pytest.raises(ValueError):
+        visualization_payload(cohort(10), {"bins": "-3", "mode": "histogram"})
+    with pytest.raises(ValueError):
+        visualization_payload(cohort(10), {"metric": "MISSING"})
+
+
+def test_visualization_columns_select_what_the_payload_reads():
+    df = cohort(100).assign(RIAGENDR=1.0, BMXWT=70.0)
+    columns = visualization_columns(df.iloc[0:0], {"mode": "stats"})
+    assert columns == ["SEQN", "cycle", "RIDAGEYR", "BPXSY1"]
+    assert visualization_payload(df[columns], {"mode": "stats"}) == visualization_payload(df, {"mode": "stats"})
+    assert "RIAGENDR" in visualization_columns(df.iloc[0:0], {"stratify": "RIAGENDR"})
+
+
+def test_default_metric_skips_design_columns_and_prefers_body_measures():
+    df = pd.DataFrame({"SEQN": [1.0], "RIDAGEYR": [40.0], "WTINT2YR": [1.0], "WTMEC2YR": [1.0],
+                       "SDMVPSU": [1.0], "SDMVSTRA": [1.0], "ALQ130": [2.0], "BMXBMI": [25.0]})
+    assert pick_metric(df) == "BMXBMI"
+    assert pick_metric(df.drop(columns=["BMXBMI"])) == "ALQ130"
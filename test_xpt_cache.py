@@ -0,0 +1,222 @@
+import os
+import numpy as np
+import pandas as pd
+import pyreadstat
+import pytest
+import patient_profile_builder
+import xpt_cache
+from xpt_cache import CacheMissError, XPTCache, columnar_path, read_xpt
+
+
+def write_blob(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def write_demo_xpt(path):
+    df = pd.DataFrame({
+        "SEQN": [1.0, 2.0, 3.0],
+        "RIDAGEYR": [25.0, 35.0, 65.0],
+        "RIAGENDR": [1.0, 2.0, 2.0],
+        "RIDRETH1": [3.0, 3.0, 4.0],
+        "WTINT2YR": [1000.0, 2000.0, 3000.0],
+        "DMDEDUC2": [3.0, 4.0, 5.0],
+    })
+    pyreadstat.write_xport(df, path, file_format_version=5)
+
+
+def test_put_and_get_roundtrip(tmp_path):
+    cache = XPTCache(str(tmp_path / "cache"), max_bytes=1024)
+    src = write_blob(tmp_path, "a.part", b"demo-bytes")
+    cached = cache.put("1999-2000", "DEMO", src)
+
+    assert not os.path.exists(src), "Source file should be moved into the cache."
+    assert cache.get("1999-2000", "DEMO") == cached
+    # A fresh instance over the same directory sees the persisted index.
+    assert XPTCache(str(tmp_path / "cache")).get("1999-2000", "DEMO") == cached
+
+
+
+def test_file_fingerprint_changes_only_with_that_file(tmp_path):
+    cache = XPTCache(str(tmp_path / "cache"))
+    cache.put("1999-2000", "DEMO", write_blob(tmp_path, "a", b"demo"))
+    before = cache.fingerprint("1999-2000", "DEMO")
+    cache.put("1999-2000", "DEMO_X", write_blob(tmp_path, "b", b"other"))
+    assert cache.fingerprint("1999-2000", "DEMO") == before
+    assert cache.fingerprint("1999-2000") != XPTCache(str(tmp_path / "empty")).fingerprint("1999-2000")
+    cache.put("1999-2000", "DEMO", write_blob(tmp_path, "c", b"replaced"))
+    assert cache.fingerprint("1999-2000", "DEMO") != before
+
+def test_processes_sharing_a_directory_merge_their_index(tmp_path):
+    first, second = XPTCache(str(tmp_path / "cache"), max_bytes=25), XPTCache(str(tmp_path / "cache"), max_bytes=25)
+    first.put("1999-2000", "DEMO", write_blob(tmp_path, "a", b"a" * 10))
+    second.put("2001-2002", "DEMO_B", write_blob(tmp_path, "b", b"b" * 10))
+    assert first.get("2001-2002", "DEMO_B") is not None, "Entries written by another process are seen."
+    assert first.total_bytes() == second.total_bytes() == 20
+
+    first.put("2003-2004", "DEMO_C", write_blob(tmp_path, "c", b"c" * 10))
+    assert second.total_bytes() <= 25, "Eviction counts the other process's entries."
+    assert len(os.listdir(tmp_path / "cache" / "objects")) == 2
+
+
+def test_cache_hits_batch_last_access_writes(tmp_path, monkeypatch):
+    cache = XPTCache(str(tmp_path / "cache"))
+    cache.put("1999-2000", "DEMO", write_blob(tmp_path, "a", b"demo"))
+    written = os.stat(cache.index_path).st_mtime_ns, os.stat(cache.index_path).st_ino
+    for _ in range(5):
+        assert cache.get("1999-2000", "DEMO") is not None
+    assert (os.stat(cache.index_path).st_mtime_ns, os.stat(cache.index_path).st_ino) == written
+    accessed = cache._index["1999-2000/DEMO"]["last_access"]
+    cache.flush()
+    assert XPTCache(str(tmp_path / "cache"))._index["1999-2000/DEMO"]["last_access"] == accessed
+
+    monkeypatch.setattr(xpt_cache, "ACCESS_FLUSH_INTERVAL", 0)
+    cache.get("1999-2000", "DEMO")
+    assert XPTCache(str(tmp_path / "cache"))._index["1999-2000/DEMO"]["last_access"] > accessed
+
+
+def test_lru_eviction_respects_size_cap(tmp_path):
+    cache = XPTCache(str(tmp_path / "cache"), max_bytes=20)
+    cache.put("1999-2000", "DEMO", write_blob(tmp_path, "a", b"a" * 10))
+    cache.put("2001-2002", "DEMO_B", write_blob(tmp_path, "b", b"b" * 10))
+    cache.get("1999-2000", "DEMO")  # DEMO is now the most recently used
+    cache.put("2003-2004", "DEMO_C", write_blob(tmp_path, "c", b"c" * 10))
+
+    assert cache.get("2001-2002", "DEMO_B") is None
+    assert cache.get("1999-2000", "DEMO") is not None
+    assert cache.total_bytes() <= 20
+
+
+def test_checksum_mismatch_drops_entry(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    path = XPTCache(cache_dir).put("1999-2000", "DEMO", write_blob(tmp_path, "a", b"original"))
+    with open(path, "wb") as f:
+        f.write(b"tampered")
+
+    assert XPTCache(cache_dir).get("1999-2000", "DEMO") is None
+
+
+def test_offline_mode_serves_only_from_cache(tmp_path):
+    cache = XPTCache(str(tmp_path / "cache"), offline=True)
+    with pytest.raises(CacheMissError):
+        cache.fetch("1999-2000", "DEMO", lambda tmp: pytest.fail("offline mode must not download"))
+
+
+def test_download_nhanes_file_reuses_cached_xpt(tmp_path, cdc_server):
+    xpt_path = str(tmp_path / "DEMO.XPT")
+    write_demo_xpt(xpt_path)
+    with open(xpt_path, "rb") as f:
+        cdc_server.add_file("1999", "DEMO", f.read())
+    cache = XPTCache(str(tmp_path / "cache"))
+
+    first = patient_profile_builder.download_nhanes_file(
+        "1999-2000", "Demographic Variables & Sample Weights", "demographics", cache=cache)
+    second = patient_profile_builder.download_nhanes_file(
+        "1999-2000", "Demographic Variables & Sample Weights", "demographics", cache=cache)
+
+    assert len(cdc_server.requests) == 1, "Second build should be served from the cache."
+    pd.testing.assert_frame_equal(first, second)
+    assert list(first.columns) == ["SEQN", "RIDAGEYR", "RIAGENDR", "RIDRETH1", "WTINT2YR"]
+
+
+def test_read_xpt_converts_once_and_projects_columns(tmp_path, monkeypatch):
+    pytest.importorskip("pyarrow")
+    xpt_path = str(tmp_path / "DEMO.XPT")
+    write_demo_xpt(xpt_path)
+
+    full = read_xpt(xpt_path)
+    assert os.path.exists(columnar_path(xpt_path)), "Columnar copy should be written on first read."
+    assert "WTINT2YR" in full.columns, "Columnar copy should keep every column."
+
+    def no_sas(*args, **kwargs):
+        raise AssertionError("XPT should not be re-parsed once a columnar copy exists")
+
+    monkeypatch.setattr(xpt_cache.pd, "read_sas", no_sas)
+    df = read_xpt(xpt_path, columns=["SEQN", "RIDAGEYR", "NOT_A_COLUMN"])
+    assert list(df.columns) == ["SEQN", "RIDAGEYR"]
+    assert df["RIDAGEYR"].tolist() == [25.0, 35.0, 65.0]
+
+
+def test_dropping_entry_removes_columnar_copy(tmp_path):
+    pytest.importorskip("pyarrow")
+    cache = XPTCache(str(tmp_path / "cache"), max_bytes=10 ** 6)
+    src = str(tmp_path / "DEMO.part")
+    write_demo_xpt(src)
+    path = cache.put("1999-2000", "DEMO", src)
+    read_xpt(path)
+
+    cache._drop(cache.key("1999-2000", "DEMO"))
+    assert not os.path.exists(path)
+    assert not os.path.exists(columnar_path(path))
+
+
+def test_columnar_copies_count_towards_the_size_cap(tmp_path):
+    pytest.importorskip("pyarrow")
+    cache = XPTCache(str(tmp_path / "cache"), max_bytes=10 ** 6)
+    paths = []
+    for cycle in ("1999-2000", "2001-2002"):
+        src = str(tmp_path / f"{cycle}.part")
+        write_demo_xpt(src)
+        paths.append(cache.put(cycle, "DEMO", src))
+    # Both cycles hold the same bytes, so they share one object and one Parquet copy.
+    read_xpt(paths[0])
+    cache.record_columnar("1999-2000", "DEMO")
+    xpt_bytes = os.path.getsize(paths[0])
+    assert cache.total_bytes() == xpt_bytes + os.path.getsize(columnar_path(paths[0]))
+
+    cache.max_bytes = xpt_bytes * 2
+    src = str(tmp_path / "other.part")
+    write_wide_xpt(src, 5)
+    cache.put("2003-2004", "LAB", src)
+    assert cache.get("1999-2000", "DEMO") is None, "The Parquet copy must push the cache over its cap."
+    assert not os.path.exists(columnar_path(paths[0]))
+
+
+def write_wide_xpt(path, rows, width=30):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({"SEQN": np.arange(1, rows + 1, dtype=float), "RIDAGEYR": rng.integers(0, 86, rows).astype(float)})
+    for i in range(width):
+        df[f"LBX{i:03d}"] = rng.normal(size=rows)
+    pyreadstat.write_xport(df, path, file_format_version=5)
+    return df
+
+
+def test_chunked_read_matches_full_read_and_writes_columnar_copy(tmp_path, monkeypatch):
+    pytest.importorskip("pyarrow")
+    xpt_path = str(tmp_path / "LAB.XPT")
+    source = write_wide_xpt(xpt_path, 2500)
+    seniors = lambda chunk: chunk[chunk["RIDAGEYR"] >= 60]
+
+    df = read_xpt(xpt_path, columns=["SEQN", "RIDAGEYR", "LBX001"], chunksize=1000, transform=seniors)
+    expected = source.loc[source["RIDAGEYR"] >= 60, ["SEQN", "RIDAGEYR", "LBX001"]].reset_index(drop=True)
+    pd.testing.assert_frame_equal(df, expected)
+    assert os.path.exists(columnar_path(xpt_path)), "Streaming should leave a columnar copy behind."
+
+    def no_sas(*args, **kwargs):
+        raise AssertionError("XPT should not be re-parsed once a columnar copy exists")
+
+    monkeypatch.setattr(xpt_cache.pd, "read_sas", no_sas)
+    again = read_xpt(xpt_path, columns=["SEQN", "RIDAGEYR", "LBX001"], chunksize=1000, transform=seniors)
+    pd.testing.assert_frame_equal(again, expected)
+    assert read_xpt(xpt_path, columns=["SEQN"], chunksize=1000, transform=lambda c: c.iloc[0:0]).empty
+
+
+def test_chunked_read_peak_memory_follows_output(tmp_path, monkeypatch):
+    import tracemalloc
+    monkeypatch.setattr(xpt_cache, "pq", None)
+    xpt_path = str(tmp_path / "LAB.XPT")
+    write_wide_xpt(xpt_path, 40000)
+    keep_few = lambda chunk: chunk[chunk["SEQN"] % 100 == 0]
+
+    def peak(read):
+        tracemalloc.start()
+        try:
+            read()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    full = peak(lambda: keep_few(read_xpt(xpt_path)))
+    chunked = peak(lambda: read_xpt(xpt_path, chunksize=2000, transform=keep_few))
+    assert chunked < full / 4, f"Chunked peak {chunked} should be far below full-file peak {full}"
@@ -0,0 +1,242 @@
+import numpy as np
+import pandas as pd
+
+DEFAULT_MAX_POINTS = 5000
+MAX_POINTS = 20000
+MAX_BINS = 200
+MAX_GRIDSIZE = 100
+DEFAULT_AGE_BANDS = [0, 20, 30, 40, 50, 60, 70, 80]
+DEFAULT_QUANTILES = (0.25, 0.5, 0.75)
+
+AGE_COLUMN = "RIDAGEYR"
+# Columns never picked as the default health metric: identifiers, demographics
+# and the survey design (sample weights, strata and PSUs).
+NON_METRIC_COLUMNS = {
+    "SEQN", "cycle", "RIDAGEYR", "RIAGENDR", "RIDRETH1", "RIDRETH3",
+    "WTINT2YR", "WTMEC2YR", "WTINT4YR", "WTMEC4YR", "SDMVPSU", "SDMVSTRA",
+}
+
+MODES = ("points", "histogram", "grid", "hex", "stats")
+
+
+def numeric_values(series):
+    """
+    Returns a Series as a float64 array with missing values as NaN (nullable
+    integer and categorical columns included).
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        series = series.astype(series.cat.categories.dtype)
+    return pd.to_numeric(series, errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def pick_metric(df, metric=None):
+    """
+    Returns the health metric column to plot: metric when given, otherwise the
+    first diabetes / blood pressure / body measure column, otherwise the first
+    numeric non-demographic column.
+    """
+    if metric:
+        if metric not in df.columns:
+            raise ValueError(f"Metric column {metric} not found in data.")
+        return metric
+    for col in df.columns:
+        if col.startswith('DIQ010') or col.startswith('BPX') or col.startswith('BMX'):
+            return col
+    for col in df.columns:
+        if col not in NON_METRIC_COLUMNS and pd.api.types.is_numeric_dtype(df[col]):
+            return col
+    raise ValueError("Health metric column not found in data.")
+
+
+def age_bands(ages, edges=DEFAULT_AGE_BANDS):
+    """
+    Returns the age band label ("20-29", "80+") of every age, NaN when missing.
+    """
+    edges = list(edges)
+    labels = [f"{low}-{high - 1}" for low, high in zip(edges[:-1], edges[1:])] + [f"{edges[-1]}+"]
+    return pd.cut(ages, bins=edges + [np.inf], right=False, labels=labels)
+
+
+def histogram(values, bins=20):
+    """
+    Returns {"edges", "counts"} of a histogram of the finite values.
+    """
+    values = values[np.isfinite(values)]
+    counts, edges = np.histogram(values, bins=bins)
+    return {"edges": edges.tolist(), "counts": counts.tolist()}
+
+
+def grid_counts(x, y, bins=20):
+    """
+    Returns rectangular 2-D bin counts of the points with both coordinates present.
+    """
+    keep = np.isfinite(x) & np.isfinite(y)
+    counts, x_edges, y_edges = np.histogram2d(x[keep], y[keep], bins=bins)
+    return {"x_edges": x_edges.tolist(), "y_edges": y_edges.tolist(), "counts": counts.astype(int).tolist()}
+
+
+def hex_counts(x, y, gridsize=20):
+    """
+    Returns the centers and counts of the non-empty hexagonal bins, gridsize
+    hexagons across the x range (the same lattice as matplotlib's hexbin).
+    """
+    keep = np.isfinite(x) & np.isfinite(y)
+    x, y = x[keep], y[keep]
+    if not len(x):
+        return {"x": [], "y": [], "counts": [], "size": [0.0, 0.0]}
+    nx = gridsize
+    ny = max(int(gridsize / np.sqrt(3)), 1)
+    xmin, xmax, ymin, ymax = x.min(), x.max(), y.min(), y.max()
+    sx = (xmax - xmin) / nx or 1.0
+    sy = (ymax - ymin) / ny or 1.0
+    ix, iy = (x - xmin) / sx, (y - ymin) / sy
+
+    ix1, iy1 = np.round(ix), np.round(iy)
+    ix2, iy2 = np.floor(ix), np.floor(iy)
+    d1 = (ix - ix1) ** 2 + 3.0 * (iy - iy1) ** 2
+    d2 = (ix - ix2 - 0.5) ** 2 + 3.0 * (iy - iy2 - 0.5) ** 2
+    first = d1 < d2
+    # Doubled lattice coordinates keep both offset lattices on integers.
+    cx = np.where(first, 2 * ix1, 2 * ix2 + 1).astype(np.int64)
+    cy = np.where(first, 2 * iy1, 2 * iy2 + 1).astype(np.int64)
+    cells, counts = np.unique(np.stack([cx, cy], axis=1), axis=0, return_counts=True)
+    return {
+        "x": (xmin + cells[:, 0] * sx / 2).tolist(),
+        "y": (ymin + cells[:, 1] * sy / 2).tolist(),
+        "counts": counts.tolist(),
+        "size": [float(sx), float(sy)],
+    }
+
+
+def group_stats(df, metric, edges=DEFAULT_AGE_BANDS, quantiles=DEFAULT_QUANTILES):
+    """
+    Returns count, mean and quantiles of metric per age band (and per cycle
+    when the profile has a cycle column) as a list of records.
+    """
+    keys = {"age_band": age_bands(numeric_values(df[AGE_COLUMN]), edges)}
+    if "cycle" in df.columns:
+        keys["cycle"] = df["cycle"].astype(str).to_numpy()
+    frame = pd.DataFrame(dict(keys, value=numeric_values(df[metric])))
+    grouped = frame.dropna(subset=["value"]).groupby(list(keys), observed=True)["value"]
+
+    stats = grouped.agg(["count", "mean"])
+    for q in quantiles:
+        stats[f"q{int(round(q * 100))}"] = grouped.quantile(q)
+    stats = stats.reset_index()
+    stats["age_band"] = stats["age_band"].astype(str)
+    stats = stats.astype(object).where(stats.notna(), None)
+    return stats.to_dict(orient="records")
+
+
+def sample_rows(df, max_points, stratify=None, seed=0):
+    """
+    Returns at most max_points rows of df, drawn uniformly at random or, with
+    stratify, proportionally from every group of that column (at least one
+    row per group).  Row order is preserved.
+    """
+    if len(df) <= max_points:
+        return df
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(df))
+    if stratify is None:
+        return df.iloc[np.sort(order[:max_points])]
+
+    groups = df[stratify].astype(str).to_numpy()[order]
+    shuffled = pd.Series(groups)
+    rank = shuffled.groupby(shuffled).cumcount().to_numpy()
+    sizes = shuffled.map(shuffled.value_counts()).to_numpy()
+    quota = np.maximum(np.floor(max_points * sizes / len(df)), 1)
+    chosen = order[rank < quota][:max_points]
+    return df.iloc[np.sort(chosen)]
+
+
+def _int_param(params, name, default, upper):
+    value = params.get(name)
+    if value in (None, ""):
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be an integer.")
+    if value < 1:
+        raise ValueError(f"{name} must be positive.")
+    return min(value, upper)
+
+
+def visualization_columns(df, params):
+    """
+    Returns the columns of df that visualization_payload needs for params, in
+    df's column order, so a stored profile can be loaded with only those
+    columns.  df may be a zero-row frame carrying just the profile's schema.
+
+    Raises:
+    - ValueError: For missing age or metric columns.
+    """
+    if AGE_COLUMN not in df.columns:
+        raise ValueError("Age column not found in data.")
+    needed = {AGE_COLUMN, pick_metric(df, params.get("metric")), "SEQN", "cycle"}
+    if params.get("stratify"):
+        needed.add(params["stratify"])
+    return [col for col in df.columns if col in needed]
+
+
+def visualization_payload(df, params, default_max_points=DEFAULT_MAX_POINTS):
+    """
+    Builds the /visualization response body for a profile.
+
+    Parameters:
+    - df (DataFrame): The merged profile.
+    - params (dict): Query parameters:
+      - mode: "points" (default; capped sample of individual points), "histogram"
+        (age histogram, or of metric with field=metric), "grid" / "hex" (2-D
+        counts of age against the metric), or "stats" (count, mean and
+        quantiles of the metric per age band and cycle).
+      - metric: Column to plot (default: picked with pick_metric).
+      - bins / gridsize: Number of bins (capped at MAX_BINS / MAX_GRIDSIZE).
+      - max_points: Points returned in "points" mode (capped at MAX_POINTS).
+      - stratify: Column to sample proportionally from (e.g. "cycle").
+      - seed: Random seed for sampling.
+    - default_max_points (int): max_points when not given.
+
+    Returns:
+    - dict: A payload whose size does not depend on the cohort size; point
+      columns are NumPy arrays (missing values as NaN), to be encoded with
+      response_encoding.payload_response.
+
+    Raises:
+    - ValueError: For unknown modes, bad parameters or missing columns.
+    """
+    mode = params.get("mode") or "points"
+    if mode not in MODES:
+        raise ValueError(f"Invalid mode. Choose from {', '.join(MODES)}.")
+    if AGE_COLUMN not in df.columns:
+        raise ValueError("Age column not found in data.")
+    metric = pick_metric(df, params.get("metric"))
+    payload = {"mode": mode, "metricName": metric, "total": int(len(df))}
+
+    if mode == "points":
+        max_points = _int_param(params, "max_points", default_max_points, MAX_POINTS)
+        stratify = params.get("stratify") or None
+        if stratify is not None and stratify not in df.columns:
+            raise ValueError(f"Stratify column {stratify} not found in data.")
+        sample = sample_rows(df, max_points, stratify, seed=_int_param(params, "seed", 0, 2 ** 32 - 1))
+        age, health_metric = numeric_values(sample[AGE_COLUMN]), numeric_values(sample[metric])
+        payload.update({
+            'age': age,
+            'healthMetric': health_metric,
+            'labels': sample['SEQN'].to_numpy() if 'SEQN' in sample.columns else sample.index.to_numpy(),
+            'sampled': len(sample) < len(df),
+        })
+    elif mode == "histogram":
+        field = metric if params.get("field") == "metric" else AGE_COLUMN
+        payload["field"] = field
+        payload.update(histogram(numeric_values(df[field]), _int_param(params, "bins", 20, MAX_BINS)))
+    elif mode == "grid":
+        payload.update(grid_counts(numeric_values(df[AGE_COLUMN]), numeric_values(df[metric]),
+                                   _int_param(params, "bins", 20, MAX_BINS)))
+    elif mode == "hex":
+        payload.update(hex_counts(numeric_values(df[AGE_COLUMN]), numeric_values(df[metric]),
+                                  _int_param(params, "gridsize", 20, MAX_GRIDSIZE)))
+    else:
+        payload["groups"] = group_stats(df, metric)
+    return payload
@@ -0,0 +1,527 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+import pandas as pd
+from instrumentation import debug, metrics, warning
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - pyarrow is optional
+    pa = pq = None
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+DEFAULT_CACHE_DIR = os.path.join("nhanes_data", "xpt_cache")
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3  # 2 GiB
+DEFAULT_CHUNK_ROWS = 20000
+# Seconds between writes of the last access times recorded by cache hits.
+ACCESS_FLUSH_INTERVAL = 30.0
+
+
+class CacheMissError(Exception):
+    """Raised when a file is requested in offline mode and is not cached."""
+
+
+class XPTCache:
+    """
+    Persistent, content-addressed cache for downloaded NHANES XPT files.
+
+    Files are stored once under their SHA-256 digest (objects/<sha>.XPT) and an
+    index maps "<cycle>/<file code>" keys onto those digests.  The index also
+    records the size (including the Parquet copy kept next to the object) and
+    last access time of every entry so the cache can be kept under a size cap
+    by evicting the least recently used files.
+
+    Several processes (e.g. gunicorn workers) can share one cache directory:
+    every change to index.json re-reads and merges it under an exclusive lock
+    on index.lock, and readers reload it when another process has replaced
+    it.  Last access times of cache hits are batched and written at most
+    every ACCESS_FLUSH_INTERVAL seconds (or with the next change).
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=None, offline=None, revalidate_after=None):
+        """
+        Parameters:
+        - cache_dir (str): Directory holding the index and the cached objects.
+        - max_bytes (int): Size cap in bytes (default: NHANES_CACHE_MAX_BYTES or 2 GiB).
+        - offline (bool): Serve only from cache (default: NHANES_OFFLINE env var).
+        - revalidate_after (float): Seconds after which a cached file is revalidated
+          with a conditional request (default: NHANES_REVALIDATE_AFTER, or never).
+        """
+        if revalidate_after is None and os.environ.get("NHANES_REVALIDATE_AFTER"):
+            revalidate_after = float(os.environ["NHANES_REVALIDATE_AFTER"])
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("NHANES_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+        if offline is None:
+            offline = os.environ.get("NHANES_OFFLINE", "") not in ("", "0", "false", "False")
+
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.lock_path = os.path.join(cache_dir, "index.lock")
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.revalidate_after = revalidate_after
+        self._lock = threading.RLock()
+        self._verified = set()
+        self._pending_access = {}
+        self._index_stamp = None
+        self._flushed = time.time()
+
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self._index = self._load_index()
+
+    @staticmethod
+    def key(cycle, file_code):
+        return f"{cycle}/{file_code}"
+
+    def _stamp(self):
+        try:
+            info = os.stat(self.index_path)
+        except FileNotFoundError:
+            return None
+        return info.st_ino, info.st_mtime_ns, info.st_size
+
+    def _load_index(self):
+        """
+        Reads index.json, keeping the more recent last access times of hits
+        this process has not written yet.
+        """
+        self._index_stamp = self._stamp()
+        index = {}
+        if self._index_stamp is not None:
+            try:
+                with open(self.index_path, "r") as f:
+                    index = json.load(f)
+            except (OSError, ValueError) as e:
+                warning(f"Ignoring unreadable cache index {self.index_path}: {e}")
+        for key, accessed in self._pending_access.items():
+            entry = index.get(key)
+            if entry is not None and accessed > entry["last_access"]:
+                entry["last_access"] = accessed
+        return index
+
+    def _refresh(self):
+        # index.json is replaced atomically, so a new inode, mtime or size means another process changed it.
+        if self._stamp() != self._index_stamp:
+            self._index = self._load_index()
+
+    def _save_index(self):
+        tmp_path = f"{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self.index_path)
+        self._index_stamp = self._stamp()
+        self._pending_access.clear()
+        self._flushed = time.time()
+
+    @contextmanager
+    def _locked_index(self):
+        """
+        Holds the index exclusively (across threads and processes) while it is
+        changed: the latest index.json is merged in first and written back
+        when the block completes.
+        """
+        with self._lock, open(self.lock_path, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._index = self._load_index()
+            yield self._index
+            self._save_index()
+
+    def flush(self):
+        """
+        Writes the batched last access times of cache hits to index.json.
+        """
+        with self._lock:
+            if self._pending_access:
+                with self._locked_index():
+                    pass
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, f"{digest}.XPT")
+
+    @staticmethod
+    def _file_digest(path):
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def _is_referenced(self, digest):
+        return any(entry["sha256"] == digest for entry in self._index.values())
+
+    def _remove_object(self, digest):
+        """
+        Deletes a stored object together with its columnar copy.
+        """
+        xpt_path = self._object_path(digest)
+        for path in (xpt_path, columnar_path(xpt_path)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._verified.discard(digest)
+
+    def _drop(self, key):
+        entry = self._index.pop(key, None)
+        if entry is None:
+            return
+        digest = entry["sha256"]
+        if not self._is_referenced(digest):
+            self._remove_object(digest)
+
+    def total_bytes(self):
+        """
+        Returns the disk space of the cached objects and their Parquet copies.
+        """
+        with self._lock:
+            self._refresh()
+            sizes = {}
+            for entry in self._index.values():
+                size = entry["size"] + entry.get("columnar_size", 0)
+                sizes[entry["sha256"]] = max(size, sizes.get(entry["sha256"], 0))
+            return sum(sizes.values())
+
+    def fingerprint(self, cycle=None, file_code=None):
+        """
+        Returns a digest of which content is cached under which key.  It changes
+        whenever a cached source file is added, replaced or evicted, so results
+        derived from the cache can be invalidated when their inputs change.
+        With cycle, only that cycle's files are taken into account; with cycle
+        and file_code, only that one file.
+        """
+        if cycle and file_code:
+            exact = self.key(cycle, file_code)
+            with self._lock:
+                self._refresh()
+                entry = self._index.get(exact)
+                items = [(exact, entry["sha256"])] if entry is not None else []
+            return hashlib.sha256(json.dumps(items).encode("utf-8")).hexdigest()
+        prefix = self.key(cycle, "") if cycle else ""
+        with self._lock:
+            self._refresh()
+            items = sorted((key, entry["sha256"]) for key, entry in self._index.items() if key.startswith(prefix))
+        return hashlib.sha256(json.dumps(items).encode("utf-8")).hexdigest()
+
+    def get(self, cycle, file_code):
+        """
+        Returns the path of the cached XPT file, or None if it is not cached.
+
+        Each object's checksum is verified the first time it is served by this
+        process; corrupt or missing objects are dropped from the index.
+        """
+        key = self.key(cycle, file_code)
+        with self._lock:
+            self._refresh()
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+
+            digest = entry["sha256"]
+            path = self._object_path(digest)
+            if not os.path.exists(path) or os.path.getsize(path) != entry["size"]:
+                warning(f"Cached object for {key} is missing or truncated, dropping it.")
+                self._drop_if_current(key, digest)
+                return None
+
+            if digest not in self._verified:
+                if self._file_digest(path) != digest:
+                    warning(f"Checksum mismatch for cached {key}, dropping it.")
+                    self._drop_if_current(key, digest)
+                    return None
+                self._verified.add(digest)
+
+            now = time.time()
+            entry["last_access"] = self._pending_access[key] = now
+            if now - self._flushed >= ACCESS_FLUSH_INTERVAL:
+                self.flush()
+            return path
+
+    def _drop_if_current(self, key, digest):
+        with self._locked_index() as index:
+            if key in index and index[key]["sha256"] == digest:
+                self._drop(key)
+
+    def record_columnar(self, cycle, file_code):
+        """
+        Records the size of the Parquet copy written next to a cached file so
+        it counts towards max_bytes, evicting other entries if needed.
+        """
+        key = self.key(cycle, file_code)
+        with self._lock:
+            self._refresh()
+            entry = self._index.get(key)
+            if entry is None or entry.get("columnar_size"):
+                return
+            digest = entry["sha256"]
+            path = columnar_path(self._object_path(digest))
+            if not os.path.exists(path):
+                return
+            with self._locked_index() as index:
+                # Every key cached with the same content shares the object and its copy.
+                for entry in index.values():
+                    if entry["sha256"] == digest:
+                        entry["columnar_size"] = os.path.getsize(path)
+                self._evict(keep=key)
+
+    def put(self, cycle, file_code, src_path, etag=None, last_modified=None):
+        """
+        Moves a freshly downloaded file into the cache and returns its cached path.
+        etag and last_modified are the server's validators for later revalidation.
+        """
+        digest = self._file_digest(src_path)
+        size = os.path.getsize(src_path)
+        key = self.key(cycle, file_code)
+
+        with self._lock:
+            dest = self._object_path(digest)
+            if os.path.exists(dest):
+                os.remove(src_path)
+            else:
+                os.replace(src_path, dest)
+            self._verified.add(digest)
+            columnar = columnar_path(dest)
+            columnar_size = os.path.getsize(columnar) if os.path.exists(columnar) else 0
+
+            with self._locked_index() as index:
+                previous = index.get(key)
+                now = time.time()
+                index[key] = {
+                    "sha256": digest,
+                    "size": size,
+                    "columnar_size": columnar_size,
+                    "last_access": now,
+                    "validated": now,
+                    "etag": etag,
+                    "last_modified": last_modified,
+                }
+                if previous is not None and previous["sha256"] != digest and not self._is_referenced(previous["sha256"]):
+                    self._remove_object(previous["sha256"])
+                self._evict(keep=key)
+            return dest
+
+    def _evict(self, keep=None):
+        """
+        Evicts least recently used entries until the cache fits under max_bytes.
+        """
+        by_age = sorted(self._index.items(), key=lambda item: item[1]["last_access"])
+        for key, _ in by_age:
+            if self.total_bytes() <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            debug(f"Evicting {key} from XPT cache")
+            self._drop(key)
+
+    def _needs_revalidation(self, key):
+        if self.offline or self.revalidate_after is None:
+            return False
+        with self._lock:
+            self._refresh()
+            entry = self._index.get(key)
+            if entry is None:
+                return False
+            return time.time() - entry.get("validated", 0) >= self.revalidate_after
+
+    def fetch(self, cycle, file_code, download):
+        """
+        Returns the cached path for (cycle, file_code), calling
+        download(tmp_path, validators) to populate the cache on a miss or to
+        revalidate a copy older than revalidate_after.  download returns a
+        nhanes_http.DownloadResult; validators holds the cached copy's ETag and
+        Last-Modified (None on a miss).  If revalidation fails the cached copy
+        is still served.
+
+        Raises CacheMissError in offline mode when the file is not cached.
+        """
+        key = self.key(cycle, file_code)
+        path = self.get(cycle, file_code)
+        if path is not None and not self._needs_revalidation(key):
+            metrics.cache("xpt", True)
+            return path
+
+        if path is None and self.offline:
+            raise CacheMissError(f"{key} is not cached and offline mode is enabled")
+
+        validators = None
+        if path is not None:
+            with self._lock:
+                entry = self._index.get(key, {})
+                validators = {"etag": entry.get("etag"), "last_modified": entry.get("last_modified")}
+            if not any(validators.values()):
+                validators = None
+
+        tmp_path = os.path.join(
+            self.objects_dir, f"{file_code}.{os.getpid()}.{threading.get_ident()}.part"
+        )
+        try:
+            result = download(tmp_path, validators)
+            # A revalidated copy counts as a hit: nothing but headers was transferred.
+            metrics.cache("xpt", result.status != "downloaded" and path is not None)
+            if result.status == "downloaded":
+                return self.put(cycle, file_code, tmp_path, result.etag, result.last_modified)
+            if result.status == "not_modified" and path is not None:
+                with self._locked_index() as index:
+                    if key in index:
+                        index[key]["validated"] = time.time()
+                debug(f"{key} revalidated, cached copy is current")
+                return path
+            if path is not None:
+                warning(f"Could not revalidate {key}, serving the cached copy.")
+            return path
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Returns the shared XPTCache for cache_dir, creating it on first use.
+    """
+    cache_dir = os.path.abspath(cache_dir)
+    with _caches_lock:
+        if cache_dir not in _caches:
+            _caches[cache_dir] = XPTCache(cache_dir)
+        return _caches[cache_dir]
+
+
+def columnar_path(xpt_path):
+    """
+    Returns the path of the Parquet copy kept alongside an XPT file.
+    """
+    return os.path.splitext(xpt_path)[0] + ".parquet"
+
+
+def _project(df, columns):
+    return df if columns is None else df[[c for c in columns if c in df.columns]]
+
+
+def iter_xpt(xpt_path, columns=None, chunksize=DEFAULT_CHUNK_ROWS):
+    """
+    Yields an XPT file as DataFrames of at most chunksize rows, projected to
+    columns, without ever holding the whole file in memory.
+
+    Chunks come from the Parquet copy when one exists.  Otherwise the XPT file
+    is parsed incrementally and, when pyarrow is installed, the Parquet copy is
+    written chunk by chunk along the way (and kept only if the file was read
+    to the end).
+    """
+    parquet_path = columnar_path(xpt_path)
+    if pq is not None and os.path.exists(parquet_path):
+        parquet = pq.ParquetFile(parquet_path)
+        if columns is not None:
+            available = set(parquet.schema_arrow.names)
+            columns = [c for c in columns if c in available]
+        for batch in parquet.iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+        return
+
+    writer = None
+    tmp_path = f"{parquet_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    complete = False
+    try:
+        with pd.read_sas(xpt_path, format='xport', chunksize=chunksize) as reader:
+            for chunk in reader:
+                if pq is not None:
+                    writer = _write_chunk(writer, tmp_path, chunk)
+                yield _project(chunk, columns)
+        complete = True
+    finally:
+        if writer:
+            writer.close()
+            if complete:
+                os.replace(tmp_path, parquet_path)
+                debug(f"Stored columnar copy of {xpt_path} at {parquet_path}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _write_chunk(writer, tmp_path, chunk):
+    """
+    Appends chunk to the Parquet copy being written at tmp_path.  Returns the
+    writer, or False once writing failed (the copy is then abandoned).
+    """
+    if writer is False:
+        return False
+    try:
+        if writer is None:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            writer = pq.ParquetWriter(tmp_path, table.schema)
+        else:
+            table = pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False)
+        writer.write_table(table)
+        return writer
+    except Exception as e:
+        warning(f"Could not store columnar copy at {tmp_path}: {str(e)}")
+        if writer:
+            writer.close()
+        return False
+
+
+def read_xpt(xpt_path, columns=None, chunksize=None, transform=None):
+    """
+    Reads an XPT file, converting it once into a typed Parquet copy with every
+    column so later reads skip SAS transport parsing entirely.
+
+    Parameters:
+    - xpt_path (str): Path of the XPT file.
+    - columns (list): Columns to read; only those present in the file are
+      returned, in the requested order.  None reads every column.
+    - chunksize (int): Stream the file in chunks of this many rows (see
+      iter_xpt) instead of materializing it, so peak memory follows the
+      output rather than the file size.
+    - transform (callable): With chunksize, applied to every projected chunk
+      (e.g. missing-code cleaning and filters); only the rows it returns are kept.
+
+    Returns:
+    - DataFrame: The requested columns.  Without pyarrow installed the XPT file
+      is parsed on every call.
+    """
+    if chunksize:
+        parts, empty = [], None
+        for chunk in iter_xpt(xpt_path, columns, chunksize):
+            if transform is not None:
+                chunk = transform(chunk)
+            if len(chunk):
+                parts.append(chunk)
+            elif empty is None:
+                empty = chunk.iloc[0:0]
+        if not parts:
+            return empty if empty is not None else pd.DataFrame(columns=columns or [])
+        return pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0].reset_index(drop=True)
+
+    if pq is None:
+        df = pd.read_sas(xpt_path, format='xport')
+        return _project(df, columns)
+
+    parquet_path = columnar_path(xpt_path)
+    if not os.path.exists(parquet_path):
+        df = pd.read_sas(xpt_path, format='xport')
+        tmp_path = f"{parquet_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, parquet_path)
+            debug(f"Stored columnar copy of {xpt_path} at {parquet_path}")
+        except Exception as e:
+            warning(f"Could not store columnar copy of {xpt_path}: {str(e)}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return _project(df, columns)
+
+    if columns is not None:
+        available = set(pq.read_schema(parquet_path).names)
+        columns = [c for c in columns if c in available]
+    return pd.read_parquet(parquet_path, columns=columns)